@@ -0,0 +1,48 @@
+import csv
+import time
+import six
+from contextlib import closing
+from dpark import optParser
+from dpark.file_manager import open_file
+from dpark.rdd import TextFileRDD, CSVFileRDD, convert_csv_rows
+
+optParser.set_usage("%prog [options] path [path ...]")
+optParser.add_option("--split-size", type="int", default=TextFileRDD.DEFAULT_SPLIT_SIZE)
+optParser.add_option("--dialect", default='excel')
+optParser.add_option("--types", help="types of columns, e.g. int,float,str")
+options, args = optParser.parse_args()
+types = options.types and [getattr(six.moves.builtins, t) for t in options.types.split(',')]
+
+
+def read_by_line(f, start, end):
+    # the reader of csvFile before parsing in blocks
+    rdd = TextFileRDD.__new__(TextFileRDD)
+    rows = csv.reader(rdd.read(f, start, end), options.dialect)
+    if types:
+        return ([t(v) for t, v in zip(types, row)] for row in rows)
+    return rows
+
+
+def read_by_block(f, start, end):
+    rdd = CSVFileRDD.__new__(CSVFileRDD)
+    rows = rdd.read_rows(f, start, end, csv.get_dialect(options.dialect))
+    if types:
+        return convert_csv_rows(rows, types)
+    return rows
+
+
+def run(path, read):
+    t = time.time()
+    n = 0
+    with closing(open_file(path)) as f:
+        size = min(f.length, options.split_size)
+        for _ in read(f, 0, size):
+            n += 1
+    return n, size, time.time() - t
+
+
+for path in args:
+    run(path, read_by_block)  # file cache
+    for name, read in [('by line', read_by_line), ('by block', read_by_block)]:
+        n, size, secs = run(path, read)
+        print("{}: {} {} rows, {:.1f}MB/s".format(path, name, n, size / secs / (1 << 20)))
@@ -0,0 +1,44 @@
+import time
+import six
+from contextlib import closing
+from dpark import optParser
+from dpark.file_manager import open_file
+from dpark.rdd import TextFileRDD
+
+optParser.set_usage("%prog [options] path [path ...]")
+optParser.add_option("--split-size", type="int", default=TextFileRDD.DEFAULT_SPLIT_SIZE)
+options, args = optParser.parse_args()
+
+
+def read_by_line(f, start, end):
+    # the reader before bulk splitting
+    for line in f:
+        size = len(line)
+        if not six.PY2:
+            line = line.decode('utf-8')
+
+        if line.endswith('\n'):
+            yield line[:-1]
+        else:
+            yield line
+        start += size
+        if start >= end:
+            break
+
+
+def run(path, read):
+    t = time.time()
+    n = 0
+    with closing(open_file(path)) as f:
+        size = min(f.length, options.split_size)
+        for _ in read(f, 0, size):
+            n += 1
+    return n, size, time.time() - t
+
+
+for path in args:
+    rdd = TextFileRDD.__new__(TextFileRDD)
+    run(path, rdd.read)  # file cache
+    for name, read in [('by line', read_by_line), ('by block', rdd.read)]:
+        n, size, secs = run(path, read)
+        print("{}: {} {} lines, {:.1f}MB/s".format(path, name, n, size / secs / (1 << 20)))
@@ -1,16 +1,19 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import os
+import sys
+import socket
 import marshal
-from six.moves import cPickle
+import itertools
+from six.moves import cPickle, http_client
 import shutil
-import struct
-
-import msgpack
+import threading
+from collections import OrderedDict
 
+import dpark.conf as conf
 from dpark.env import env
-from dpark.serialize import marshalable
-from dpark.utils import mkdir_p, atomic_file
+from dpark.shuffle import pack_header, unpack_header
+from dpark.utils import mkdir_p, atomic_file, compress, decompress
 from dpark.utils.log import get_logger
 from dpark.tracker import GetValueMessage, AddItemMessage, RemoveItemMessage
 from six.moves import map
@@ -19,6 +22,14 @@ from six.moves import urllib
 
 logger = get_logger(__name__)
 
+# storage levels of cached rdd in memory, of local and process modes only:
+# tasks of Mesos executors have processes of their own, where partitions are
+# neither serialized nor kept (see CacheTracker)
+MEMORY = 'MEMORY'  # python objects
+MEMORY_SER = 'MEMORY_SER'  # marshal/pickle batches
+MEMORY_SER_COMPRESSED = 'MEMORY_SER_COMPRESSED'  # compressed marshal/pickle batches
+STORAGE_LEVELS = (MEMORY, MEMORY_SER, MEMORY_SER_COMPRESSED)
+
 
 class Cache:
     data = {}
@@ -39,7 +50,265 @@ class Cache:
         self.data.clear()
 
 
+SIZE_SAMPLE_STEP = 16
+
+
+def estimate_size(obj, depth=3):
+    """ approximate bytes used by obj, following containers to depth """
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(estimate_size(v, depth - 1) for v in obj)
+    elif isinstance(obj, dict):
+        size += sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1)
+                    for k, v in obj.items())
+    return size
+
+
+class SerializedBlock(object):
+    """ items of a partition kept as marshal/pickle batches, decoded lazily on iteration """
+
+    BATCH_SIZE = 1 << 16
+
+    def __init__(self, compressed=False):
+        self.compressed = compressed
+        self.batches = []  # [(is_marshal, buf)]
+        self.size = 0
+        self.use_marshal = True
+        self.kept = False  # all items are kept, set by add_items
+
+    def add_batch(self, items):
+        buf = None
+        if self.use_marshal:
+            try:
+                buf = marshal.dumps(items)
+            except Exception:
+                self.use_marshal = False
+
+        if not self.use_marshal:
+            buf = cPickle.dumps(items, -1)
+
+        if self.compressed:
+            buf = compress(buf)
+        self.batches.append((self.use_marshal, buf))
+        self.size += len(buf)
+        return len(buf)
+
+    def add_items(self, items, capacity):
+        """ yield items and serialize them in batches, stop keeping them
+            and return False if the size exceeds capacity """
+        batch = []
+        batch_num = 1
+        keep = True
+        for v in items:
+            if keep:
+                batch.append(v)
+                if len(batch) >= batch_num:
+                    if self.add_batch(batch) < self.BATCH_SIZE:
+                        batch_num *= 2
+                    batch = []
+                    if self.size > capacity:
+                        keep = False
+                        self.batches = []
+            yield v
+
+        if keep and batch:
+            self.add_batch(batch)
+            keep = self.size <= capacity
+        self.kept = keep
+
+    def __iter__(self):
+        for is_marshal, buf in self.batches:
+            if self.compressed:
+                buf = decompress(buf)
+            if is_marshal:
+                vs = marshal.loads(buf)
+            else:
+                vs = cPickle.loads(buf)
+            for v in vs:
+                yield v
+
+
+class MemoryCache(Cache):
+    """ LRU cache of partitions, bounded by estimated size in bytes.
+
+        Partitions too large to fit are not kept, evicted ones are just dropped,
+        a copy is always kept by DiskCache.
+
+        Items of MEMORY level are kept in tuples and shared by all tasks reading
+        the partition in the executor, so they must not be changed; use
+        MEMORY_SER to get new objects for each task.
+    """
+
+    def __init__(self, capacity):
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.capacity = capacity
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value  # most recently used
+            return value
+
+    def _remove(self, key):
+        if self.data.pop(key, None) is not None:
+            self.used -= self.sizes.pop(key)
+
+    def _add(self, key, value, size):
+        with self.lock:
+            self._remove(key)
+            while self.data and self.used + size > self.capacity:
+                k, _ = self.data.popitem(last=False)
+                self.used -= self.sizes.pop(k)
+                env.task_stats.num_cache_evict += 1
+                logger.debug('evict partition %s from memory cache', k)
+
+            self.data[key] = value
+            self.sizes[key] = size
+            self.used += size
+
+    def put(self, key, value, is_iterator=False):
+        if value is None:
+            with self.lock:
+                self._remove(key)
+            return
+
+        if is_iterator:
+            return self.put_iter(key, value)
+
+        value = tuple(value)
+        size = estimate_size(value, 1)
+        if size <= self.capacity:
+            self._add(key, value, size)
+        return value
+
+    def put_iter(self, key, items, storage_level=MEMORY):
+        """ yield items, keep them if the estimated size fits in capacity """
+        if storage_level != MEMORY:
+            block = SerializedBlock(compressed=(storage_level == MEMORY_SER_COMPRESSED))
+            for v in block.add_items(items, self.capacity):
+                yield v
+
+            if block.kept:
+                self._add(key, block, block.size + sys.getsizeof(block.batches))
+            return
+
+        buf = []
+        size = 0
+        for i, v in enumerate(items):
+            if buf is not None:
+                buf.append(v)
+                if i % SIZE_SAMPLE_STEP == 0:
+                    size += estimate_size(v) * SIZE_SAMPLE_STEP
+                    if size > self.capacity:
+                        buf = None
+            yield v
+
+        if buf is not None:
+            self._add(key, tuple(buf), size + sys.getsizeof(buf))
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.used = 0
+
+
+CACHE_BATCH_SIZE = 1 << 17
+MAX_DRAIN_SIZE = 1 << 20
+
+'''
+Cache File Format:
++------------+-----+------------+-----------+
+|  *Batch_0  | ... |  *Batch_n  |  End_Mark |
+|            |     |            |    (5)    |
++------------+-----+------------+-----------+
+
+*: header(5) + compressed marshal/pickle list of items, see shuffle.pack_header
+End_Mark: header with length 0, where streaming the file ends
+'''
+
+
+class HTTPConnectionPool(object):
+    """ keep-alive http connections to other executors, by host:port """
+
+    def __init__(self):
+        self.conns = {}
+        self.lock = threading.Lock()
+
+    def get(self, netloc):
+        with self.lock:
+            conns = self.conns.get(netloc)
+            if conns:
+                return conns.pop()
+        return http_client.HTTPConnection(netloc, timeout=60)
+
+    def put(self, netloc, conn):
+        with self.lock:
+            self.conns.setdefault(netloc, []).append(conn)
+
+    def urlopen(self, url):
+        """ return (status, response), response is closed unless status is 200 """
+        parsed = urllib.parse.urlparse(url)
+        for i in range(2):
+            conn = self.get(parsed.netloc)
+            try:
+                conn.request('GET', parsed.path)
+                resp = conn.getresponse()
+                break
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if i:  # a fresh connection also failed
+                    raise
+
+        if resp.status != 200:
+            resp.read()
+            self.release(parsed.netloc, conn, resp)
+            return resp.status, None
+        return resp.status, PooledResponse(self, parsed.netloc, conn, resp)
+
+    def release(self, netloc, conn, resp):
+        if resp.length is not None and resp.length <= MAX_DRAIN_SIZE:
+            resp.read()
+        if resp.isclosed() and not resp.will_close:
+            self.put(netloc, conn)
+        else:
+            conn.close()
+
+    def clear(self):
+        with self.lock:
+            for conns in self.conns.values():
+                for conn in conns:
+                    conn.close()
+            self.conns.clear()
+
+
+class PooledResponse(object):
+
+    def __init__(self, pool, netloc, conn, resp):
+        self.pool = pool
+        self.netloc = netloc
+        self.conn = conn
+        self.resp = resp
+
+    def read(self, n):
+        return self.resp.read(n)
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.netloc, self.conn, self.resp)
+            self.conn = None
+
+
 class DiskCache(Cache):
+    conn_pool = HTTPConnectionPool()
+
     def __init__(self, tracker, path):
         try:
             mkdir_p(path)
@@ -67,15 +336,20 @@ class DiskCache(Cache):
         serve_uri = locs[-1]
         uri = '%s/cache/%s' % (serve_uri, os.path.basename(p))
         try:
-            f = urllib.request.urlopen(uri)
+            if uri.startswith('http://'):
+                status, f = self.conn_pool.urlopen(uri)
+            else:
+                f = urllib.request.urlopen(uri)
+                status = 200
         except IOError:
             logger.warning('urlopen cache uri %s failed', uri)
             raise
-        if f.code == 404:
+        if status == 404:
             logger.warning('load from cache %s failed', uri)
             self.tracker.removeHost(rdd_id, index, serve_uri)
-            f.close()
             return
+        if f is None:
+            raise IOError('urlopen cache uri %s failed: %s' % (uri, status))
         return self.load(f)
 
     def put(self, key, value, is_iterator=False):
@@ -92,43 +366,57 @@ class DiskCache(Cache):
             pass
 
     def load(self, f):
-        count, = struct.unpack("I", f.read(4))
-        if not count: return
-        unpacker = msgpack.Unpacker(f, use_list=False)
-        for i in range(count):
-            _type, data = next(unpacker)
-            if _type == 0:
-                yield marshal.loads(data)
-            else:
-                yield cPickle.loads(data)
-        f.close()
+        try:
+            while True:
+                length, is_marshal, _ = unpack_header(f.read(5))
+                if not length:
+                    break
+                buf = f.read(length)
+                if len(buf) != length:
+                    raise IOError("length not match: expected %d, but got %d" % (length, len(buf)))
+
+                buf = decompress(buf)
+                vs = marshal.loads(buf) if is_marshal else cPickle.loads(buf)
+                for v in vs:
+                    yield v
+        finally:
+            f.close()
 
     def save(self, path, items):
         # TODO: purge old cache
         with atomic_file(path) as f:
-            c = 0
-            f.write(struct.pack("I", c))
-            # check is marshalable and compatible with broadcast
-            can_marshal = marshalable(items)
-            for v in items:
-                if can_marshal:
+            offset = 0
+            batch_num = 1
+            use_marshal = True
+            items = iter(items)
+            while True:
+                vs = list(itertools.islice(items, batch_num))
+                if not vs:
+                    break
+
+                buf = None
+                if use_marshal:
                     try:
-                        r = 0, marshal.dumps(v)
+                        buf = marshal.dumps(vs)
                     except Exception:
-                        r = 1, cPickle.dumps(v, -1)
-                        can_marshal = False
-                else:
-                    r = 1, cPickle.dumps(v, -1)
-                f.write(msgpack.packb(r))
-                c += 1
-                yield v
+                        use_marshal = False
+                if not use_marshal:
+                    buf = cPickle.dumps(vs, -1)
+
+                buf = compress(buf)
+                f.write(pack_header(len(buf), use_marshal, False))
+                f.write(buf)
+                offset += len(buf) + 5
+                if len(buf) < CACHE_BATCH_SIZE:
+                    batch_num *= 2
 
-            bytes = f.tell()
-            if bytes > 10 << 20:
-                logger.warning("cached result is %dMB (larger than 10MB)", bytes >> 20)
-            # count
-            f.seek(0)
-            f.write(struct.pack("I", c))
+                for v in vs:
+                    yield v
+
+            if offset > 10 << 20:
+                logger.warning("cached result is %dMB (larger than 10MB)", offset >> 20)
+
+            f.write(pack_header(0, True, False))
 
 
 class BaseCacheTracker(object):
@@ -180,6 +468,12 @@ class CacheTracker(BaseCacheTracker):
     def __init__(self):
         cachedir = os.path.join(env.get('WORKDIR')[0], 'cache')
         self.cache = DiskCache(self, cachedir)
+        # tasks of Mesos executors run in processes of their own, which keep
+        # nothing for later tasks, so partitions are cached in memory only by
+        # the long-lived processes of local and process schedulers
+        self.mem_cache = None
+        if not env.get('PROCESS_PER_TASK'):
+            self.mem_cache = MemoryCache(conf.CACHE_MEMORY_SIZE << 20)
         self.client = env.trackerClient
         if env.trackerServer is not None:
             self.locs = env.trackerServer.locs
@@ -214,19 +508,39 @@ class CacheTracker(BaseCacheTracker):
     def removeHost(self, rdd_id, index, host):
         return self.client.call(RemoveItemMessage('cache:%s-%s' % (rdd_id, index), host))
 
+    def clear(self):
+        if self.mem_cache is not None:
+            self.mem_cache.clear()
+        self.cache.clear()
+
     def getOrCompute(self, rdd, split):
         key = (rdd.id, split.index)
+        mem_cache = self.mem_cache
+        if mem_cache is not None:
+            cachedVal = mem_cache.get(key)
+            if cachedVal is not None:
+                logger.debug("Found partition in memory cache! %s", key)
+                env.task_stats.num_cache_hit += 1
+                for i in cachedVal:
+                    yield i
+                return
+
         cachedVal = self.cache.get(key)
         if cachedVal is not None:
             logger.debug("Found partition in cache! %s", key)
-            for i in cachedVal:
-                yield i
-
+            env.task_stats.num_cache_hit += 1
+            it = cachedVal
         else:
             logger.debug("partition not in cache, %s", key)
-            for i in self.cache.put(key, rdd.compute(split), is_iterator=True):
-                yield i
+            env.task_stats.num_cache_miss += 1
+            it = self.cache.put(key, rdd.compute(split), is_iterator=True)
+
+        if mem_cache is not None:
+            it = mem_cache.put_iter(key, it, rdd.storage_level)
+        for i in it:
+            yield i
 
+        if cachedVal is None:
             serve_uri = env.get('SERVER_URI')
             if serve_uri:
                 self.addHost(rdd.id, split.index, serve_uri)
@@ -29,18 +29,62 @@ MOOSEFS_MOUNT_POINTS = {
 LOGHUB = None
 LOGHUB_PATH_FORMAT = "%Y/%m/%d/%H"
 
+# profiles of former runs of the same script in loghub are used to order stages,
+# search dirs of the last LOGHUB_HISTORY_HOURS hours, 0 to disable
+LOGHUB_HISTORY_HOURS = 24
+MAX_HISTORY_PROFILES = 16
+
+# dir to keep resource profiles of stages across runs, None to disable;
+# used to raise task memory (max(mem90 * PROFILE_MEM_RATIO, max_rss)) and cpus
+# above -M and -c, and default number of reduce splits (about
+# PROFILE_SPLIT_SIZE bytes each)
+PROFILE_STORE_DIR = None
+PROFILE_MEM_RATIO = 1.2
+PROFILE_SPLIT_SIZE = 64 << 20
+
 ENABLE_ES_LOGHUB = False
 ES_HOST = None
 ES_INDEX = None
 ES_TYPE = None
 
-# consistant dir cache in client, need patched mfsmaster
+# consistant dir cache in client, need patched mfsmaster.
+# if enabled, metadata of MooseFS files prefetched by textFile are also kept
+# in METADATA_CACHE_DIR (default is dpark_meta_cache_<uid> in tempdir), shared
+# by runs in a short time. the dir is not used unless private to the user.
 MOOSEFS_DIR_CACHE = False
+METADATA_CACHE_DIR = None
+
+# secs that prefetched attributes and chunk locations of files are used in driver
+METADATA_CACHE_TTL = 60
+# threads to fetch chunk locations of files from MooseFS master
+METADATA_THREADS = 16
+
+# access points of gzip files are kept in GZIP_INDEX_DIR (default is a dir
+# of the user in tempdir, used only if private to the user), about
+# GZIP_INDEX_SPAN compressed bytes apart. a sidecar index `.<name>.gzidx`
+# next to the file is used first if exists (written by saveAsTextFile with
+# compress). files without index are split at sync flush markers, unless
+# GZIP_INDEX_BUILD, which decompresses the whole file in driver once.
+GZIP_INDEX_DIR = None
+GZIP_INDEX_SPAN = 4 << 20
+GZIP_INDEX_BUILD = False
+
+# max segments (1MB) of a MooseFS file fetched ahead by threads, 0 to disable
+MOOSEFS_READ_AHEAD = 8
 
 # memory used per task, like -M (--m) option in context.
 MEM_PER_TASK = 200.0
 
 MAX_OPEN_FILE = 900
+
+# memory (MB) used by each process to keep cached partitions, in front of disk
+# cache, in local and process modes (tasks of Mesos executors use no memory)
+CACHE_MEMORY_SIZE = 256
+
+# results of RDD.persist() shared by all runs, least recently used ones
+# are removed when they take more than PERSIST_CACHE_SIZE bytes
+PERSIST_CACHE_DIR = None
+PERSIST_CACHE_SIZE = 100 << 30
 LOG_ROTATE = True
 MULTI_SEGMENT_DUMP = True
 
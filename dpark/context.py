@@ -12,7 +12,7 @@ from dpark.schedule import (
     LocalScheduler, MultiProcessScheduler, MesosScheduler
 )
 from dpark.env import env
-from dpark.file_manager import walk
+from dpark.file_manager import walk, stat_files, prefetch
 from dpark.tabular import TabularRDD
 from dpark.utils import memory_str_to_mb
 from dpark.utils.log import init_dpark_logger, get_logger
@@ -224,31 +224,69 @@ class DparkContext(object):
                     return BZip2FileRDD(self, _path, *_ka, **_kw)
                 elif _path.endswith('.gz'):
                     return GZipFileRDD(self, _path, *_ka, **_kw)
+            elif _cls is CSVFileRDD and _path.endswith(('.bz2', '.gz')):
+                _kw = dict(_kw)
+                dialect, types = _kw.pop('dialect'), _kw.pop('types')
+                return create_rdd(TextFileRDD, _path, *_ka, **_kw).fromCsv(dialect, types)
             return _cls(self, _path, *_ka, **_kw)
 
         if os.path.isdir(path):
-            paths = []
-            for root, dirs, names in walk(path, followlinks=followLink):
-                if maxdepth > 0:
-                    depth = len([_f for _f in root[len(path):].split('/') if _f]) + 1
-                    if depth > maxdepth:
-                        break
-                for n in sorted(names):
-                    if n.endswith(ext) and not n.startswith('.'):
-                        p = os.path.join(root, n)
-                        if followLink or not os.path.islink(p):
-                            paths.append(p)
-                dirs.sort()
-                for d in dirs[:]:
-                    if d.startswith('.'):
-                        dirs.remove(d)
-
+            paths = [os.path.join(root, n)
+                     for root, names in self._walk_files(path, ext, followLink, maxdepth)
+                     for n in names]
+            prefetch(paths)
             rdds = [create_rdd(cls, p, *ka, **kws)
                     for p in paths]
             return self.union(rdds)
         else:
             return create_rdd(cls, path, *ka, **kws)
 
+    def _walk_files(self, path, ext, followLink, maxdepth):
+        """ (root, sorted names) of the files to read in directory path """
+        for root, dirs, names in walk(path, followlinks=followLink):
+            if maxdepth > 0:
+                depth = len([_f for _f in root[len(path):].split('/') if _f]) + 1
+                if depth > maxdepth:
+                    break
+            files = []
+            for n in sorted(names):
+                if n.endswith(ext) and not n.startswith('.'):
+                    if followLink or not os.path.islink(os.path.join(root, n)):
+                        files.append(n)
+            yield root, files
+            dirs.sort()
+            for d in dirs[:]:
+                if d.startswith('.'):
+                    dirs.remove(d)
+
+    def combinedTextFile(self, path, ext='', followLink=True, maxdepth=0, splitSize=None):
+        """ like textFile, but small files are packed into splits of about
+            splitSize bytes, files larger than splitSize are split as usual.
+        """
+        self.init()
+        if isinstance(path, (list, tuple)):
+            return self.union([self.combinedTextFile(p, ext, followLink, maxdepth, splitSize)
+                               for p in path])
+
+        path = os.path.realpath(path)
+        splitSize = splitSize or TextFileRDD.DEFAULT_SPLIT_SIZE
+        if not os.path.isdir(path):
+            return self.textFile(path, splitSize=splitSize)
+
+        small, rdds = [], []
+        for root, names in self._walk_files(path, ext, followLink, maxdepth):
+            if not names:
+                continue
+            for n, size, hosts in stat_files(root, names):
+                p = os.path.join(root, n)
+                if size > splitSize:
+                    rdds.append(self.textFile(p, splitSize=splitSize))
+                elif size > 0:
+                    small.append((p, size, hosts))
+        if small:
+            rdds.insert(0, CombinedFileRDD(self, small, splitSize))
+        return self.union(rdds)
+
     def tfRecordsFile(self, path, *args, **kwargs):
         return self.textFile(path, cls=TfrecordsRDD, *args, **kwargs)
 
@@ -262,7 +300,16 @@ class DparkContext(object):
         return self.textFile(cls=BZip2FileRDD, *args, **kwargs)
 
     def csvFile(self, path, dialect='excel', *args, **kwargs):
-        return self.textFile(path, cls=TextFileRDD, *args, **kwargs).fromCsv(dialect)
+        """ rows of csv files, quoted fields may have line breaks.
+
+            types: functions to convert the columns, an empty field is None,
+                e.g. types=[int, None, float] keeps the second one as str.
+                Rows become tuples, to be used by asTable or saveAsTabular.
+                Extra columns are kept as str, fewer columns raise ValueError.
+        """
+        types = kwargs.pop('types', None)
+        return self.textFile(path, cls=CSVFileRDD, dialect=dialect, types=types,
+                             *args, **kwargs)
 
     def binaryFile(self, path, fmt=None, length=None, *args, **kwargs):
         return self.textFile(path, cls=BinaryFileRDD, fmt=fmt, length=length, *args, **kwargs)
@@ -299,7 +346,8 @@ class DparkContext(object):
 
         Args:
             path: beansdb data path
-            filter: used to filter key
+            filter: used to filter key, or a collection of keys to look up
+                in the index files.
             depth: choice = [None, 0, 1, 2]. e.g. depth=2 assume dir tree like:
                     'path/[0-F]/[0-F]/%03d.data'
                 If depth is None, dpark will guess.
@@ -307,7 +355,7 @@ class DparkContext(object):
                 pairs.
                 Better use fullscan unless the filter selectivity is low.
                 Effect of using index:
-                    inefficient random access
+                    random access, in the order of positions
                     one split(task) for each file instead of each moosefs chunk
 
                 Omitted if filter is None.
@@ -322,9 +370,11 @@ class DparkContext(object):
         self.init()
         if key_filter is None:
             fullscan = True
+        # values are restored by readers unless reduced by key
+        read_raw = raw or only_latest
         if isinstance(path, (tuple, list)):
             rdd = self.union([self.beansdb(p, depth, key_filter, fullscan,
-                                           raw=True, only_latest=False)
+                                           raw=read_raw, only_latest=False)
                               for p in path])
         else:
             path = os.path.realpath(path)
@@ -336,22 +386,22 @@ class DparkContext(object):
                             if n.endswith('.data')]
                 if subs:
                     rdd = self.union([BeansdbFileRDD(self, p, key_filter,
-                                                     fullscan, raw=True)
+                                                     fullscan, raw=read_raw)
                                       for p in subs])
                 else:
                     subs = [os.path.join(path, '%x' % i) for i in range(16)]
                     rdd = self.union([self.beansdb(p, depth and depth - 1, key_filter,
-                                                   fullscan, raw=True, only_latest=False)
+                                                   fullscan, raw=read_raw, only_latest=False)
                                       for p in subs if os.path.exists(p)])
             else:
-                rdd = BeansdbFileRDD(self, path, key_filter, fullscan, raw)
+                rdd = BeansdbFileRDD(self, path, key_filter, fullscan, read_raw)
 
         # choose only latest version
         if only_latest:
             num_splits = min(int(ceil(len(rdd) / 4)), 800)
             rdd = rdd.reduceByKey(lambda v1, v2: v1[2] > v2[2] and v1 or v2,
                                   numSplits=num_splits)
-        if not raw:
+        if read_raw and not raw:
             rdd = rdd.mapValue(lambda v_ver_t: (restore_value(*v_ver_t[0]), v_ver_t[1], v_ver_t[2]))
         return rdd
 
@@ -21,6 +21,7 @@ class TaskStats(object):
     def _reset(self):
         self.bytes_max_rss = 0
         self.secs_all = 0
+        self.secs_cpu = 0
 
         # broadcast
         self.secs_broadcast = 0
@@ -35,6 +36,11 @@ class TaskStats(object):
         self.num_fetch_rotate = 0  # 0 if all in memory
         self.num_dump_rotate = 0  # 1 if all in memory
 
+        # cache of rdd partitions
+        self.num_cache_hit = 0
+        self.num_cache_miss = 0
+        self.num_cache_evict = 0
+
 
 class DparkEnv:
     environ = {}
@@ -73,8 +73,11 @@ def run_task(task_data):
         task, task_try_id = loads(decompress(task_data))
         ttid = TTID(task_try_id)
         Accumulator.clear()
+        t0 = os.times()
         result = task.run(ttid.ttid)
+        t1 = os.times()
         env.task_stats.bytes_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        env.task_stats.secs_cpu = (t1[0] - t0[0]) + (t1[1] - t0[1])
         accUpdate = Accumulator.values()
         MutableDict.flush()
 
@@ -116,6 +119,8 @@ def run_task(task_data):
 
 
 class LocalizedHTTP(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # keep-alive for the pool of DiskCache, files are sent with Content-Length
+    protocol_version = 'HTTP/1.1'
     basedir = None
 
     def translate_path(self, path):
@@ -145,7 +150,9 @@ def startWebServer(path):
 
     logger.warning('default webserver at %s not available', DEFAULT_WEB_PORT)
     LocalizedHTTP.basedir = os.path.dirname(path)
-    ss = socketserver.TCPServer(('0.0.0.0', 0), LocalizedHTTP)
+    # a thread for each kept alive connection
+    ss = socketserver.ThreadingTCPServer(('0.0.0.0', 0), LocalizedHTTP)
+    ss.daemon_threads = True
     spawn(ss.serve_forever)
     uri = 'http://%s:%d/%s' % (socket.gethostname(), ss.server_address[1],
                                os.path.basename(path))
@@ -513,6 +520,8 @@ class MyExecutor(Executor):
             threading.current_thread().name = task_id_str
             setproctitle(procname)
             set_oom_score(100)
+            # nothing kept in memory of this process is read by later tasks
+            env.register('PROCESS_PER_TASK', True)
             env.start()
             q.put((task_id_value, run_task(task_data)))
 
@@ -31,6 +31,18 @@ class FileManager(object):
         fs = self._get_fs(path)
         return fs.walk(path, followlinks=followlinks)
 
+    def stat_files(self, root, names):
+        fs = self._get_fs(root)
+        return fs.stat_files(root, names)
+
+    def prefetch(self, paths):
+        groups = {}
+        for d in set(os.path.dirname(p) for p in paths):
+            groups.setdefault(self._get_fs(d), []).append(d)
+        for fs, dirs in groups.items():
+            dirs = set(dirs)
+            fs.prefetch([p for p in paths if os.path.dirname(p) in dirs])
+
 
 file_manager = FileManager()
 
@@ -41,3 +53,11 @@ def open_file(path):
 
 def walk(path, followlinks=True):
     return file_manager.walk(path, followlinks=followlinks)
+
+
+def stat_files(root, names):
+    return file_manager.stat_files(root, names)
+
+
+def prefetch(paths):
+    return file_manager.prefetch(paths)
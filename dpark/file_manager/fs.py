@@ -2,14 +2,22 @@ from __future__ import absolute_import
 import os
 import stat
 import errno
+import math
+import time
 import socket
+import marshal
+import hashlib
+import tempfile
 import threading
+from collections import deque
 from .utils import FileInfo, read_chunk
 from .consts import *
-from .mfs_proxy import ProxyConn
+from .mfs_proxy import ProxyConn, Chunk
+import dpark.conf
+from dpark.utils import spawn, mkdir_p, atomic_file
 from dpark.utils.log import get_logger
 import six
-from six.moves import range
+from six.moves import range, queue
 
 try:
     from cStringIO import StringIO
@@ -18,6 +26,8 @@ except ImportError:
 
 logger = get_logger(__name__)
 
+READ_AHEAD_SEGMENT = 1 << 20
+
 
 class FileSystem(object):
 
@@ -33,6 +43,14 @@ class FileSystem(object):
     def walk(self, path, followlinks=True):
         raise NotImplementedError
 
+    def stat_files(self, root, names):
+        """ [(name, size, hosts of the first chunk)] of files in root """
+        raise NotImplementedError
+
+    def prefetch(self, paths):
+        """ get metadata of files to be opened soon in batch """
+        raise NotImplementedError
+
     def check_ok(self, path):
         raise NotImplementedError
 
@@ -51,25 +69,40 @@ class PosixFS(object):
     def walk(self, path, followlinks):
         return os.walk(path, followlinks=followlinks)
 
+    def stat_files(self, root, names):
+        return [(n, os.path.getsize(os.path.join(root, n)), []) for n in names]
+
+    def prefetch(self, paths):
+        pass
+
     def check_ok(self, path):
         return True
 
 
+def _restore(cls, fields):
+    """ object of cls with fields, kept by marshal instead of pickle """
+    obj = cls.__new__(cls)
+    obj.__dict__.update(fields)
+    return obj
+
+
 class MooseFS(PosixFS):
 
     def __init__(self):
         self._local = threading.local()
+        self._meta = {}  # path -> (expire time, FileInfo, {chunk index: Chunk})
 
     def _find_proxy(self, path):
         pid = getattr(self._local, 'pid', None)
         if pid != os.getpid():
             self._local.proxy_map = {}
             self._local.pid = os.getpid()
-            self.proxy_map = self._local.proxy_map
+        # one connection per thread, the map must not be shared
+        proxy_map = self._local.proxy_map
 
-        for mountpoint in self.proxy_map:
+        for mountpoint in proxy_map:
             if mountpoint in path:
-                return self.proxy_map[mountpoint]
+                return proxy_map[mountpoint]
 
         dir_path = path if os.path.isdir(path) else os.path.dirname(path)
         mount = ''
@@ -81,8 +114,8 @@ class MooseFS(PosixFS):
             raise OSError('Can not find mount for %s' % path)
 
         host, port, version = ProxyConn.get_masterinfo(os.path.join(mount, '.masterinfo'))
-        self.proxy_map[mount] = ProxyConn(host, port, version)
-        return self.proxy_map[mount]
+        proxy_map[mount] = ProxyConn(host, port, version)
+        return proxy_map[mount]
 
     def _get_indeed_root(self, root):
         root = os.path.realpath(root)
@@ -132,6 +165,150 @@ class MooseFS(PosixFS):
                         continue
                     ds.append(os.path.join(root, d))
 
+    def stat_files(self, root, names):
+        """ sizes and chunk servers of files with one getdirplus of root,
+            the first chunks are fetched by a pool of threads as in prefetch
+        """
+        real_root, proxy, inode = self._get_indeed_root(root)
+        if not real_root or not proxy:
+            return PosixFS.stat_files(self, root, names)
+
+        cs = proxy.getdirplus(inode)
+        result = []
+        chunks = []
+        for n in names:
+            info = cs.get(n)
+            if info is None or info.ftype != TYPE_FILE:
+                result.extend(PosixFS.stat_files(self, root, [n]))
+                continue
+            if info.length:
+                chunks.append((len(result), info.inode))
+            result.append((n, info.length, []))
+
+        reader = ReadAhead(self._first_chunk, ((root, ino) for _, ino in chunks),
+                           dpark.conf.METADATA_THREADS)
+        try:
+            for (i, _), chunk in zip(chunks, reader):
+                n, length, _ = result[i]
+                result[i] = (n, length, [host for host, _ in chunk.addrs])
+        finally:
+            reader.close()
+        return result
+
+    def _first_chunk(self, root, inode):
+        return self._find_proxy(root).readchunk(inode, 0)
+
+    def get_meta(self, path):
+        """ (FileInfo, chunks) of path prefetched in the last METADATA_CACHE_TTL secs """
+        m = self._meta.get(path)
+        if m is None:
+            return None
+        expire, info, chunks = m
+        if expire < time.time():
+            del self._meta[path]
+            return None
+        return info, chunks
+
+    def prefetch(self, paths):
+        """ fetch attributes and chunk locations of files before opening them,
+            with one getdirplus per directory and a pool of threads for chunks.
+            They are also kept on disk if MOOSEFS_DIR_CACHE is enabled.
+        """
+        now = time.time()
+        expire = now + dpark.conf.METADATA_CACHE_TTL
+        dirs = {}
+        for path in paths:
+            if self.get_meta(path) is None:
+                d, name = os.path.split(path)
+                dirs.setdefault(d, []).append(name)
+
+        saved = {}
+        files = []
+        for d in sorted(dirs):
+            names = dirs[d]
+            if dpark.conf.MOOSEFS_DIR_CACHE:
+                saved[d] = entries = self._load_dir_cache(d, now)
+                for n in names:
+                    if n in entries:
+                        info, chunks = entries[n]
+                        self._meta[os.path.join(d, n)] = (expire, info, chunks)
+                names = [n for n in names if n not in entries]
+                if not names:
+                    continue
+
+            real_root, proxy, inode = self._get_indeed_root(d)
+            if not real_root or not proxy:
+                continue
+            cs = proxy.getdirplus(inode)
+            for n in names:
+                info = cs.get(n)
+                if info is not None and info.ftype == TYPE_FILE:
+                    files.append((d, n, info))
+
+        fetched = set()
+        reader = ReadAhead(self._fetch_chunks, files, dpark.conf.METADATA_THREADS)
+        try:
+            for (d, n, info), chunks in zip(files, reader):
+                self._meta[os.path.join(d, n)] = (expire, info, chunks)
+                if d in saved:
+                    saved[d][n] = (info, chunks)
+                    fetched.add(d)
+        finally:
+            reader.close()
+
+        for d in fetched:
+            self._save_dir_cache(d, saved[d], now)
+
+    def _fetch_chunks(self, d, name, info):
+        proxy = self._find_proxy(d)
+        n = (info.length + CHUNKSIZE - 1) // CHUNKSIZE
+        return dict((i, proxy.readchunk(info.inode, i)) for i in range(n))
+
+    @staticmethod
+    def _dir_cache_path(d):
+        """ path of the cache of d in a dir private to the user, None if unsafe """
+        root = dpark.conf.METADATA_CACHE_DIR or os.path.join(
+            tempfile.gettempdir(), 'dpark_meta_cache_%d' % os.getuid())
+        try:
+            mkdir_p(os.path.dirname(root))
+            os.mkdir(root, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                logger.warning('fail to create metadata cache dir %s: %s', root, e)
+                return None
+        st = os.lstat(root)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            logger.warning('metadata cache dir %s is not private to the user, not used', root)
+            return None
+        return os.path.join(root, hashlib.md5(d.encode('utf-8')).hexdigest())
+
+    def _load_dir_cache(self, d, now):
+        path = self._dir_cache_path(d)
+        if path is None:
+            return {}
+        try:
+            with open(path, 'rb') as f:
+                saved, entries = marshal.loads(f.read())
+            if saved + dpark.conf.METADATA_CACHE_TTL < now:
+                return {}
+            return dict((n, (_restore(FileInfo, info),
+                             dict((i, _restore(Chunk, c)) for i, c in six.iteritems(chunks))))
+                        for n, (info, chunks) in six.iteritems(entries))
+        except Exception:
+            return {}
+
+    def _save_dir_cache(self, d, entries, now):
+        path = self._dir_cache_path(d)
+        if path is None:
+            return
+        entries = dict((n, (vars(info), dict((i, vars(c)) for i, c in six.iteritems(chunks))))
+                       for n, (info, chunks) in six.iteritems(entries))
+        try:
+            with atomic_file(path) as f:
+                f.write(marshal.dumps((now, entries)))
+        except (IOError, OSError) as e:
+            logger.warning('fail to save metadata of %s: %s', d, e)
+
     def check_ok(self, path):
         if os.path.isdir(path):
             return os.path.exists(os.path.join(path, '.masterinfo'))
@@ -197,6 +374,108 @@ class ReadableFile(object):
         self.close()
 
 
+class _Segment(object):
+    def __init__(self, args):
+        self.args = args
+        self.data = None
+        self.error = None
+        self.secs = 0
+        self.ready = threading.Event()
+
+
+class ReadAhead(object):
+    """ iterate over fetch(*args) of segments, fetched by a pool of threads.
+
+        The number of segments fetched ahead of the reader (window) follows the
+        observed throughput: secs to fetch a segment / secs the reader takes to
+        consume one, at most max_window. max_window = 0 means fetch inline.
+    """
+    EWMA_RATIO = 0.3
+
+    def __init__(self, fetch, segments, max_window):
+        self.fetch = fetch
+        self.segments = iter(segments)
+        self.max_window = max_window
+        self.window = 1
+        self.pending = deque()
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.closed = False
+        self.fetch_secs = None
+        self.consume_secs = None
+        self.last_return = None
+
+    def _ewma(self, old, new):
+        if old is None:
+            return new
+        return old + (new - old) * self.EWMA_RATIO
+
+    def _worker(self):
+        while True:
+            seg = self.tasks.get()
+            if seg is None:
+                return
+            if not self.closed:
+                start = time.time()
+                try:
+                    seg.data = self.fetch(*seg.args)
+                except Exception as e:
+                    seg.error = e
+                seg.secs = time.time() - start
+            seg.ready.set()
+
+    def _schedule(self):
+        while len(self.pending) <= self.window:
+            try:
+                args = next(self.segments)
+            except StopIteration:
+                break
+            seg = _Segment(args)
+            self.pending.append(seg)
+            if len(self.threads) < len(self.pending):
+                self.threads.append(spawn(self._worker))
+            self.tasks.put(seg)
+
+    def _adapt(self, seg):
+        now = time.time()
+        if self.last_return is not None:
+            self.consume_secs = self._ewma(self.consume_secs, now - self.last_return)
+        self.fetch_secs = self._ewma(self.fetch_secs, seg.secs)
+        if self.consume_secs is not None:
+            need = int(math.ceil(self.fetch_secs / max(self.consume_secs, 1e-4)))
+            self.window = max(min(need, self.max_window), 1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.max_window <= 0:
+            return self.fetch(*next(self.segments))
+
+        self._schedule()
+        if not self.pending:
+            raise StopIteration
+
+        seg = self.pending.popleft()
+        seg.ready.wait()
+        if seg.error is not None:
+            raise seg.error
+
+        self._adapt(seg)
+        self._schedule()
+        self.last_return = time.time()
+        return seg.data
+
+    next = __next__
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        for _ in self.threads:
+            self.tasks.put(None)
+        self.threads = []
+
+
 class PosixFile(ReadableFile):
     def __init__(self, path):
         ReadableFile.__init__(self, path)
@@ -240,16 +519,23 @@ class MooseFile(ReadableFile):
         self._load(path)
 
     def _load(self, path):
-        proxy = self.fs._find_proxy(path)
-        st = os.lstat(path)
-        self.inode = st.st_ino
-        self.info = proxy.getattr(self.inode)
+        meta = self.fs.get_meta(path)
+        if meta is not None:
+            self.info, self.cached_chunks = meta
+            self.inode = self.info.inode
+        else:
+            proxy = self.fs._find_proxy(path)
+            st = os.lstat(path)
+            self.inode = st.st_ino
+            self.info = proxy.getattr(self.inode)
+            self.cached_chunks = {}
         self.length = self.info.length
         self.cscache = {}
         self.roff = 0
         self.rbuf = b''
         self.reader = None
         self.generator = None
+        self.local_ip = None
 
     def get_chunk(self, i):
         chunk = self.cscache.get(i)
@@ -271,9 +557,10 @@ class MooseFile(ReadableFile):
     def locs(self, i=None):
         if i is None:
             n = (self.length - 1) // CHUNKSIZE + 1
-            return [[host for host, _ in self.get_chunk(i).addrs]
-                    for i in range(n)]
-        return [host for host, _ in self.get_chunk(i).addrs]
+            return [self.locs(i) for i in range(n)]
+        # prefetched chunks are only for locations, never read by them
+        chunk = self.cached_chunks.get(i) or self.get_chunk(i)
+        return [host for host, _ in chunk.addrs]
 
     def seek(self, offset, whence=0):
         if whence == 1:
@@ -286,7 +573,7 @@ class MooseFile(ReadableFile):
             self.rbuf = self.rbuf[off:]
         else:
             self.rbuf = b''
-            self.reader = None
+            self.close_reader()
 
         self.roff = offset
         self.generator = None
@@ -326,45 +613,67 @@ class MooseFile(ReadableFile):
     def fill_buffer(self):
         if self.reader is None:
             if self.roff < self.length:
-                self.reader = self.chunk_reader(self.roff)
+                self.reader = ReadAhead(self.read_segment, self.segments(self.roff),
+                                        dpark.conf.MOOSEFS_READ_AHEAD)
             else:
                 return
         try:
             self.rbuf = next(self.reader)
         except StopIteration:
-            self.reader = None
+            self.close_reader()
             self.fill_buffer()
 
-    def chunk_reader(self, roff):
-        index = roff // CHUNKSIZE
-        offset = roff % CHUNKSIZE
-        chunk = self.get_chunk(index)
-        length = min(self.length - index * CHUNKSIZE, CHUNKSIZE)
-        if offset > length:
-            return
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
 
-        local_ip = socket.gethostbyname(socket.gethostname())
-        for i in range(len(chunk.addrs)):
-            ip, port = chunk.addrs[i]
-            if ip == local_ip:
-                if i != 0:
-                    chunk.addrs[0], chunk.addrs[i] = chunk.addrs[i], chunk.addrs[0]
-                break
+    def segments(self, roff):
+        """ (chunk, offset, size, seq) from roff to the end of file, growing from
+            one block to READ_AHEAD_SEGMENT, so random reads do not fetch too much
+        """
+        size = 64 << 10
+        seq = 0
+        while roff < self.length:
+            index = roff // CHUNKSIZE
+            offset = roff % CHUNKSIZE
+            length = min(self.length - index * CHUNKSIZE, CHUNKSIZE)
+            n = min(size, length - offset)
+            yield self.get_chunk(index), offset, n, seq
+            roff += n
+            seq += 1
+            size = min(size * 2, READ_AHEAD_SEGMENT)
+
+    def read_segment(self, chunk, offset, size, seq):
+        if self.local_ip is None:
+            self.local_ip = socket.gethostbyname(socket.gethostname())
+
+        # prefer local replica, or spread segments over replicas
+        addrs = list(chunk.addrs)
+        local = [a for a in addrs if a[0] == self.local_ip]
+        if local:
+            addrs.remove(local[0])
+            addrs.insert(0, local[0])
+        elif addrs:
+            k = seq % len(addrs)
+            addrs = addrs[k:] + addrs[:k]
 
+        buf = []
+        got = 0
         last_exception = None
         last_host = None
-        for host, port in chunk.addrs:
+        for host, port in addrs:
             nerror = 0
             while nerror < 2:
                 try:
                     for block in read_chunk(host, port, chunk.id,
                                             chunk.version,
-                                            length - offset,
-                                            offset):
-                        yield block
-                        offset += len(block)
-                        if offset >= length:
-                            return
+                                            size - got,
+                                            offset + got):
+                        buf.append(block)
+                        got += len(block)
+                        if got >= size:
+                            return b''.join(buf)
                         nerror = 0
                     break
                 except IOError as e:
@@ -376,17 +685,17 @@ class MooseFile(ReadableFile):
                     nerror += 1
 
         raise Exception("unexpected path=%s, addrs=%s, "
-                        "start_offset=%d, chunk=%d, "
-                        "curr_offset_in_chunk=%d < length = %d, "
+                        "chunk=%d, start_offset_in_chunk=%d, "
+                        "curr_offset_in_chunk=%d < %d, "
                         "last exception on host %s: %s" %
                         (self.path,
                          chunk.addrs,
-                         roff, index,
-                         offset, length,
+                         chunk.id, offset,
+                         offset + got, offset + size,
                          last_host, last_exception))
 
     def close(self):
         self.roff = 0
         self.rbuf = b''
-        self.reader = None
+        self.close_reader()
         self.generator = None
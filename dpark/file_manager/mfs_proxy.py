@@ -18,7 +18,7 @@ class ProtocolError(Exception):
     pass
 
 
-class Chunk:
+class Chunk(object):
 
     def __init__(self, index, id_, file_length, version, csdata, ele_width=6):
         self.index = index
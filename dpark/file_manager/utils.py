@@ -42,7 +42,7 @@ def unpack(fmt, buf):
     return struct.unpack(fmt, buf[:struct.calcsize(fmt)])
 
 
-class FileInfo:
+class FileInfo(object):
     def __init__(self, inode, name, ftype, mode, uid, gid,
                  atime, mtime, ctime, nlink, length):
         self.inode = inode
@@ -0,0 +1,275 @@
+from __future__ import absolute_import
+import os
+import sys
+import json
+import glob
+import math
+import time
+import hashlib
+from datetime import datetime, timedelta
+
+import dpark.conf as conf
+from dpark.utils import atomic_file
+from dpark.utils.log import get_logger
+from dpark.taskset import MAX_TASK_MEMORY
+
+logger = get_logger(__name__)
+
+DEFAULT_TASK_SECS = 1.0
+
+
+class StageHistory(object):
+    """ Historical cost of stages, keyed by the api callsite of the stage output rdd.
+
+        Filled from profiles of former runs of the same script found in loghub
+        (written by DAGScheduler._dump_stats) and from jobs finished in this run.
+        The cost of a stage is the sum of `secs_all` of its tasks.
+    """
+
+    def __init__(self):
+        self.costs = {}  # api_callsite -> [(secs, num_partition), ...]
+        self.loaded = False
+
+    def _add_stage(self, prof):
+        info = prof.get('info', {})
+        callsite = info.get('api_callsite')
+        secs = prof.get('stats', {}).get('secs_all')
+        if not callsite or not secs:
+            return
+
+        costs = self.costs.setdefault(callsite, [])
+        costs.append((secs['sum'], info.get('num_partition') or 1))
+        del costs[:-conf.MAX_HISTORY_PROFILES]
+
+    def add_job(self, stats):
+        for prof in stats['run']['stages']:
+            self._add_stage(prof)
+
+    def _find_profiles(self):
+        cmd = ' '.join(sys.argv)
+        now = datetime.now()
+        dirs = set()
+        for i in range(conf.LOGHUB_HISTORY_HOURS):
+            date_str = (now - timedelta(hours=i)).strftime(conf.LOGHUB_PATH_FORMAT)
+            dirs.add(os.path.join(conf.LOGHUB, date_str))
+
+        paths = []
+        for d in dirs:
+            for log_path in glob.glob(os.path.join(d, '*', 'log')):
+                try:
+                    with open(log_path) as f:
+                        line = f.readline()
+                except IOError:
+                    continue
+
+                if line.strip() != 'DPARK_CMD = %s' % cmd:
+                    continue
+
+                dir_path = os.path.dirname(log_path)
+                paths.extend(glob.glob(os.path.join(dir_path, 'sched_*_job_*.json')))
+
+        paths.sort(key=os.path.getmtime)
+        return paths[-conf.MAX_HISTORY_PROFILES:]
+
+    def load(self):
+        if self.loaded:
+            return
+
+        self.loaded = True
+        if not conf.LOGHUB:
+            return
+
+        try:
+            paths = self._find_profiles()
+        except Exception as e:
+            logger.warning('fail to find history profiles in loghub: %s', e)
+            return
+
+        for path in paths:
+            try:
+                with open(path) as f:
+                    self.add_job(json.load(f))
+            except Exception as e:
+                logger.debug('skip bad profile %s: %s', path, e)
+
+        logger.debug('load %d history profiles, %d callsites', len(paths), len(self.costs))
+
+    def _default_task_secs(self):
+        costs = [c for v in self.costs.values() for c in v]
+        n = sum(c[1] for c in costs)
+        if not n:
+            return DEFAULT_TASK_SECS
+        return float(sum(c[0] for c in costs)) / n
+
+    def estimate(self, stage):
+        """ remaining work of a stage in secs """
+        n = stage.numPartitions
+        if not n:
+            return 0
+
+        remain = n - stage.num_task_finished
+        costs = self.costs.get(stage.rdd.scope.api_callsite)
+        if costs:
+            return float(sum(c[0] for c in costs)) / len(costs) * remain / n
+
+        return self._default_task_secs() * remain
+
+    def rank_stages(self, final_stage):
+        """ set `priority` of each stage to the length of
+            the longest remaining path from it to the final stage """
+        self.load()
+        stages = final_stage.get_tree_stages()
+        children = dict((s.id, []) for s in stages)
+        for s in stages:
+            for p in s.parents:
+                children[p.id].append(s)
+
+        num_pending_children = dict((s.id, len(children[s.id])) for s in stages)
+        to_visit = [final_stage]
+        while to_visit:
+            s = to_visit.pop()
+            s.priority = self.estimate(s) + max([c.priority for c in children[s.id]] or [0])
+            for p in s.parents:
+                num_pending_children[p.id] -= 1
+                if num_pending_children[p.id] == 0:
+                    to_visit.append(p)
+
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+class ProfileStore(object):
+    """ Persistent resource profiles of the stages of a script.
+
+        Profiles are saved in PROFILE_STORE_DIR, one file per script, keyed by
+        the api callsite of the stage output rdd and the magnitude of its input
+        size. They are used to pre-size mem and cpus of tasks and the number of
+        reduce splits in later runs.
+    """
+
+    def __init__(self):
+        self.profiles = None  # api_callsite -> {size_bucket: profile}
+        self.dirty = False
+
+    @property
+    def enabled(self):
+        return bool(conf.PROFILE_STORE_DIR)
+
+    def _get_path(self):
+        script = os.path.abspath(sys.argv[0])
+        name = hashlib.md5(script.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(conf.PROFILE_STORE_DIR, name)
+
+    def load(self):
+        if self.profiles is not None:
+            return
+
+        self.profiles = {}
+        if not self.enabled:
+            return
+
+        path = self._get_path()
+        if not os.path.exists(path):
+            return
+
+        try:
+            with open(path) as f:
+                self.profiles = json.load(f)
+        except Exception as e:
+            logger.warning('fail to load profiles from %s: %s', path, e)
+
+    def save(self):
+        if not self.enabled or not self.dirty:
+            return
+
+        path = self._get_path()
+        try:
+            with atomic_file(path, mode='w') as f:
+                json.dump(self.profiles, f)
+            self.dirty = False
+        except Exception as e:
+            logger.warning('fail to save profiles to %s: %s', path, e)
+
+    @staticmethod
+    def _bucket(size):
+        return str(int(size).bit_length())
+
+    def lookup(self, api_callsite, input_size=None):
+        """ profile of the same callsite with the nearest input size """
+        self.load()
+        profs = self.profiles.get(api_callsite)
+        if not profs:
+            return None
+
+        if input_size is None:
+            return max(profs.values(), key=lambda p: p['time'])
+
+        b = int(self._bucket(input_size))
+        return profs[min(profs, key=lambda k: (abs(int(k) - b), -profs[k]['time']))]
+
+    def record(self, stage, input_size):
+        if not self.enabled:
+            return
+
+        stats = [x[-1] for x in stage.task_stats if x and x[-1]]
+        if not stats:
+            return
+
+        secs = sorted(s.secs_all for s in stats)
+        prof = {
+            'time': time.time(),
+            'input_size': input_size,
+            'num_partition': stage.numPartitions,
+            'secs': [float(sum(secs)) / len(secs), secs[-1]],
+            'bytes_out': sum(s.bytes_dump for s in stats),
+        }
+
+        mems = sorted(s.bytes_max_rss / (1024. ** 2) for s in stats if s.bytes_max_rss)
+        if mems:
+            prof['mem'] = [_percentile(mems, 0.5), _percentile(mems, 0.9), mems[-1]]
+
+        cpus = sorted(s.secs_cpu / s.secs_all
+                      for s in stats if getattr(s, 'secs_cpu', 0) and s.secs_all)
+        if cpus:
+            prof['cpus'] = _percentile(cpus, 0.9)
+
+        self.load()
+        profs = self.profiles.setdefault(stage.rdd.scope.api_callsite, {})
+        profs[self._bucket(input_size)] = prof
+        self.dirty = True
+
+    def suggest_resources(self, stage, input_size, cpus, mem):
+        if not self.enabled:
+            return cpus, mem
+
+        prof = self.lookup(stage.rdd.scope.api_callsite, input_size)
+        if not prof:
+            return cpus, mem
+
+        if 'mem' in prof:
+            _, mem90, mem_max = prof['mem']
+            need = int(math.ceil(max(mem90 * conf.PROFILE_MEM_RATIO, mem_max)))
+            # only raised, mem set by user or rdd is the least
+            mem = max(mem, min(need, MAX_TASK_MEMORY))
+
+        if 'cpus' in prof and not stage.rdd.cpus:
+            # only raised too, cpus set by user (-c) is the least
+            cpus = max(cpus, math.ceil(prof['cpus'] * 2) / 2.)
+
+        return cpus, mem
+
+    def suggest_splits(self, rdd, num_splits):
+        """ number of reduce splits for the output of rdd, never more than num_splits """
+        if not self.enabled:
+            return num_splits
+
+        prof = self.lookup(rdd.scope.api_callsite)
+        if not prof or not prof['bytes_out']:
+            return num_splits
+
+        n = int(math.ceil(float(prof['bytes_out']) / conf.PROFILE_SPLIT_SIZE))
+        return max(min(n, num_splits), 1)
+
+
+profile_store = ProfileStore()
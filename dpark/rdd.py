@@ -1,15 +1,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys
+import re
 import os, os.path
 import time
 import socket
 import csv
+import io
 import itertools
 import collections
 import math
 import six
-from six.moves import filter, map, range, zip, cPickle
+from six.moves import filter, map, range, zip, cPickle, queue
 import random
 import bz2
 import gzip
@@ -18,7 +20,10 @@ from copy import copy
 import shutil
 import heapq
 import struct
+import bisect
+import marshal
 import tempfile
+import hashlib
 
 try:
     from cStringIO import StringIO
@@ -37,15 +42,26 @@ from dpark.dependency import *
 from dpark.utils import (
     spawn, chain, mkdir_p, recursion_limit_breaker, atomic_file,
     AbortFileReplacement, portable_hash,
-    masked_crc32c
+    masked_crc32c, find_tfrecord, parse_tfrecords, get_hostname
 )
 from dpark.utils import DparkUserFatalError
 from dpark.utils.log import get_logger
 from dpark.utils.frame import Scope, func_info
-from dpark.shuffle import SortShuffleFetcher, Merger
+from dpark.shuffle import (
+    SortShuffleFetcher, Merger, AutoBatchedSerializer, LocalFileShuffle, write_buf
+)
 from dpark.env import env
+from dpark.serialize import update_digest
+from dpark.history import profile_store
+from dpark.cache import MEMORY, STORAGE_LEVELS
 from dpark.file_manager import open_file, CHUNKSIZE
+from dpark.file_manager.fs import ReadAhead
 from dpark.utils.beansdb import BeansdbReader, BeansdbWriter
+from dpark.utils.gzip_index import (
+    get_index as get_gzip_index, iter_decompress as iter_gzip,
+    write_members as write_gzip_members, save_index as save_gzip_index,
+    sidecar_path as gzip_index_path
+)
 from contextlib import closing
 from functools import reduce
 
@@ -71,6 +87,22 @@ def cached(func):
     return getstate
 
 
+def _file_versions(path):
+    """ [(path, size, mtime)] of the file, or files in the dir, at path """
+    if os.path.isdir(path):
+        result = []
+        for name in sorted(os.listdir(path)):
+            p = os.path.join(path, name)
+            if os.path.isfile(p):
+                st = os.stat(p)
+                result.append((p, st.st_size, st.st_mtime))
+        return result
+    if not os.path.exists(path):
+        return []
+    with closing(open_file(path)) as f:
+        return [(path, f.length, f.info.mtime)]
+
+
 class RDD(object):
     def __init__(self, ctx):
         self.ctx = ctx
@@ -80,6 +112,7 @@ class RDD(object):
         self.aggregator = None
         self._partitioner = None
         self.shouldCache = False
+        self.storage_level = MEMORY
         self.checkpoint_path = None
         self._checkpoint_rdd = None
         ctx.init()
@@ -175,8 +208,18 @@ class RDD(object):
     def ui_label(self):
         return "{}[{}]".format(self.__class__.__name__, len(self))
 
-    def cache(self):
+    def cache(self, storage_level=MEMORY):
+        """ storage_level: how partitions are kept in memory of executors,
+            MEMORY, MEMORY_SER or MEMORY_SER_COMPRESSED (in dpark.cache),
+            serialized ones use less memory and more cpu. Memory is used
+            only by local and process schedulers, tasks of Mesos executors
+            read partitions from the disk cache.
+        """
+        if storage_level not in STORAGE_LEVELS:
+            raise ValueError('invalid storage level: %s' % (storage_level,))
+
         self.shouldCache = True
+        self.storage_level = storage_level
         self._pickle_cache = None  # clear pickle cache
         return self
 
@@ -203,6 +246,101 @@ class RDD(object):
                            'please re-run with --checkpoint-dir to enable checkpoint')
         return self
 
+    # run specific or not affecting the result
+    _FINGERPRINT_SKIP_FIELDS = frozenset([
+        'ctx', 'id', 'scope', 'repr_name', 'lineage', 'mem', 'cpus', 'gpus',
+        'shouldCache', 'storage_level', 'checkpoint_path', '_checkpoint_rdd',
+        '_preferred_locs', '_dep_lineage_counts', '_pickle_cache', '_split_size',
+        '_dependencies', '_splits', 'exc_info', 'rddconf', 'shuffleId',
+    ])
+
+    def fingerprint(self, _memo=None):
+        """ digest of the lineage of this rdd, stable across runs:
+            code and closures of functions, structure of dependencies,
+            and size and mtime of input files
+        """
+        if _memo is None:
+            _memo = {}
+        if self.id in _memo:
+            return _memo[self.id]
+
+        def hook(h, obj):
+            if isinstance(obj, RDD):
+                h.update(obj.fingerprint(_memo).encode('utf-8'))
+                return True
+            if obj is self.ctx:
+                h.update(b'ctx')
+                return True
+            return False
+
+        def fields(obj):
+            return dict((k, v) for k, v in six.iteritems(obj.__dict__)
+                        if k not in self._FINGERPRINT_SKIP_FIELDS)
+
+        h = hashlib.md5()
+        h.update(self.__class__.__name__.encode('utf-8'))
+        update_digest(h, fields(self), hook)
+        update_digest(h, len(self), hook)
+        for dep in self.dependencies:
+            h.update(dep.__class__.__name__.encode('utf-8'))
+            update_digest(h, fields(dep), hook)
+
+        if not self.dependencies:
+            # the data of ParallelCollection, or offsets of input files
+            update_digest(h, [fields(sp) for sp in self.splits], hook)
+            for path in self._input_files():
+                update_digest(h, _file_versions(path), hook)
+
+        _memo[self.id] = r = h.hexdigest()
+        return r
+
+    def _input_files(self):
+        """ paths of input files (or dirs) of a leaf rdd, by its path
+            and the files of its splits
+        """
+        paths = []
+        path = getattr(self, 'path', None)
+        for p in (path if isinstance(path, (list, tuple)) else [path]):
+            if isinstance(p, six.string_types):
+                paths.append(p)
+        for sp in self.splits:
+            for f in getattr(sp, 'files', None) or ():
+                if isinstance(f, tuple):
+                    f = f[0]
+                if isinstance(f, six.string_types) and f not in paths:
+                    paths.append(f)
+        return paths
+
+    def persist(self, path=None):
+        """ keep the result in a cache dir shared by all runs, keyed by
+            the fingerprint of the lineage, and reuse it if it exists.
+        """
+        if path is None:
+            path = dpark.conf.PERSIST_CACHE_DIR
+        if not path:
+            logger.warning('No result will be persisted without PERSIST_CACHE_DIR')
+            return self
+
+        try:
+            fp = self.fingerprint()
+        except ValueError as e:
+            logger.warning('%s will not be persisted, its lineage has objects '
+                           'not stable across runs: %s', self, e)
+            return self
+
+        cache_path = os.path.join(path, fp)
+        mkdir_p(cache_path)
+        os.utime(cache_path, None)
+        _evict_persist_cache(path, dpark.conf.PERSIST_CACHE_SIZE, keep=fp)
+
+        self.checkpoint_path = cache_path
+        if len(CheckpointRDD.generated_files(cache_path)) == len(self):
+            logger.info('reuse persisted result of %s in %s', self, cache_path)
+            self._pickle_cache = None
+            self._checkpoint_rdd = CheckpointRDD(self.ctx, cache_path)
+            self._clear_dependencies()
+        return self
+
     def _clear_dependencies(self):
         self._dependencies = []
         self._splits = []
@@ -232,16 +370,30 @@ class RDD(object):
 
         if self.checkpoint_path:
             if self._checkpoint_rdd is None:
-                p = os.path.join(self.checkpoint_path, str(split.index))
-                v = list(self.compute(split))
-                with atomic_file(p) as f:
-                    f.write(cPickle.dumps(v, -1))
-
-                return v
+                return self._checkpoint_iter(split)
             else:
                 return _compute(self._checkpoint_rdd, split)
         return _compute(self, split)
 
+    def _checkpoint_iter(self, split):
+        p = os.path.join(self.checkpoint_path, str(split.index))
+        writer = CheckpointWriter(p)
+        try:
+            it = iter(self.compute(split))
+            while True:
+                batch = list(itertools.islice(it, CheckpointWriter.BATCH_SIZE))
+                if not batch:
+                    break
+                # serialized before yielded, the items may be changed after
+                writer.write(batch)
+                for v in batch:
+                    yield v
+
+            writer.close()
+        finally:
+            # not exhausted or failed, drop the partial file
+            writer.abort()
+
     def set_rddconf(self, rddconf):
         if rddconf is None:
             rddconf = dpark.conf.rddconf()
@@ -305,8 +457,8 @@ class RDD(object):
             command = command.split(' ')
         return PipedRDD(self, command, quiet)
 
-    def fromCsv(self, dialect='excel'):
-        return CSVReaderRDD(self, dialect)
+    def fromCsv(self, dialect='excel', types=None):
+        return CSVReaderRDD(self, dialect, types)
 
     def mapPartitions(self, f):
         return MapPartitionsRDD(self, f)
@@ -465,8 +617,13 @@ class RDD(object):
     def saveAsTFRecordsFile(self, path, ext='', overwrite=True, compress=False):
         return OutputTfrecordstFileRDD(self, path, ext, overwrite, compress=compress).collect()
 
-    def saveAsTextFileByKey(self, path, ext='', overwrite=True, compress=False):
-        return MultiOutputTextFileRDD(self, path, ext, overwrite, compress=compress).collect()
+    def saveAsTextFileByKey(self, path, ext='', overwrite=True, compress=False, sort=False):
+        """ save lines into path/key/, with sort=True lines are spilled in
+            runs sorted by key and the files are written one at a time,
+            good for many keys
+        """
+        return MultiOutputTextFileRDD(self, path, ext, overwrite, compress=compress,
+                                      sort=sort).collect()
 
     def saveAsCSVFile(self, path, dialect='excel', overwrite=True, compress=False):
         return OutputCSVFileRDD(self, path, dialect, overwrite, compress).collect()
@@ -510,7 +667,7 @@ class RDD(object):
 
     def combineByKey(self, aggregator, splits=None, taskMemory=None, fixSkew=-1, rddconf=None):
         if splits is None:
-            splits = min(self.ctx.defaultMinSplits, len(self))
+            splits = profile_store.suggest_splits(self, min(self.ctx.defaultMinSplits, len(self)))
         if type(splits) is int:
             _thresh = None
             if fixSkew > 0 and splits > 1:
@@ -1427,6 +1584,10 @@ class UnionRDD(RDD):
     def compute(self, split):
         return split.rdd.iterator(split.split)
 
+    def mapBlocks(self, f):
+        """ mapBlocks of all the BinaryFileRDDs in the union """
+        return self.ctx.union([dep.rdd.mapBlocks(f) for dep in self._dependencies])
+
     @property
     def ui_label(self):
         return "{}[{}]({})".format(self.__class__.__name__, len(self), len(self._dependencies))
@@ -1530,14 +1691,43 @@ class ZippedRDD(RDD):
         return sum([rdd.num_stream() for rdd in self.rdds])
 
 
+def convert_csv_rows(rows, types):
+    """ tuples of the columns converted by types, None keeps the string.
+        An empty field to convert is None, extra columns are kept as strings,
+        and rows with fewer columns than types raise ValueError.
+    """
+    n = len(types)
+    names = ['_t%d' % i for i in range(n)]
+    cols = ['_r[%d]' % i if t is None else '%s(_r[%d])' % (name, i)
+            for i, (name, t) in enumerate(zip(names, types))]
+    convert = eval('lambda _r:(%s,)+tuple(_r[%d:])' % (','.join(cols), n),
+                   dict(zip(names, types)))
+    for row in rows:
+        try:
+            yield convert(row)
+        except (ValueError, IndexError):
+            if len(row) < n:
+                raise ValueError('csv row of %d columns for %d types: %r' % (len(row), n, row))
+            # empty fields
+            yield tuple(v if t is None else None if v == '' else t(v)
+                        for t, v in zip(types, row)) + tuple(row[n:])
+
+
 class CSVReaderRDD(DerivedRDD):
-    def __init__(self, prev, dialect='excel'):
+    def __init__(self, prev, dialect='excel', types=None):
         DerivedRDD.__init__(self, prev)
         self.dialect = dialect
+        self.types = types
         self.repr_name = '<CSVReaderRDD %s of %s>' % (dialect, prev)
 
     def compute(self, split):
-        return csv.reader(self.prev.iterator(split), self.dialect)
+        # keep line breaks in quoted fields, which are dropped by TextFileRDD
+        lines = (line if line.endswith('\n') else line + '\n'
+                 for line in self.prev.iterator(split))
+        rows = csv.reader(lines, self.dialect)
+        if self.types:
+            return convert_csv_rows(rows, self.types)
+        return rows
 
 
 class ParallelCollectionSplit:
@@ -1599,6 +1789,63 @@ class ParallelCollection(RDD):
         return [data[i * n: i * n + n] for i in range(numSlices)]
 
 
+class CheckpointWriter(object):
+    """ write a partition in the format of AutoBatchedSerializer: batches are
+        serialized by the caller, then compressed and written by a background
+        thread, with at most QUEUE_SIZE batches pending
+    """
+    BATCH_SIZE = 1024
+    QUEUE_SIZE = 4
+    ABORT = object()
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.error = None
+        self.closed = False
+        self.thread = spawn(self._run)
+
+    def _run(self):
+        try:
+            with atomic_file(self.path) as f:
+                while True:
+                    item = self.queue.get()
+                    if item is None:
+                        break
+                    if item is self.ABORT:
+                        raise AbortFileReplacement()
+                    write_buf(f, *item)
+        except Exception as e:
+            self.error = e
+            # keep consuming, do not block the task
+            while self.queue.get() not in (None, self.ABORT):
+                pass
+
+    def write(self, batch):
+        if self.error is not None:
+            raise self.error
+        if batch:
+            try:
+                item = marshal.dumps(batch), True
+            except ValueError:
+                item = cPickle.dumps(batch, -1), False
+            self.queue.put(item)
+
+    def _finish(self, mark):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(mark)
+            self.thread.join()
+
+    def close(self):
+        self._finish(None)
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self._finish(self.ABORT)
+
+
 class CheckpointRDD(RDD):
     def __init__(self, ctx, path):
         RDD.__init__(self, ctx)
@@ -1614,14 +1861,51 @@ class CheckpointRDD(RDD):
     def generated_files(cls, path):
         return sorted(filter(str.isdigit, os.listdir(path)), key=int)
 
-    def compute(self, split):
+    def _open(self, split):
+        path = os.path.join(self.path, self.files[split.index])
         try:
-            with open(os.path.join(self.path, self.files[split.index]), 'rb') as f:
-                return cPickle.loads(f.read())
+            return open(path, 'rb')
         except IOError:
             time.sleep(1)
-            with open(os.path.join(self.path, self.files[split.index]), 'rb') as f:
-                return cPickle.loads(f.read())
+            return open(path, 'rb')
+
+    def compute(self, split):
+        with self._open(split) as f:
+            flag = f.read(1)
+            f.seek(0)
+            if flag and flag not in (b'M', b'P'):
+                # whole pickled list, written by older versions
+                for v in cPickle.loads(f.read()):
+                    yield v
+                return
+
+            for v in AutoBatchedSerializer().load_stream(f):
+                yield v
+
+
+def _evict_persist_cache(path, capacity, keep=None):
+    """ remove least recently used results in path until they fit in capacity """
+    entries = []
+    total = 0
+    for name in os.listdir(path):
+        p = os.path.join(path, name)
+        try:
+            mtime = os.path.getmtime(p)
+            size = sum(os.path.getsize(os.path.join(p, f)) for f in os.listdir(p))
+        except OSError:
+            continue
+        entries.append((mtime, name, size))
+        total += size
+
+    entries.sort()
+    for mtime, name, size in entries:
+        if total <= capacity:
+            break
+        if name == keep:
+            continue
+        logger.debug('evict persisted result %s, %d bytes', name, size)
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        total -= size
 
 
 class PartialSplit(Split):
@@ -1633,6 +1917,8 @@ class PartialSplit(Split):
 
 class TextFileRDD(RDD):
     DEFAULT_SPLIT_SIZE = 64 * 1024 * 1024
+    READ_BLOCK_SIZE = 4 << 20
+    LINE_READ_SIZE = 64 << 10  # to read the rest of the last line after the split
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         RDD.__init__(self, ctx)
@@ -1645,12 +1931,8 @@ class TextFileRDD(RDD):
                     splitSize = self.DEFAULT_SPLIT_SIZE
                 else:
                     splitSize = size // numSplits or self.DEFAULT_SPLIT_SIZE
-            numSplits = size // splitSize
-            if size % splitSize > 0:
-                numSplits += 1
             self.splitSize = splitSize
-            self._splits = [PartialSplit(i, i * splitSize, min(size, (i + 1) * splitSize))
-                            for i in range(numSplits)]
+            self._splits = self._make_splits(file_, size, splitSize)
 
             self._preferred_locs = {}
             for split in self._splits:
@@ -1660,15 +1942,8 @@ class TextFileRDD(RDD):
                     self._preferred_locs[split] = sum((file_.locs(i) for i in range(start, end)), [])
                 else:
                     self._preferred_locs[split] = file_.locs(split.begin // self.splitSize)
-                hostnames = []
-                for loc in self._preferred_locs[split]:
-                    host = loc
-                    try:
-                        host = socket.gethostbyaddr(loc)[0]
-                    except IOError as e:
-                        logger.warning('get hostname exec %s for loc %s', e.message, loc)
-                    hostnames.append(host)
-                self._preferred_locs[split] = hostnames
+                self._preferred_locs[split] = [get_hostname(loc)
+                                               for loc in self._preferred_locs[split]]
         self.repr_name = '<%s %s>' % (self.__class__.__name__, path)
 
 
@@ -1676,6 +1951,13 @@ class TextFileRDD(RDD):
     def params(self):
         return self.path
 
+    def _make_splits(self, f, size, splitSize):
+        numSplits = size // splitSize
+        if size % splitSize > 0:
+            numSplits += 1
+        return [PartialSplit(i, i * splitSize, min(size, (i + 1) * splitSize))
+                for i in range(numSplits)]
+
     def open_file(self):
         return open_file(self.path)
 
@@ -1684,13 +1966,18 @@ class TextFileRDD(RDD):
             start = split.begin
             end = split.end
             if start > 0:
+                # skip to the beginning of next line
                 f.seek(start - 1)
-                byte = f.read(1)
-                while byte != b'\n':
-                    byte = f.read(1)
-                    if not byte:
+                while True:
+                    block = f.read(64 << 10)
+                    if not block:
                         return
-                    start += 1
+                    p = block.find(b'\n')
+                    if p >= 0:
+                        start += p
+                        break
+                    start += len(block)
+                f.seek(start)
 
             if start >= end:
                 return
@@ -1699,21 +1986,350 @@ class TextFileRDD(RDD):
                 yield l
 
     def read(self, f, start, end):
-        for line in f:
-            size = len(line)
+        """ lines beginning in [start, end), f is at start.
+            Read big blocks and split them in bulk, a line across blocks
+            is kept in `remain` until its end is read.
+        """
+        remain = b''
+        while True:
+            size = end - start - len(remain)
+            if size <= 0:
+                size = self.LINE_READ_SIZE
+            block = f.read(min(self.READ_BLOCK_SIZE, size))
+            if not block:
+                break
+            if remain:
+                block = remain + block
+
+            p = block.rfind(b'\n')
+            if p < 0:
+                remain = block
+                continue
+
+            remain = block[p + 1:]
+            block = block[:p]
+            done = start + p + 1 >= end
+            if done:
+                # the last line is the one containing offset `end - 1`
+                cut = block.find(b'\n', max(end - start - 1, 0))
+                if cut >= 0:
+                    block = block[:cut]
+            start += p + 1
+
+            if not six.PY2:
+                block = block.decode('utf-8')
+            for line in block.split('\n' if not six.PY2 else b'\n'):
+                yield line
+            if done:
+                return
+
+        if remain and start < end:
+            yield remain if six.PY2 else remain.decode('utf-8')
+
+
+class CSVFileRDD(TextFileRDD):
+    """ rows of a csv file, parsed in blocks cut at line breaks out of quotes.
+
+        A split begins at the first line break after its offset which is not
+        in a quoted field, told by the nearest quotes whose neighbours show
+        whether they open or close a field (see _record_start). The previous
+        split ends at the same place, so no row is lost or read twice.
+    """
+    LOOKAHEAD = 1 << 20  # to find the quote state at a split offset
+
+    def __init__(self, ctx, path, numSplits=None, splitSize=None, dialect='excel', types=None):
+        TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
+        self.dialect = dialect
+        self.types = types
+
+    def _get_dialect(self):
+        if isinstance(self.dialect, six.string_types):
+            return csv.get_dialect(self.dialect)
+        return self.dialect
+
+    @staticmethod
+    def _in_quotes(buf, quote, delimiter, at_eof=False):
+        """ whether buf begins in a quoted field: walk through the quotes
+            in buf from both states, the one meeting a quote at a wrong
+            place first is wrong, so is the one ending in quotes at EOF.
+            Guess not if neither is wrong.
+        """
+        bounds = (delimiter, b'\n', b'\r')
+        states = [False, True]
+        i = buf.find(quote)
+        while 0 <= i:
+            k = 1
+            while buf[i + k:i + k + 1] == quote:
+                k += 1
+            prev = buf[i - 1:i] if i > 0 else delimiter
+            after = buf[i + k:i + k + 1] or delimiter
+            for j, in_quotes in enumerate(states):
+                if in_quotes is None:
+                    continue
+                if in_quotes:
+                    # k - 1 escaped quotes and the closing one
+                    if k % 2:
+                        states[j] = False if after in bounds else None
+                elif prev not in bounds:
+                    states[j] = None
+                elif k % 2:
+                    states[j] = True
+                elif after not in bounds:
+                    states[j] = None
+            if states[0] is None or states[1] is None:
+                return states[0] is None and states[1] is not None
+            i = buf.find(quote, i + k)
+        if at_eof and states[0] != states[1]:
+            return states[1] is False
+        return False
+
+    def _record_start(self, f, pos, dialect):
+        """ offset of the first row beginning at or after pos """
+        if pos <= 0:
+            return 0
+        if pos >= self.size:
+            return self.size
+
+        f.seek(pos - 1)
+        buf = f.read(self.LOOKAHEAD)
+        quote = (dialect.quotechar or '').encode('utf-8')
+        in_quotes = False
+        if quote and dialect.quoting != csv.QUOTE_NONE:
+            in_quotes = self._in_quotes(buf, quote, dialect.delimiter.encode('utf-8'),
+                                        pos - 1 + len(buf) >= self.size)
+        else:
+            quote = None
+
+        start = pos - 1  # offset of buf
+        p = 0
+        while True:
+            n = buf.find(b'\n', p)
+            if n < 0:
+                if quote:
+                    in_quotes ^= buf.count(quote, p) % 2 == 1
+                start += len(buf)
+                buf = f.read(self.LOOKAHEAD)
+                p = 0
+                if not buf:
+                    return self.size
+                continue
+            if quote:
+                in_quotes ^= buf.count(quote, p, n) % 2 == 1
+            if not in_quotes:
+                return min(start + n + 1, self.size)
+            p = n + 1
+
+    def compute(self, split):
+        dialect = self._get_dialect()
+        with closing(self.open_file()) as f:
+            start = self._record_start(f, split.begin, dialect)
+            end = self._record_start(f, split.end, dialect)
+            if start >= end:
+                return
+            f.seek(start)
+            rows = self.read_rows(f, start, end, dialect)
+            if self.types:
+                rows = convert_csv_rows(rows, self.types)
+            for row in rows:
+                yield row
+
+    def read_rows(self, f, start, end, dialect):
+        """ rows in [start, end), f is at start, which begins a row """
+        return itertools.chain.from_iterable(self.read_blocks(f, start, end, dialect))
+
+    def read_blocks(self, f, start, end, dialect):
+        """ rows of blocks cut at the last line break out of quotes, those
+            without special chars are split directly, others parsed by csv.reader.
+        """
+        quote = dialect.quotechar if dialect.quoting != csv.QUOTE_NONE else None
+        bquote = quote.encode('utf-8') if quote else None
+        delimiter = dialect.delimiter
+        specials = [c for c in (quote, dialect.escapechar) if c]
+        simple = not dialect.skipinitialspace
+        remain = b''
+        while start < end:
+            block = f.read(min(self.READ_BLOCK_SIZE, end - start))
+            if not block:
+                break
+            start += len(block)
+            if remain:
+                block = remain + block
+
+            if start >= end:
+                remain = b''
+            else:
+                p = block.rfind(b'\n')
+                if bquote:
+                    quotes = block.count(bquote, 0, p) if p >= 0 else 0
+                    while p >= 0 and quotes % 2:
+                        q = block.rfind(b'\n', 0, p)
+                        quotes -= block.count(bquote, q + 1, p)
+                        p = q
+                if p < 0:
+                    remain = block
+                    continue
+                remain = block[p + 1:]
+                block = block[:p + 1]
+
             if not six.PY2:
-                line = line.decode('utf-8')
+                block = block.decode('utf-8')
+            eol = None
+            if simple and not any(c in block for c in specials):
+                eol = '\n'
+                if '\r' in block:
+                    n = block.count('\n')
+                    eol = '\r\n' if block.count('\r') == block.count('\r\n') == n else None
+                if eol and (eol + eol in block or block.startswith(eol)):
+                    eol = None  # empty lines are [] in csv
+            if eol:
+                lines = block.split(eol)
+                if not lines[-1]:
+                    lines.pop()
+                yield map(str.split, lines, itertools.repeat(delimiter))
+            else:
+                # split lines as a file opened with newline=''
+                lines = block.splitlines(True) if six.PY2 else io.StringIO(block, newline='')
+                yield csv.reader(lines, dialect)
+
+
+class CombinedSplit(Split):
+    def __init__(self, index, files):
+        self.index = index
+        self.files = files
+
+
+class CombinedFileRDD(RDD):
+    """ small text files packed into splits of about splitSize bytes,
+        files with a replica on the same chunk server are packed together.
 
-            if line.endswith('\n'):
-                yield line[:-1]
+        files: [(path, size, hosts of the first chunk)]
+    """
+
+    def __init__(self, ctx, files, splitSize=None):
+        RDD.__init__(self, ctx)
+        self.splitSize = splitSize or TextFileRDD.DEFAULT_SPLIT_SIZE
+        self.size = sum(size for _, size, _ in files)
+        self._splits = []
+        self._preferred_locs = {}
+        for host, group in self._pack(files, self.splitSize):
+            split = CombinedSplit(len(self._splits), group)
+            self._splits.append(split)
+            self._preferred_locs[split] = [get_hostname(host)] if host else []
+        self.repr_name = '<%s %d files>' % (self.__class__.__name__, len(files))
+
+    @staticmethod
+    def _pack(files, splitSize):
+        """ [(host, [(path, size)])], splits of a host are packed first
+            from its files, beginning with the host having most data;
+            files left in splits less than half full are packed in order.
+        """
+        by_host = {}
+        for path, size, hosts in files:
+            for host in hosts:
+                by_host.setdefault(host, []).append((path, size))
+
+        packed = set()
+        result = []
+        hosts = sorted(by_host, key=lambda h: (-sum(s for _, s in by_host[h]), h))
+        for host in hosts:
+            group, total = [], 0
+            for path, size in by_host[host]:
+                if path in packed:
+                    continue
+                group.append((path, size))
+                packed.add(path)
+                total += size
+                if total >= splitSize:
+                    result.append((host, group))
+                    group, total = [], 0
+            if total * 2 >= splitSize:
+                result.append((host, group))
             else:
-                yield line
-            start += size
-            if start >= end: break
+                packed.difference_update(path for path, _ in group)
+
+        group, total = [], 0
+        for path, size, _ in files:
+            if path in packed:
+                continue
+            group.append((path, size))
+            total += size
+            if total >= splitSize:
+                result.append((None, group))
+                group, total = [], 0
+        if group:
+            result.append((None, group))
+        return result
+
+    @staticmethod
+    def _read_blocks(path, f):
+        """ data of the file in blocks, decompressed incrementally """
+        size = TextFileRDD.READ_BLOCK_SIZE
+        if path.endswith('.gz'):
+            for block in iter_gzip(f, (0, 0, True, None)):
+                yield block
+        elif path.endswith('.bz2'):
+            dz = bz2.BZ2Decompressor()
+            while True:
+                data = f.read(size)
+                if not data:
+                    break
+                while data:
+                    try:
+                        block = dz.decompress(data)
+                    except EOFError:
+                        # the last stream ended with the previous read
+                        dz = bz2.BZ2Decompressor()
+                        continue
+                    if block:
+                        yield block
+                    data = dz.unused_data
+                    if data:
+                        dz = bz2.BZ2Decompressor()
+        else:
+            while True:
+                block = f.read(size)
+                if not block:
+                    break
+                yield block
+
+    def compute(self, split):
+        for path, size in split.files:
+            with closing(open_file(path)) as f:
+                remain = b''
+                for block in self._read_blocks(path, f):
+                    if remain:
+                        block = remain + block
+                    p = block.rfind(b'\n')
+                    if p < 0:
+                        remain = block
+                        continue
+
+                    remain = block[p + 1:]
+                    block = block[:p]
+                    if not six.PY2:
+                        block = block.decode('utf-8')
+                    for line in block.split('\n' if not six.PY2 else b'\n'):
+                        yield line
+
+                if remain:
+                    yield remain if six.PY2 else remain.decode('utf-8')
+
+
+def tfrecord_index_path(path):
+    d, name = os.path.split(path)
+    return os.path.join(d, '.%s.tfidx' % name)
 
 
 class TfrecordsRDD(TextFileRDD):
-    DEFAULT_READ_SIZE = 1 << 10
+    """ records in TFRecord files:
+        length (8) | masked crc32c of length (4) | data | masked crc32c of data (4)
+
+        A split begins at the first record starting in it, found by the
+        sidecar index written by saveAsTFRecordsFile, or by scanning for a
+        valid header.
+    """
+    BUFFER_SIZE = 4 << 20
+    INDEX_VERSION = 1
 
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
@@ -1723,60 +2339,94 @@ class TfrecordsRDD(TextFileRDD):
             start = split.begin
             end = split.end
             if start > 0:
-                # modified below
-                f.seek(start)
-                buffer = f.read(min(self.DEFAULT_READ_SIZE, end - f.tell()))
-                while start < end:
-                    cursor = 0
-                    while cursor < len(buffer) - 11 and not self.check_split_point(buffer[cursor:cursor + 12]):
-                        cursor += 1
-                    start += cursor
-                    if cursor == len(buffer) - 11:
-                        start += 11
-                        buffer = buffer[-11:] + f.read(min(self.DEFAULT_READ_SIZE, end - f.tell()))
-                    else:
-                        break
+                start = self.find_record(f, start, end)
 
             if start >= end:
                 return
 
-            f.seek(start)
-            while start < end:
-                record = self.get_single_record(f)
-                yield record
-                start += len(record) + 16
+            for r in self.read_records(f, start, end):
+                yield r
 
-    def check_split_point(self, buf):
-        buf_length_expected = 12
-        if not buf:
-            return False
-        if len(buf) != buf_length_expected:
-            return False
-        length, length_mask_expected = struct.unpack('<QI', buf)
-        length_mask_actual = masked_crc32c(buf[:8])
-        return length_mask_actual == length_mask_expected
-
-    def get_single_record(self, f):
-        buf_length_expected = 12
-        buf = f.read(buf_length_expected)
-        if len(buf) != buf_length_expected:
-            raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (buf_length_expected, buf))
-        length, length_mask_expected = struct.unpack('<QI', buf)
-        length_mask_actual = masked_crc32c(buf[:8])
-        if length_mask_actual == length_mask_expected:
-            # data verification
-            buf_length_expected = length + 4
-            buf = f.read(buf_length_expected)
-            if len(buf) != buf_length_expected:
-                raise ValueError('Not a valid TFRecord. Fewer than %d bytes: %s' % (buf_length_expected, buf))
-            data, data_mask_expected = struct.unpack('<%dsI' % length, buf)
-            data_mask_actual = masked_crc32c(data)
-            if data_mask_actual == data_mask_expected:
-                return data.decode()
-            else:
-                logger.error("data loss!!!")  # Note: Pending
-        else:
+    def load_index(self):
+        """ offsets of some records, None if there is no valid index """
+        try:
+            with open(tfrecord_index_path(self.path), 'rb') as f:
+                version, size, offsets = marshal.loads(f.read())
+        except Exception:
+            return None
+        if version != self.INDEX_VERSION or size != self.size:
             return None
+        return offsets
+
+    def find_record(self, f, start, end):
+        """ offset of the first record at or after start, end if none before end """
+        index = self.load_index()
+        if index:
+            pos = base = index[bisect.bisect_right(index, start) - 1]
+            f.seek(pos)
+            # headers of all records beginning before start are in buf
+            buf = f.read(start - pos + 12)
+            while pos < start:
+                if pos - base + 12 > len(buf):
+                    return end
+                length, = struct.unpack_from('<Q', buf, pos - base)
+                pos += length + 16
+            return min(pos, end)
+
+        pos = start
+        f.seek(pos)
+        while pos < end:
+            buf = f.read(min(self.BUFFER_SIZE, end - pos + 11))
+            if len(buf) < 12:
+                break
+            i = find_tfrecord(buf)
+            while i >= 0:
+                if self._is_record(f, pos + i, buf, i):
+                    return pos + i
+                i = find_tfrecord(buf, i + 1)
+            pos += len(buf) - 11
+            f.seek(pos)
+        return end
+
+    def _is_record(self, f, pos, buf, i):
+        """ whether a valid header at pos is followed by another one or the end,
+            to make false positives of the scan unlikely
+        """
+        length, = struct.unpack_from('<Q', buf, i)
+        next_pos = pos + length + 16
+        if next_pos == self.size:
+            return True
+        if next_pos + 12 > self.size:
+            return False
+        f.seek(next_pos)
+        header = f.read(12)
+        return (len(header) == 12 and
+                masked_crc32c(header[:8]) == struct.unpack('<I', header[8:])[0])
+
+    def read_records(self, f, start, end):
+        """ records beginning in [start, end), parsed from big buffers in bulk """
+        f.seek(start)
+        buf = b''
+        need = 12  # bytes to parse the next record
+        while start < end:
+            d = f.read(max(min(self.BUFFER_SIZE, end - start - len(buf)), need - len(buf)))
+            if not d:
+                raise ValueError('Not a valid TFRecord. Fewer than %d bytes at %d of %s'
+                                 % (need, start, self.path))
+            buf += d
+            try:
+                records, pos = parse_tfrecords(buf, 0, end - start)
+            except ValueError:
+                raise ValueError('Not a valid TFRecord at %d of %s' % (start, self.path))
+
+            for r in records:
+                if r is not None:
+                    yield r.decode()
+                else:
+                    logger.error("data loss!!!")  # Note: Pending
+            start += pos
+            buf = buf[pos:]
+            need = struct.unpack_from('<Q', buf)[0] + 16 if len(buf) >= 12 else 12
 
 
 class PartialTextFileRDD(TextFileRDD):
@@ -1806,14 +2456,53 @@ class PartialTextFileRDD(TextFileRDD):
         self.repr_name = '<%s %s (%d-%d)>' % (self.__class__.__name__, path, firstPos, lastPos)
 
 
+class GZipSplit(PartialSplit):
+    def __init__(self, index, points):
+        PartialSplit.__init__(self, index, points[0][0], None)
+        self.points = points  # access points in the split, see dpark.utils.gzip_index
+        self.uend = None  # uncompressed offset of the next split
+
+
 class GZipFileRDD(TextFileRDD):
-    "the gziped file must be seekable, compressed by pigz -i"
+    """ splits begin at access points of the gzip file, kept in an index
+        (see dpark.utils.gzip_index), so the file should be compressed with
+        sync flushes (pigz, pigz -i) or be multi-member. The index is built
+        only if dpark.conf.GZIP_INDEX_BUILD, otherwise a file without index
+        is split at sync flush markers found in every splitSize bytes.
+    """
     BLOCK_SIZE = 64 << 10
     DEFAULT_SPLIT_SIZE = 32 << 20
 
     def __init__(self, ctx, path, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, None, splitSize)
 
+    def _make_splits(self, f, size, splitSize):
+        if size <= splitSize:
+            points = [(0, 0, True, None)]
+        else:
+            span = min(dpark.conf.GZIP_INDEX_SPAN, splitSize)
+            index_dir = (dpark.conf.GZIP_INDEX_DIR or
+                         os.path.join(tempfile.gettempdir(), 'dpark_gzip_index_%d' % os.getuid()))
+            points = get_gzip_index(f, self.path, size, f.info.mtime, span, index_dir,
+                                    dpark.conf.GZIP_INDEX_BUILD)
+            if points is None:
+                logger.debug('no gzip index of %s, split at sync markers', self.path)
+                return TextFileRDD._make_splits(self, f, size, splitSize)
+            elif not points:
+                return []
+
+        splits = []
+        for point in points:
+            if splits and point[0] < splits[-1].begin + splitSize:
+                splits[-1].points.append(point)
+            else:
+                if splits:
+                    splits[-1].end = point[0]
+                    splits[-1].uend = point[1]
+                splits.append(GZipSplit(len(splits), [point]))
+        splits[-1].end = size
+        return splits
+
     def find_block(self, f, pos):
         f.seek(pos)
         block = f.read(32 * 1024)
@@ -1843,9 +2532,17 @@ class GZipFileRDD(TextFileRDD):
                 pass
 
     def compute(self, split):
+        if isinstance(split, GZipSplit):
+            return self._compute_points(split)
+        return self._compute_sync_marks(split)
+
+    def _compute_sync_marks(self, split):
+        """ lines of a split of a file without index, from the first sync
+            flush marker after split.begin to the first one after split.end
+        """
         with closing(self.open_file()) as f:
             last_line = b''
-            if split.index == 0:
+            if split.begin == 0:
                 zf = gzip.GzipFile(mode='r', fileobj=f)
                 if hasattr(zf, '_buffer'):
                     zf._buffer.raw._read_gzip_header()
@@ -1856,8 +2553,8 @@ class GZipFileRDD(TextFileRDD):
 
                 start = f.tell()
             else:
-                start = self.find_block(f, split.index * self.splitSize)
-                if start >= split.index * self.splitSize + self.splitSize:
+                start = self.find_block(f, split.begin)
+                if start >= split.end:
                     return
                 for i in range(1, 100):
                     if start - i * self.BLOCK_SIZE <= 4:
@@ -1871,8 +2568,7 @@ class GZipFileRDD(TextFileRDD):
                         if sep:
                             break
 
-            end = self.find_block(f, split.index * self.splitSize + self.splitSize)
-            # TODO: speed up
+            end = self.find_block(f, split.end)
             f.seek(start)
             f.length = end
             dz = zlib.decompressobj(-zlib.MAX_WBITS)
@@ -1934,6 +2630,64 @@ class GZipFileRDD(TextFileRDD):
                     yield line
                     last_line = b''
 
+    def _compute_points(self, split):
+        uend = split.uend
+        with closing(self.open_file()) as f:
+            pos = split.points[0][1]
+            for point in split.points:
+                if point[1] < pos:
+                    continue
+
+                pos = point[1]
+                skip_first = not point[2]
+                remain = b''
+                try:
+                    for data in iter_gzip(f, point):
+                        start = pos - len(remain)
+                        pos += len(data)
+                        block = remain + data if remain else data
+                        p = block.rfind(b'\n')
+                        if p < 0:
+                            remain = block
+                            continue
+
+                        remain = block[p + 1:]
+                        block = block[:p]
+                        done = uend is not None and start + p + 1 >= uend
+                        if done:
+                            # the last line is the one containing offset `uend - 1`
+                            cut = block.find(b'\n', max(uend - start - 1, 0))
+                            if cut >= 0:
+                                block = block[:cut]
+
+                        if skip_first:
+                            # the line begins in the last split
+                            skip_first = False
+                            q = block.find(b'\n')
+                            if q < 0:
+                                if done:
+                                    return
+                                continue
+                            block = block[q + 1:]
+
+                        if not six.PY2:
+                            block = block.decode('utf-8')
+                        for line in block.split('\n' if not six.PY2 else b'\n'):
+                            yield line
+                        if done:
+                            return
+
+                except zlib.error:
+                    if self.err_ratio < 1e-6:
+                        logger.error("failed to decompress file: %s", self.path)
+                        raise
+                    logger.error("drop corrupted data after %d bytes in %s", pos, self.path)
+                    continue
+
+                if remain and not skip_first and (uend is None or pos - len(remain) < uend):
+                    yield remain if six.PY2 else remain.decode('utf-8')
+                return
+
 
 class TableFileRDD(TextFileRDD):
     DEFAULT_SPLIT_SIZE = 32 << 20
@@ -1981,7 +2735,10 @@ class TableFileRDD(TextFileRDD):
 
 
 class BZip2FileRDD(TextFileRDD):
-    "the bzip2ed file must be seekable, compressed by pbzip2"
+    """ the bzip2ed file must be seekable, compressed by pbzip2.
+        blocks of a split are decompressed by max(cpus, 1) threads,
+        use with_cpus() to speed it up.
+    """
 
     DEFAULT_SPLIT_SIZE = 32 * 1024 * 1024
     BLOCK_SIZE = 9000
@@ -1989,6 +2746,13 @@ class BZip2FileRDD(TextFileRDD):
     def __init__(self, ctx, path, numSplits=None, splitSize=None):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
 
+    @staticmethod
+    def _decompress(data):
+        try:
+            return bz2.decompress(data)
+        except IOError:
+            return None  # bad position, skip it
+
     def compute(self, split):
         with closing(self.open_file()) as f:
             magic = f.read(10)
@@ -2008,8 +2772,10 @@ class BZip2FileRDD(TextFileRDD):
                 nd += t
                 np = nd.find(magic)
             d += nd[:np] if np >= 0 else nd
+            at_eof = np < 0 and fp >= 0  # the last block of file begins in this split
 
-            last_line = b''
+            # the last block of last split, to get the beginning of first line
+            last_block = None
             if split.index > 0:
                 cur = split.index * self.splitSize
                 skip = fp if fp >= 0 else d.find(magic)
@@ -2027,42 +2793,85 @@ class BZip2FileRDD(TextFileRDD):
                     nd = f.read(cur - pos)
                     np = nd.find(magic)
                     if np >= 0:
-                        nd = nd[np:]
-                        last_line = bz2.decompress(nd).split(b'\n')[-1]
+                        last_block = nd[np:]
                         break
 
+        blocks = []
         while d:
             np = d.find(magic, len(magic))
             if np <= 0:
-                data = d
-            else:
-                data = d[:np]
-            try:
-                io = BytesIO(bz2.decompress(data))
-            except IOError as e:
-                # bad position, skip it
-                pass
-            else:
-                last_line += io.readline()
-                if last_line.endswith(b'\n'):
-                    line = last_line[:-1]
-                    if not six.PY2:
-                        line = line.decode('utf-8')
+                blocks.append(d)
+                break
+            blocks.append(d[:np])
+            d = d[np:]
+
+        if last_block is not None:
+            blocks.insert(0, last_block)
+        threads = max(int(self.cpus), 1)
+        reader = ReadAhead(self._decompress, ((b,) for b in blocks), threads - 1)
+        try:
+            last_line = b''
+            if last_block is not None:
+                data = next(reader)
+                if data:
+                    last_line = data.rsplit(b'\n', 1)[-1]
+
+            for data in reader:
+                if data is None:
+                    continue
+                p = data.rfind(b'\n')
+                if p < 0:
+                    last_line += data
+                    continue
+
+                block = last_line + data[:p]
+                last_line = data[p + 1:]  # drop last line
+                if not six.PY2:
+                    block = block.decode('utf-8')
+                for line in block.split('\n' if not six.PY2 else b'\n'):
                     yield line
-                    last_line = b''
 
-                for line in io:
-                    if line.endswith(b'\n'):  # drop last line
-                        line = line[:-1]
-                        if not six.PY2:
-                            line = line.decode('utf-8')
-                        yield line
-                    else:
-                        last_line = line
+            if at_eof and last_line:
+                yield last_line if six.PY2 else last_line.decode('utf-8')
+        finally:
+            reader.close()
+
+
+_STRUCT_KINDS = dict([(c, 'i') for c in 'bhilqn'] + [(c, 'u') for c in 'BHILQN'] +
+                     [(c, 'f') for c in 'efd'] + [('?', 'b'), ('P', 'u')])
+
+
+def struct_to_dtype(fmt):
+    """ numpy dtype of records in struct format fmt, fields are f0, f1, ... """
+    import numpy
+
+    order = fmt[:1] if fmt[:1] in '@=<>!' else ''
+    np_order = {'<': '<', '>': '>', '!': '>'}.get(order, '=')
+    names, formats, offsets = [], [], []
+    prefix = order
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt[len(order):]):
+        count = int(count) if count else 1
+        if code in 'sp':
+            items = [('S%d' % count, '%d%s' % (count, code))]
+        elif code in _STRUCT_KINDS:
+            size = struct.calcsize(order + code)
+            items = [('%s%s%d' % (np_order, _STRUCT_KINDS[code], size), code)] * count
+        elif code == 'c':
+            items = [('S1', code)] * count
+        elif code == 'x':
+            prefix += '%dx' % count
+            continue
+        else:
+            raise ValueError('bad char in struct format: %s' % code)
 
-            if np <= 0:
-                break
-            d = d[np:]
+        for np_fmt, code in items:
+            prefix += code
+            offsets.append(struct.calcsize(prefix) - numpy.dtype(np_fmt).itemsize)
+            names.append('f%d' % len(names))
+            formats.append(np_fmt)
+
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                        'itemsize': struct.calcsize(fmt)})
 
 
 class BinaryFileRDD(TextFileRDD):
@@ -2079,20 +2888,59 @@ class BinaryFileRDD(TextFileRDD):
         TextFileRDD.__init__(self, ctx, path, numSplits, splitSize)
         self.repr_name = '<BinaryFileRDD(%s) %s>' % (fmt, path)
 
-    def compute(self, split):
+    def read_blocks(self, split):
+        """ blocks of whole records in split, about READ_BLOCK_SIZE bytes each """
         start = split.index * self.splitSize
         end = min(start + self.splitSize, self.size)
+        rlen = self.length
+        end -= (end - start) % rlen
+        block_size = max(self.READ_BLOCK_SIZE // rlen, 1) * rlen
 
         with closing(self.open_file()) as f:
             f.seek(start)
-            rlen = self.length
-            fmt = self.fmt
-            for i in range((end - start) // rlen):
-                d = f.read(rlen)
-                if len(d) < rlen: break
-                if fmt:
-                    d = struct.unpack(fmt, d)
+            while start < end:
+                d = f.read(min(block_size, end - start))
+                d = d[:len(d) - len(d) % rlen]
+                if not d:
+                    break
                 yield d
+                start += len(d)
+
+    def compute(self, split):
+        rlen = self.length
+        if self.fmt:
+            st = struct.Struct(self.fmt)
+            if hasattr(st, 'iter_unpack'):
+                unpack_block = st.iter_unpack
+            else:
+                unpack_block = lambda d: [st.unpack_from(d, i) for i in range(0, len(d), rlen)]
+        else:
+            unpack_block = lambda d: [d[i:i + rlen] for i in range(0, len(d), rlen)]
+
+        for d in self.read_blocks(split):
+            for r in unpack_block(d):
+                yield r
+
+    def dtype(self):
+        import numpy
+        if self.fmt:
+            return struct_to_dtype(self.fmt)
+        return numpy.dtype((numpy.void, self.length))
+
+    def mapBlocks(self, f):
+        """ f(array) of each block of records, the array is a numpy structured
+            array with fields f0, f1, ... (or void records without fmt),
+            read only and valid only during the call.
+        """
+        return MappedBlocksRDD(self, f)
+
+
+class MappedBlocksRDD(MappedRDD):
+    def compute(self, split):
+        import numpy
+        dtype = self.prev.dtype()
+        for d in self.prev.read_blocks(split):
+            yield self.func(numpy.frombuffer(d, dtype=dtype))
 
 
 class OutputTextFileRDD(DerivedRDD):
@@ -2121,6 +2969,9 @@ class OutputTextFileRDD(DerivedRDD):
         self.compress = compress
         self.repr_name = '<%s %s %s>' % (self.__class__.__name__, path, rdd)
 
+    # uncompressed size of gzip members, compressed by max(cpus, 1) threads
+    BLOCK_SIZE = 256 << 10
+
     def compute(self, split):
         path = os.path.join(self.path,
                             "%04d%s" % (split.index, self.ext))
@@ -2129,16 +2980,34 @@ class OutputTextFileRDD(DerivedRDD):
 
         with atomic_file(path, mode='wb', bufsize=4096 * 1024 * 16) as f:
             if self.compress:
-                have_data = self.write_compress_data(f, self.prev.iterator(split))
+                written = self.write_compress_data(f, self.prev.iterator(split))
             else:
-                have_data = self.writedata(f, self.prev.iterator(split))
+                written = self.writedata(f, self.prev.iterator(split))
 
-            if not have_data:
+            if not written:
                 raise AbortFileReplacement
 
         if os.path.exists(path):
+            self.write_index(path, written)
             yield path
 
+    def write_index(self, path, written):
+        """ save the index of the file, by the result of writedata
+            or write_compress_data
+        """
+        if self.compress:
+            self.write_gzip_index(path, written)
+
+    def write_gzip_index(self, path, points):
+        """ save members as split points of GZipFileRDD, if more than one """
+        if not points or len(points) < 2:
+            return
+        try:
+            save_gzip_index(gzip_index_path(path), os.path.getsize(path),
+                            os.path.getmtime(path), 0, points)
+        except (IOError, OSError) as e:
+            logger.warning('fail to write gzip index of %s: %s', path, e)
+
     def writedata(self, f, lines):
         if not six.PY2:
             f = TextIOWrapper(f)
@@ -2161,49 +3030,80 @@ class OutputTextFileRDD(DerivedRDD):
             f.close()
         return True
 
-    def write_compress_data(self, f, lines):
-        empty = True
-        with gzip.GzipFile(filename='', mode='w', fileobj=f) as f:
-            if not six.PY2:
-                f = TextIOWrapper(f)
-            size = 0
-            for line in lines:
-                f.write(line)
-                if not line.endswith('\n'):
-                    f.write('\n')
-                size += len(line) + 1
-                if size >= 256 << 10:
-                    f.flush()
-                    f.compress = zlib.compressobj(9, zlib.DEFLATED,
-                                                  -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    size = 0
-                empty = False
-            if not empty:
-                f.flush()
-            if not six.PY2:
-                f.close()
+    def text_blocks(self, lines):
+        """ encoded lines in blocks of about BLOCK_SIZE """
+        buf = []
+        size = 0
+        for line in lines:
+            buf.append(line)
+            size += len(line) + 1
+            if not line.endswith('\n'):
+                buf.append('\n')
+            if size >= self.BLOCK_SIZE:
+                block = ''.join(buf)
+                yield block if six.PY2 else block.encode('utf-8')
+                buf = []
+                size = 0
+        if buf:
+            block = ''.join(buf)
+            yield block if six.PY2 else block.encode('utf-8')
 
-        return not empty
+    def write_compress_data(self, f, lines):
+        """ access points of the gzip members written, empty if no data """
+        threads = max(int(self.cpus), 1)
+        return write_gzip_members(f, self.text_blocks(lines), threads - 1)
 
 
 class OutputTfrecordstFileRDD(OutputTextFileRDD):
     def __init__(self, rdd, path, ext, overwrite=True, compress=False):
         OutputTextFileRDD.__init__(self, rdd=rdd, path=path, ext='.tfrecords', overwrite=overwrite, compress=compress)
 
+    INDEX_SPAN = 1 << 20
+
+    def write_index(self, path, written):
+        if self.compress:
+            return OutputTextFileRDD.write_index(self, path, written)
+        # offsets of some records, to find the beginning of splits
+        try:
+            with atomic_file(tfrecord_index_path(path)) as f:
+                f.write(marshal.dumps((TfrecordsRDD.INDEX_VERSION,
+                                       os.path.getsize(path), written)))
+        except (IOError, OSError) as e:
+            logger.warning('fail to write index of %s: %s', path, e)
+
     def writedata(self, f, strings):
-        empty = True
+        """ offsets of some records written, empty if no data """
+        index = []
+        offset = 0
+        buf = []
+        size = 0
         for string in strings:
+            if not index or offset - index[-1] >= self.INDEX_SPAN:
+                index.append(offset)
             string_bytes = str(string).encode()
             encoded_length = struct.pack('<Q', len(string_bytes))
-            f.write(encoded_length + struct.pack('<I', masked_crc32c(encoded_length)) +
-                    string_bytes + struct.pack('<I', masked_crc32c(string_bytes)))
-            empty = False
-        return not empty
+            buf.append(encoded_length + struct.pack('<I', masked_crc32c(encoded_length)) +
+                       string_bytes + struct.pack('<I', masked_crc32c(string_bytes)))
+            offset += len(string_bytes) + 16
+            size += len(string_bytes) + 16
+            if size >= self.INDEX_SPAN:
+                f.write(b''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            f.write(b''.join(buf))
+        return index
 
 
 class MultiOutputTextFileRDD(OutputTextFileRDD):
     MAX_OPEN_FILES = 512
     BLOCK_SIZE = 256 << 10
+    # bytes of lines buffered before a sorted run is spilled, in sort mode
+    SORT_BUFFER_SIZE = 64 << 20
+
+    def __init__(self, rdd, path, ext='', overwrite=False, compress=False, sort=False):
+        OutputTextFileRDD.__init__(self, rdd, path, ext, overwrite, compress)
+        self.sort_keys = sort
 
     def get_tpath(self, key):
         tpath = self.paths.get(key)
@@ -2218,11 +3118,8 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
 
     def get_file(self, key):
         f = self.files.get(key)
-        fileobj = getattr(f, 'fileobj', None)
-        if hasattr(f, 'buffer'):
-            fileobj = f.buffer.fileobj
-
-        if f is None or self.compress and fileobj is None:
+        g = getattr(f, 'buffer', f)  # the GzipFile under TextIOWrapper
+        if f is None or self.compress and g.fileobj is None:
             tpath = self.get_tpath(key)
             try:
                 nf = open(tpath, 'ab+', 4096 * 1024)
@@ -2231,37 +3128,44 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
                 nf = open(tpath, 'ab+', 4096 * 1024)
             if self.compress:
                 if f:
-                    f.fileobj = nf
+                    g.fileobj = nf
                 else:
-                    f = gzip.GzipFile(filename='', mode='a+', fileobj=nf)
+                    g = gzip.GzipFile(filename='', mode='a+', fileobj=nf)
 
-                f.myfileobj = nf  # force f.myfileobj.close() in f.close()
+                g.myfileobj = nf  # force f.myfileobj.close() in f.close()
             else:
-                f = nf
+                g = nf
 
-            if not six.PY2:
-                f = TextIOWrapper(f)
-            self.files[key] = f
+            if f is None:
+                f = g if six.PY2 else TextIOWrapper(g)
+                self.files[key] = f
 
         return f
 
     def flush_file(self, key, f):
         f.flush()
+        g = getattr(f, 'buffer', f)
         if self.compress:
-            f.compress = zlib.compressobj(9, zlib.DEFLATED,
+            g.compress = zlib.compressobj(9, zlib.DEFLATED,
                                           -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
 
         if len(self.files) > self.MAX_OPEN_FILES:
             if self.compress:
-                open_files = sum(1 for f in self.files.values() if f.fileobj is not None)
+                open_files = sum(1 for o in self.files.values()
+                                 if getattr(o, 'buffer', o).fileobj is not None)
                 if open_files > self.MAX_OPEN_FILES:
-                    f.fileobj.close()
-                    f.fileobj = None
+                    g.fileobj.close()
+                    g.fileobj = None
             else:
                 f.close()
                 self.files.pop(key)
 
     def compute(self, split):
+        if self.sort_keys:
+            return self.compute_sorted(split)
+        return self.compute_by_files(split)
+
+    def compute_by_files(self, split):
         self.split = split
         self.paths = {}
         self.files = {}
@@ -2307,6 +3211,92 @@ class MultiOutputTextFileRDD(OutputTextFileRDD):
                 except:
                     pass
 
+    def sorted_runs(self, items):
+        """ runs of (key, run, seq, block of lines) sorted by key, each of about
+            SORT_BUFFER_SIZE bytes, all but the last spilled to disk
+        """
+        blocks = {}  # key -> [finished blocks, lines, size of lines]
+        size = 0
+        for k, v in items:
+            k = str(k)
+            b = blocks.get(k)
+            if b is None:
+                b = blocks[k] = [[], [], 0]
+            b[1].append(v)
+            n = len(v) + 1
+            if not v.endswith('\n'):
+                b[1].append('\n')
+            b[2] += n
+            if b[2] >= self.BLOCK_SIZE:
+                b[0].append(''.join(b[1]))
+                b[1] = []
+                b[2] = 0
+
+            size += n
+            if size >= self.SORT_BUFFER_SIZE:
+                path = LocalFileShuffle.get_tmp()
+                self.runs.append(path)
+                with open(path, 'wb', 4096 * 1024) as f:
+                    for r in self._sorted_blocks(blocks, len(self.runs)):
+                        marshal.dump(r, f)
+                blocks = {}
+                size = 0
+
+        runs = [self._load_run(path) for path in self.runs]
+        runs.append(self._sorted_blocks(blocks, len(runs) + 1))
+        return runs
+
+    @staticmethod
+    def _sorted_blocks(blocks, run):
+        seq = itertools.count()
+        for k in sorted(blocks):
+            done, lines, _ = blocks[k]
+            if lines:
+                done.append(''.join(lines))
+            for block in done:
+                yield k, run, next(seq), block
+
+    @staticmethod
+    def _load_run(path):
+        with open(path, 'rb', 4096 * 1024) as f:
+            while True:
+                try:
+                    yield marshal.load(f)
+                except EOFError:
+                    return
+
+    def compute_sorted(self, split):
+        """ spill lines sorted by key, then write the files one by one """
+        self.split = split
+        self.paths = {}
+        self.runs = []
+        threads = max(int(self.cpus), 1)
+        indexes = {}
+        try:
+            merged = heapq.merge(*self.sorted_runs(self.prev.iterator(split)))
+            for k, group in itertools.groupby(merged, lambda r: r[0]):
+                blocks = (b if six.PY2 else b.encode('utf-8') for _, _, _, b in group)
+                tpath = self.get_tpath(k)
+                with open(tpath, 'wb', 4096 * 1024) as f:
+                    if self.compress:
+                        indexes[k] = write_gzip_members(f, blocks, threads - 1)
+                    else:
+                        for b in blocks:
+                            f.write(b)
+
+            for k, tpath in self.paths.items():
+                path = os.path.join(self.path, k, "%04d%s" % (split.index, self.ext))
+                if not os.path.exists(path):
+                    os.rename(tpath, path)
+                    self.write_gzip_index(path, indexes.get(k))
+                    yield path
+        finally:
+            for tpath in list(self.paths.values()) + self.runs:
+                try:
+                    os.remove(tpath)
+                except OSError:
+                    pass
+
 
 class OutputCSVFileRDD(OutputTextFileRDD):
     def __init__(self, rdd, path, dialect, overwrite, compress):
@@ -2328,28 +3318,21 @@ class OutputCSVFileRDD(OutputTextFileRDD):
             f.close()
         return not empty
 
-    def write_compress_data(self, f, rows):
-        empty = True
-        with gzip.GzipFile(filename='', mode='w', fileobj=f) as f:
-            if not six.PY2:
-                f = TextIOWrapper(f)
-            writer = csv.writer(f, self.dialect)
-            last_flush = 0
-            for row in rows:
-                if not isinstance(row, (tuple, list)):
-                    row = (row,)
-                writer.writerow(row)
-                empty = False
-                if f.tell() - last_flush >= 256 << 10:
-                    f.flush()
-                    f.compress = zlib.compressobj(9, zlib.DEFLATED,
-                                                  -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
-                    last_flush = f.tell()
-            if not empty:
-                f.flush()
-            if not six.PY2:
-                f.close()
-        return not empty
+    def text_blocks(self, rows):
+        buf = six.StringIO()
+        writer = csv.writer(buf, self.dialect)
+        for row in rows:
+            if not isinstance(row, (tuple, list)):
+                row = (row,)
+            writer.writerow(row)
+            if buf.tell() >= self.BLOCK_SIZE:
+                block = buf.getvalue()
+                yield block if six.PY2 else block.encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        block = buf.getvalue()
+        if block:
+            yield block if six.PY2 else block.encode('utf-8')
 
 
 class OutputBinaryFileRDD(OutputTextFileRDD):
@@ -2357,14 +3340,29 @@ class OutputBinaryFileRDD(OutputTextFileRDD):
         OutputTextFileRDD.__init__(self, rdd, path, '.bin', overwrite)
         self.fmt = fmt
 
+    BATCH_SIZE = 4096
+
     def writedata(self, f, rows):
+        """ rows are records, or numpy arrays of records (like in mapBlocks) """
+        st = struct.Struct(self.fmt)
+        pack = st.pack
         empty = True
+        buf = []
         for row in rows:
             if isinstance(row, (tuple, list)):
-                f.write(struct.pack(self.fmt, *row))
+                buf.append(pack(*row))
+            elif getattr(row, 'ndim', 0) > 0:
+                if row.dtype.itemsize != st.size:
+                    raise ValueError('size of %s does not match format %s' % (row.dtype, self.fmt))
+                buf.append(row.tobytes())
             else:
-                f.write(struct.pack(self.fmt, row))
+                buf.append(pack(row))
             empty = False
+            if len(buf) >= self.BATCH_SIZE:
+                f.write(b''.join(buf))
+                buf = []
+        if buf:
+            f.write(b''.join(buf))
         return not empty
 
 
@@ -2400,7 +3398,9 @@ class OutputTableFileRDD(OutputTextFileRDD):
 
         return f.tell() > 0
 
-    write_compress_data = writedata
+    def write_compress_data(self, f, rows):
+        # blocks are compressed by writedata, no gzip members to be indexed
+        return [(0, 0, True, None)] if self.writedata(f, rows) else []
 
 
 class BeansdbFileRDD(TextFileRDD):
@@ -2414,7 +3414,8 @@ class BeansdbFileRDD(TextFileRDD):
         self.reader = BeansdbReader(path, key_filter, fullscan, raw)
 
     def compute(self, split):
-        return self.reader.read(split.begin, split.end)
+        threads = max(int(self.cpus), 1)
+        return self.reader.read(split.begin, split.end, threads - 1)
 
 
 class OutputBeansdbRDD(DerivedRDD):
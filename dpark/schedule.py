@@ -20,6 +20,7 @@ import dpark.conf as conf
 from dpark.accumulator import Accumulator
 from dpark.dependency import ShuffleDependency
 from dpark.env import env
+from dpark.history import StageHistory, profile_store
 from dpark.taskset import TaskSet, TaskCounter
 from dpark.mutable_dict import MutableDict
 from dpark.task import ResultTask, ShuffleMapTask, TTID, TaskState, TaskEndReason
@@ -62,6 +63,7 @@ class Stage(object):
         self.taskcounters = []  # a TaskCounter object for each run/retry
         self.submit_time = 0
         self.finish_time = 0
+        self.priority = 0  # estimated secs of the longest remaining path to final stage
         self.pipelines = pipelines  # each pipeline is a list of rdds
         self.pipeline_edges = pipeline_edges  # ((src_stage_id, src_pipeline_id), (dst_stage_id, dst_pipeline_id)): N
         self.rdd_pipelines = rdd_pipelines  # rdd_id: pipeline_id
@@ -148,6 +150,21 @@ class Stage(object):
                     d[attr] = _summary(list([getattr(s, attr) for s in stats]))
         return d
 
+    def get_input_size(self):
+        """ shuffle output of parent stages plus size of source rdds (bytes of files) """
+        size = 0
+        for p in self.parents:
+            size += sum(x[-1].bytes_dump for x in p.task_stats if x and x[-1])
+
+        def _(r):
+            if not r.dependencies:
+                size_list.append(getattr(r, 'size', 0))
+            return True
+
+        size_list = []
+        walk_dependencies(self.rdd, lambda r, dep: not isinstance(dep, ShuffleDependency), _)
+        return size + sum(size_list)
+
     def get_node_id(self, stage_id, pipeline_id):
         if stage_id == -1:
             stage_id = self.id
@@ -325,6 +342,7 @@ class DAGScheduler(Scheduler):
         self.jobstats = []
         self.is_dstream = False
         self.current_scope = None
+        self.history = StageHistory()
 
         self.final_lock = threading.RLock()
         self.final_stage = None
@@ -564,6 +582,10 @@ class DAGScheduler(Scheduler):
         lastFetchFailureTime = 0
 
         self.updateCacheLocs()
+        self.history.rank_stages(finalStage)
+
+        def by_priority(stages):
+            return sorted(stages, key=lambda s: -s.priority)
 
         logger.debug('Final stage: %s, %d', finalStage, numOutputParts)
         logger.debug('Parents of final stage: %s', finalStage.parents)
@@ -578,6 +600,7 @@ class DAGScheduler(Scheduler):
             MutableDict.merge()
             walk_dependencies(stage.rdd, _)
             logger.info("stage %d finish %s", stage.id, stage.fmt_stats())
+            profile_store.record(stage, stage.get_input_size())
 
         if (allowLocal and
                 (
@@ -599,7 +622,7 @@ class DAGScheduler(Scheduler):
                     submitMissingTasks(stage)
                     running.add(stage)
                 else:
-                    for parent in missing:
+                    for parent in by_priority(missing):
                         submitStage(parent)
                     waiting.add(stage)
 
@@ -643,7 +666,7 @@ class DAGScheduler(Scheduler):
                 if (failed and
                         time.time() > lastFetchFailureTime + RESUBMIT_TIMEOUT):
                     self.updateCacheLocs()
-                    for stage in failed:
+                    for stage in by_priority(failed):
                         logger.info('Resubmitting failed stages: %s', stage)
                         submitStage(stage)
                     failed.clear()
@@ -711,7 +734,7 @@ class DAGScheduler(Scheduler):
                         running |= newlyRunnable
                         logger.debug(
                             'newly runnable: %s, %s', waiting, newlyRunnable)
-                        for stage in newlyRunnable:
+                        for stage in by_priority(newlyRunnable):
                             submitMissingTasks(stage)
             elif reason == TaskEndReason.fetch_failed:
                 exception = evt.result
@@ -732,6 +755,7 @@ class DAGScheduler(Scheduler):
                 raise Exception(reason.message)
 
         onStageFinished(finalStage)
+        profile_store.save()
 
         if not self.is_dstream:
             self._keep_stats(finalRdd, finalStage)
@@ -748,6 +772,7 @@ class DAGScheduler(Scheduler):
         try:
             stats = self._get_stats(final_rdd, final_stage)
             self.jobstats.append(marshal.dumps(stats))
+            self.history.add_job(stats)
             if self.loghub_dir:
                 self._dump_stats(stats)
         except Exception as e:
@@ -1183,8 +1208,10 @@ class MesosScheduler(DAGScheduler):
         rdd = tasks[0].rdd
         assert all(t.rdd is rdd for t in tasks)
 
-        taskset = TaskSet(self, tasks, rdd.cpus or self.cpus, rdd.mem or self.mem,
-                          rdd.gpus, self.task_host_manager)
+        stage = self.idToStage[tasks[0].stage_id]
+        cpus, mem = profile_store.suggest_resources(stage, stage.get_input_size(),
+                                                    rdd.cpus or self.cpus, rdd.mem or self.mem)
+        taskset = TaskSet(self, tasks, cpus, mem, rdd.gpus, self.task_host_manager, stage.priority)
         self.active_tasksets[taskset.id] = taskset
         stage_scope = ''
         try:
@@ -1193,7 +1220,6 @@ class MesosScheduler(DAGScheduler):
         except:
             pass
 
-        stage = self.idToStage[tasks[0].stage_id]
         stage.num_try += 1
         stage.taskcounters.append(taskset.counter)
         logger.info(
@@ -1281,7 +1307,9 @@ class MesosScheduler(DAGScheduler):
         mesos_tasks = {}
         tasks = {}
         max_create_time = 0
-        for taskset in self.active_tasksets.values():
+        # tasksets on the critical path first
+        tasksets = sorted(self.active_tasksets.values(), key=lambda t: -t.priority)
+        for taskset in tasksets:
             while True:
                 host_offers = {}
                 for i, o in enumerate(offers):
@@ -1,9 +1,11 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import os
 import sys
 import types
 import marshal
 import types
+import hashlib
 import six
 import itertools
 from collections import deque
@@ -209,6 +211,116 @@ def marshalable(o):
     return False
 
 
+def _update_code_digest(h, code, hook, seen):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code_digest(h, const, hook, seen)
+        else:
+            update_digest(h, const, hook, seen)
+
+
+def _update_methods_digest(h, cls, hook, seen):
+    # only the code of methods, globals of them are shared by the module
+    for k, v in sorted(six.iteritems(vars(cls)), key=lambda kv: kv[0]):
+        if isinstance(v, (staticmethod, classmethod)):
+            v = v.__func__
+        if isinstance(v, property):
+            funcs = (v.fget, v.fset, v.fdel)
+        else:
+            funcs = (v,)
+        for f in funcs:
+            if isinstance(f, types.FunctionType):
+                h.update(k.encode('utf-8'))
+                _update_code_digest(h, f.__code__, hook, seen)
+
+
+def _sub_digest(obj, hook, seen):
+    h = hashlib.md5()
+    update_digest(h, obj, hook, seen)
+    return h.digest()
+
+
+def update_digest(h, obj, hook=None, seen=None):
+    """ Feed a digest of obj into hasher h, stable across runs (no ids or addresses).
+        Functions are digested by code, defaults, closures and referenced globals,
+        classes by code of their methods. Raise ValueError if obj can not be digested.
+        hook(h, obj) returns True if it has digested obj itself.
+    """
+    if seen is None:
+        seen = set()
+    if hook is not None and hook(h, obj):
+        return
+
+    h.update(type(obj).__name__.encode('utf-8'))
+    if obj is None or isinstance(obj, (bool, float, complex, six.binary_type, six.text_type)
+                                 + six.integer_types):
+        h.update(repr(obj).encode('utf-8'))
+        return
+
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+
+    if isinstance(obj, (tuple, list, deque)):
+        for v in obj:
+            update_digest(h, v, hook, seen)
+    elif isinstance(obj, (set, frozenset)):
+        for d in sorted(_sub_digest(v, hook, seen) for v in obj):
+            h.update(d)
+    elif isinstance(obj, dict):
+        for k, v in sorted((_sub_digest(k, hook, seen), v) for k, v in six.iteritems(obj)):
+            h.update(k)
+            update_digest(h, v, hook, seen)
+    elif isinstance(obj, types.FunctionType):
+        code = obj.__code__
+        _update_code_digest(h, code, hook, seen)
+        update_digest(h, obj.__defaults__, hook, seen)
+        for c in obj.__closure__ or ():
+            try:
+                v = c.cell_contents
+            except ValueError:  # empty cell
+                continue
+            update_digest(h, v, hook, seen)
+        for n in sorted(set(get_co_names(code))):
+            if n in obj.__globals__:
+                h.update(n.encode('utf-8'))
+                update_digest(h, obj.__globals__[n], hook, seen)
+    elif isinstance(obj, types.CodeType):
+        _update_code_digest(h, obj, hook, seen)
+    elif isinstance(obj, types.MethodType):
+        update_digest(h, obj.__self__, hook, seen)
+        update_digest(h, obj.__func__, hook, seen)
+    elif isinstance(obj, types.ModuleType):
+        h.update(obj.__name__.encode('utf-8'))
+        path = getattr(obj, '__file__', None)
+        if path and os.path.exists(path):
+            # modules are edited between runs
+            st = os.stat(path)
+            h.update(repr((st.st_size, int(st.st_mtime))).encode('utf-8'))
+    elif isinstance(obj, types.BuiltinFunctionType):
+        name = '%s.%s' % (getattr(obj, '__module__', ''), obj.__name__)
+        h.update(name.encode('utf-8'))
+    elif isinstance(obj, type):
+        name = '%s.%s' % (obj.__module__, obj.__name__)
+        h.update(name.encode('utf-8'))
+        if obj.__module__ not in ('builtins', '__builtin__'):
+            for base in obj.__bases__:
+                update_digest(h, base, hook, seen)
+            _update_methods_digest(h, obj, hook, seen)
+    elif isinstance(obj, partial):
+        update_digest(h, (obj.func, obj.args, obj.keywords), hook, seen)
+    elif hasattr(obj, '__dict__'):
+        update_digest(h, type(obj), hook, seen)
+        update_digest(h, obj.__dict__, hook, seen)
+    else:
+        try:
+            h.update(cPickle.dumps(obj, 2))
+        except Exception as e:
+            raise ValueError('can not digest %s: %s' % (type(obj), e))
+
+
 OBJECT_SIZE_LIMIT = 100 << 10
 
 
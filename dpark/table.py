@@ -1,12 +1,15 @@
 from __future__ import absolute_import
 import os, sys
 import re
+import ast
 from collections import namedtuple
 import itertools
 
 import msgpack
 
 from dpark.rdd import DerivedRDD, OutputTableFileRDD
+from dpark.tabular import TabularRDD, parse_filter
+from dpark.utils.log import get_logger
 from dpark.dependency import Aggregator, OneToOneDependency
 from six.moves import range
 from six.moves import zip
@@ -75,6 +78,62 @@ def eval(code, g={}, l={}):
     return __eval(code, g or Globals, l)
 
 
+logger = get_logger(__name__)
+
+# comparisons of where pushed down as filterByIndex(field__op=value)
+CMP_OPS = {'==': '', '=': '', '>': '__gt', '>=': '__ge', '<': '__lt', '<=': '__le'}
+
+
+def _conjuncts(expr):
+    """ conditions joined by and at the top level of expr, a condition
+        joined by or is left out
+    """
+    literals = []
+
+    def hide(m):
+        literals.append(m.group(0))
+        return '\0%d\0' % (len(literals) - 1)
+
+    def show(e):
+        return re.sub('\0(\\d+)\0', lambda m: literals[int(m.group(1))], e).strip()
+
+    def split(e):
+        parts, last, depth = [], [], 0
+        for tok in re.split(r'(\(|\)|\band\b|\bor\b)', e, flags=re.I):
+            if depth == 0 and tok.lower() == 'or':
+                return []
+            if depth == 0 and tok.lower() == 'and':
+                parts.append(''.join(last))
+                last = []
+                continue
+            depth += (tok == '(') - (tok == ')')
+            if depth < 0:
+                return []
+            last.append(tok)
+        parts.append(''.join(last))
+
+        rs = []
+        for part in parts:
+            part = part.strip()
+            if part.startswith('(') and part.endswith(')') and _balanced(part[1:-1]):
+                rs.extend(split(part[1:-1]))
+            else:
+                rs.append(part)
+        return rs
+
+    e = re.sub(r'\'(?:[^\'\\]|\\.)*\'|"(?:[^"\\]|\\.)*"', hide, expr)
+    return [show(c) for c in split(e)]
+
+
+def _balanced(e):
+    depth = 0
+    for c in e:
+        depth += (c == '(') - (c == ')')
+        if depth < 0:
+            return False
+    return depth == 0
+
+
 def table_join(f):
     def _join(self, other, left_keys=None, right_keys=None):
         if not left_keys:
@@ -314,6 +373,72 @@ class TableRDD(DerivedRDD):
     def take(self, n):
         return self.prev.take(n)
 
+    def _used_fields(self, kw):
+        """ fields referred in the parts of sql, in order of the table """
+        if kw.get('select', '').strip() == '*':
+            return list(self.fields)
+        words = set()
+        for k, e in kw.items():
+            if k not in ('from', 'limit'):
+                words.update(re.findall(r'\w+', e))
+        return [f for f in self.fields if f in words]
+
+    def _where_filters(self, where):
+        """ {(field, op): value} of conditions in where which can be
+            checked by filterByIndex, comparisons of fields and literals
+        """
+        filters = {}
+        for c in _conjuncts(where):
+            m = re.match(r'(\w+)\s*(==|>=|<=|=|>|<)\s*(.+)$', c, re.S)
+            is_in = False
+            if m is None:
+                m = re.match(r'(\w+)\s+(in)\s+(.+)$', c, re.I | re.S)
+                is_in = True
+            if m is None or m.group(1) not in self.fields:
+                continue
+            field, op, literal = m.groups()
+            try:
+                value = ast.literal_eval(literal.strip())
+            except (ValueError, SyntaxError):
+                continue
+
+            # nulls are left to the where of the table
+            if is_in:
+                if not isinstance(value, (list, tuple, set, frozenset)) or None in value:
+                    continue
+                key, value = (field, ''), list(value)
+            elif isinstance(value, (list, set, dict)) or value is None:
+                continue
+            else:
+                key = (field, CMP_OPS[op])
+            filters.setdefault(key, value)
+        return filters
+
+    def _pushdown(self, fields, filters):
+        """ a table of tabular files which reads only columns of fields and
+            skips stripes by filters, self if it is not of tabular files
+        """
+        prev = self.prev
+        if not isinstance(prev, TabularRDD):
+            return self
+        source = prev.get_fields()
+        if source is None or len(source) != len(self.fields):
+            return self
+        if fields == self.fields and not filters:
+            return self
+
+        names = dict(zip(self.fields, source))
+        fields = fields or self.fields[:1]
+        rdd = prev.select_fields([names[f] for f in fields])
+        if filters:
+            filters = dict((names[f] + op, v) for (f, op), v in filters.items())
+            # files written before stats, or without indices of the fields
+            if prev.can_filter([parse_filter(k) for k in filters]):
+                rdd = rdd.filterByIndex(**filters)
+            else:
+                logger.info('can not filter %s by index, read all stripes', prev)
+        return rdd.asTable(fields, self.name)
+
     def execute(self, sql, asTable=False):
         sql_p = re.compile(r'(select|from|(?:inner|left outer)? join(?: each)?|where|group by|having|order by|limit) ',
                            re.I)
@@ -354,10 +479,10 @@ class TableRDD(DerivedRDD):
                         kw[k] = p.sub('', kw[k])
             break
         else:
-            r = self
+            # read needed cols and stripes only, if from tabular files
+            filters = self._where_filters(kw['where']) if 'where' in kw else {}
+            r = self._pushdown(self._used_fields(kw), filters)
 
-        # select needed cols
-        # r = self.select(*[n for n in self.fields if n in sql])
         cols = [n.strip() for n in self._split_expr(kw['select'])]
 
         if 'where' in kw:
@@ -5,10 +5,14 @@ import types
 import socket
 import struct
 import marshal
-from dpark.rdd import RDD, MultiSplit, TextFileRDD, Split, ParallelCollection, cached
+import operator
+from bisect import bisect_left
+from dpark.rdd import (
+    RDD, MappedRDD, MultiSplit, TextFileRDD, Split, ParallelCollection, cached
+)
 from dpark.utils import chain, atomic_file
 from dpark.file_manager import walk
-from dpark.utils.bitindex import Bloomfilter, BitIndex
+from dpark.utils.bitindex import Bloomfilter, BitIndex, RoaringBitmap
 from dpark.serialize import dumps, loads
 from dpark.dependency import OneToOneDependency, OneToRangeDependency
 from contextlib import closing
@@ -26,13 +30,25 @@ Strip Format:
 Padding_Size = STRIPE_SIZE - Header_Size - sum(Header)
 
 Footer Format:
-+------------------+-----------------+---------------+----------------+
-|     +Indices     |     +Fields     |  Fields_Size  |  Indices_Size  |
-|  (Indices_Size)  |  (Fields_Size)  |      (4)      |      (4)       |
-+------------------+-----------------+---------------+----------------+
++----------------+--------------+---------------+------------------+-----------------+---------------+----------------+
+|     +Stats     |  Stats_Size  |  Stats_Magic  |     #Indices     |     *Fields     |  Fields_Size  |  Indices_Size  |
+|  (Stats_Size)  |     (4)      |      (4)      |  (Indices_Size)  |  (Fields_Size)  |      (4)      |      (4)       |
++----------------+--------------+---------------+------------------+-----------------+---------------+----------------+
+
+Stats (zone maps) are missing in files written by older versions.
+Stats: {field: [(min, max, null count, distinct count, distinct values), ...]},
+one per stripe, min and max are None if unknown, distinct values are kept
+only if there are at most MAX_DICT_SIZE of them.
+
+Indices: {field: (sorted, values, stripes, null stripes)} of BitmapIndex,
+values are the distinct values except None, sorted if they can be, and the
+stripes of a value are a stripe id, or a dumped RoaringBitmap if more than
+one. Older versions wrote AdaptiveIndex objects in zlib + cPickle, without
+Indices_Magic.
 
 *: lz4 + marshal
 +: zlib + cPickle
+#: Indices_Magic (4) + zlib + marshal
 '''
 
 STRIPE_SIZE = 1 << 26
@@ -47,54 +63,84 @@ MAX_BIT_INDEX_SIZE = 1 << 14
 BITMAP_INDEX = 0
 BLOOMFILTER_INDEX = 1
 
+STATS_MAGIC = b'ZMAP'
+MAX_DICT_SIZE = 64
 
-class NamedTuple(object):
+INDEX_MAGIC = b'RBMP'
+# a field with more distinct values in a file is not indexed, zone maps are
+# used for it instead
+MAX_INDEX_VALUES = 1 << 22
+
+
+def _startswith(value, prefix):
+    return isinstance(value, type(prefix)) and value.startswith(prefix)
+
+
+# filterByIndex(field__op=value)
+OPERATORS = {
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'lt': operator.lt,
+    'le': operator.le,
+    'startswith': _startswith,
+}
+
+
+class NamedTuple(tuple):
+    """ row of tabular files, a tuple whose fields are also attributes.
+
+        NamedTuple(fields, values) is an instance of the subclass generated
+        for the fields, in which each field is a property of its position.
+    """
+    __slots__ = ()
     _fields = []
-    _values = ()
 
-    def __init__(self, fields, values):
+    def __new__(cls, fields, values):
         if isinstance(fields, (str,)):
             fields = fields.replace(',', ' ').split()
 
-        fields = list(fields)
+        cls = row_class(fields)
         values = tuple(values)
-        if len(set(fields)) != len(fields):
-            raise ValueError('Duplicated field names!')
-
-        if len(fields) != len(values):
+        if len(cls._fields) != len(values):
             raise ValueError('Key/value length not match!')
 
-        self._fields = fields
-        self._values = values
+        return tuple.__new__(cls, values)
+
+    @property
+    def _values(self):
+        return tuple(self)
 
-    def __getattr__(self, key):
-        if key in self._fields:
-            return self._values[self._fields.index(key)]
-        return getattr(self._values, key)
+    def __reduce__(self):
+        return NamedTuple, (self._fields, tuple(self))
 
     def __repr__(self):
         return '<%s(%s)>' % (
-            self.__class__.__name__,
-            ', '.join('%s=%s' % (k, v) for k, v in zip(self._fields, self._values))
+            NamedTuple.__name__,
+            ', '.join('%s=%s' % (k, v) for k, v in zip(self._fields, self))
         )
 
-    def __nonzero__(self):
-        return bool(self._values)
 
-    def __len__(self):
-        return len(self._values)
+_row_classes = {}
 
-    def __getitem__(self, key):
-        return self._values[key]
 
-    def __iter__(self):
-        return iter(self._values)
+def row_class(fields):
+    """ the subclass of NamedTuple for fields, generated once per schema """
+    fields = tuple(fields)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        if len(set(fields)) != len(fields):
+            raise ValueError('Duplicated field names!')
 
-    def __contains__(self, item):
-        return item in self._values
+        attrs = {'__slots__': (), '_fields': list(fields)}
+        for i, field in enumerate(fields):
+            attrs[field] = property(operator.itemgetter(i))
+        cls = _row_classes[fields] = type(NamedTuple.__name__, (NamedTuple,), attrs)
+    return cls
 
 
 class AdaptiveIndex(object):
+    """ index of files written by older versions """
+
     def __init__(self):
         self.index = {}
         self.index_type = BITMAP_INDEX
@@ -128,6 +174,247 @@ class AdaptiveIndex(object):
         if self.index_type == BITMAP_INDEX:
             return chain(v.positions() for k, v in self.index.items() if fun(k))
 
+    def match(self, op, v, ids):
+        """ ids of stripes which may match the filter, None if unknown """
+        if op is not None or self.index_type != BITMAP_INDEX:
+            # hashes of the bloomfilter depend on refcounts in marshal of
+            # python 3, it may miss values
+            return None
+        if isinstance(v, types.FunctionType):
+            return ids & set(self.filter(v))
+        if not isinstance(v, list):
+            v = [v]
+        return set(_id for _id in ids if any(self.get(vv, _id) for vv in v))
+
+
+def _stripes_of(s):
+    return (s,) if isinstance(s, six.integer_types) else RoaringBitmap.loads(s)
+
+
+class BitmapIndex(object):
+    """ stripes of each distinct value of a field, queried by values,
+        functions, ranges and prefixes (op in OPERATORS)
+    """
+
+    def __init__(self):
+        self.index = {}  # value -> stripe id, or RoaringBitmap of stripes
+        self.sorted = False
+        self.values = []
+        self.stripes = []
+        self.nulls = None
+
+    def add(self, value, position):
+        index = self.index
+        if index is None:
+            return
+
+        s = index.get(value)
+        if s is None:
+            if len(index) >= MAX_INDEX_VALUES:
+                self.index = None  # too many values to be useful
+                return
+            index[value] = position
+        elif isinstance(s, RoaringBitmap):
+            s.add(position)
+        elif s != position:
+            index[value] = RoaringBitmap([s, position])
+
+    def dumps(self):
+        """ (sorted, values, stripes, null stripes) for the footer """
+        def dump(s):
+            return s.dumps() if isinstance(s, RoaringBitmap) else s
+
+        index = dict(self.index)
+        nulls = index.pop(None, None)
+        try:
+            values = sorted(index)
+            is_sorted = True
+        except TypeError:
+            values = list(index)
+            is_sorted = False
+        return (is_sorted, values, [dump(index[v]) for v in values],
+                None if nulls is None else dump(nulls))
+
+    @classmethod
+    def loads(cls, data):
+        self = cls()
+        self.index = None
+        self.sorted, self.values, self.stripes, self.nulls = data
+        return self
+
+    def _find(self, value):
+        """ position of value in values, -1 if missing """
+        if not self.sorted:
+            try:
+                return self.values.index(value)
+            except ValueError:
+                return -1
+        try:
+            i = bisect_left(self.values, value)
+        except TypeError:
+            return -1
+        return i if i < len(self.values) and self.values[i] == value else -1
+
+    def _range(self, op, v):
+        """ slice of sorted values matching value__op=v """
+        values = self.values
+        if op == 'startswith':
+            begin = end = bisect_left(values, v)
+            while end < len(values) and _startswith(values[end], v):
+                end += 1
+        elif op in ('gt', 'ge'):
+            begin = bisect_left(values, v)
+            if op == 'gt':
+                while begin < len(values) and values[begin] == v:
+                    begin += 1
+            end = len(values)
+        else:
+            begin = 0
+            end = bisect_left(values, v)
+            if op == 'le':
+                while end < len(values) and values[end] == v:
+                    end += 1
+        return range(begin, end)
+
+    def match(self, op, v, ids):
+        """ ids of stripes which may match the filter, None if unknown """
+        values = self.values
+        nulls = False
+        try:
+            if op is not None:
+                if self.sorted:
+                    found = self._range(op, v)
+                else:
+                    found = [i for i, x in enumerate(values) if OPERATORS[op](x, v)]
+            elif isinstance(v, types.FunctionType):
+                found = [i for i, x in enumerate(values) if v(x)]
+                nulls = self.nulls is not None and v(None)
+            else:
+                v = v if isinstance(v, list) else [v]
+                found = [self._find(x) for x in v if x is not None]
+                nulls = None in v
+        except Exception:
+            # values the function (or comparison) can not handle, leave the
+            # stripes to the zone maps
+            return None
+
+        result = set()
+        if nulls and self.nulls is not None:
+            result.update(_stripes_of(self.nulls))
+        for i in found:
+            if i >= 0:
+                result.update(_stripes_of(self.stripes[i]))
+                if len(result) >= len(ids) and result >= ids:
+                    break
+        return ids & result
+
+
+def dump_indices(indices):
+    data = dict((k, index.dumps()) for k, index in six.iteritems(indices)
+                if index.index is not None)
+    return INDEX_MAGIC + zlib.compress(marshal.dumps(data))
+
+
+def load_indices(data):
+    if data[:4] != INDEX_MAGIC:
+        return cPickle.loads(zlib.decompress(data))
+    data = marshal.loads(zlib.decompress(data[4:]))
+    return dict((k, BitmapIndex.loads(v)) for k, v in six.iteritems(data))
+
+
+def column_stats(values):
+    """ (min, max, null count, distinct count, distinct values) of a column in a stripe """
+    present = [v for v in values if v is not None]
+    nulls = len(values) - len(present)
+    try:
+        low, high = min(present), max(present)
+    except (TypeError, ValueError):
+        low = high = None
+
+    try:
+        distinct = set(present)
+    except TypeError:
+        return low, high, nulls, None, None
+    return low, high, nulls, len(distinct), distinct if len(distinct) <= MAX_DICT_SIZE else None
+
+
+def parse_filter(key):
+    """ field name and operator of a keyword of filterByIndex """
+    field, _, op = key.rpartition('__')
+    if field and op in OPERATORS:
+        return field, op
+    return key, None
+
+
+def match_filter(value, op, v):
+    if op is not None:
+        return value is not None and OPERATORS[op](value, v)
+    if isinstance(v, types.FunctionType):
+        return v(value)
+    if not isinstance(v, list):
+        v = [v]
+    return value in v
+
+
+def stripe_may_match(stats, op, v):
+    """ whether a stripe may have rows matching the filter, by its zone map """
+    low, high, nulls, ndv, values = stats
+    if nulls and op is None:
+        try:
+            if match_filter(None, op, v):
+                return True
+        except Exception:
+            return True
+    if values is not None:
+        return any(match_filter(x, op, v) for x in values)
+    if low is None or isinstance(v, types.FunctionType):
+        return True
+
+    try:
+        if op is None:
+            return any(low <= x <= high for x in (v if isinstance(v, list) else [v]))
+        if op == 'startswith':
+            return high >= v and (low <= v or _startswith(low, v))
+        if op in ('gt', 'ge'):
+            return OPERATORS[op](high, v)
+        return OPERATORS[op](low, v)
+    except TypeError:
+        return True
+
+
+def read_footer(f):
+    """ fields, indices and stats (None if missing) in the footer of a file """
+    fields, indices, stats, _ = _read_footer(f)
+    return fields, indices, stats
+
+
+def _read_footer(f, with_indices=True):
+    """ fields, indices, stats and the offset where the footer begins;
+        indices and stats are None unless with_indices
+    """
+    f.seek(-8, 2)
+    footer_fields_size, footer_indices_size = struct.unpack('II', f.read(8))
+    f.seek(-8 - footer_fields_size - footer_indices_size, 2)
+    footer_offset = f.tell()
+    indices = load_indices(f.read(footer_indices_size)) if with_indices else None
+    f.seek(footer_offset + footer_indices_size)
+    fields = marshal.loads(decompress(f.read(footer_fields_size)))
+
+    stats = None
+    if footer_offset >= 8:
+        # stats are before the indices, missing in older files
+        f.seek(footer_offset - 8)
+        stats_size, magic = struct.unpack('I4s', f.read(8))
+        if magic == STATS_MAGIC and stats_size <= footer_offset - 8:
+            footer_offset -= stats_size + 8
+            if with_indices:
+                f.seek(footer_offset)
+                try:
+                    stats = cPickle.loads(zlib.decompress(f.read(stats_size)))
+                except Exception:
+                    stats = None
+    return fields, indices, stats, footer_offset
+
 
 class TabularSplit(Split):
     def __init__(self, index, rdd, sp):
@@ -148,6 +435,8 @@ class TabularRDD(RDD):
             files = chain(self._get_files(p) for p in path)
 
         rdds = [TabularFileRDD(ctx, f, fields) for f in files]
+        self.path = path
+        self.fields = rdds[0].fields if rdds else None
         self._splits = []
         i = 0
         for rdd in rdds:
@@ -175,9 +464,51 @@ class TabularRDD(RDD):
     def compute(self, split):
         return split.rdd.iterator(split.split)
 
+    def get_fields(self):
+        """ fields of rows: those to read, or all fields of the first file """
+        if self.fields is not None or not self._splits:
+            return self.fields
+        with closing(self._splits[0].rdd.open_file()) as f:
+            return read_footer(f)[0]
+
+    def can_filter(self, filters):
+        """ whether stripes of every file can be skipped by filters
+            [(field, op)], by stats or indices in the footers
+        """
+        for dep in self._dependencies:
+            with closing(dep.rdd.open_file()) as f:
+                _, indices, stats = read_footer(f)
+            if stats is None and any(op is not None or k not in indices for k, op in filters):
+                return False
+        return True
+
+    def select_fields(self, fields):
+        """ the same files, reading only columns of fields """
+        return TabularRDD(self.ctx, self.path, fields, self.mem)
+
+    def asTable(self, fields=None, name=''):
+        return RDD.asTable(self, fields or self.get_fields(), name)
+
     def filterByIndex(self, **kw):
+        """ filters are field=value, field=[values], field=function,
+            or field__op=value with op in gt, ge, lt, le, startswith.
+            Stripes are skipped by indices or min/max of columns.
+        """
         return FilteredByIndexRDD(self, kw)
 
+    def mapStripes(self, f):
+        """ f(columns) of each stripe, without building rows; columns are
+            a NamedTuple of tuples of values, one per field.
+        """
+        return MappedStripesRDD(self, f)
+
+
+class MappedStripesRDD(MappedRDD):
+    def compute(self, split):
+        columns = split.rdd.read_stripe(split.split)
+        if columns is not None:
+            yield self.func(columns)
+
 
 class FilteredByIndexRDD(RDD):
     def __init__(self, rdd, filters):
@@ -213,40 +544,32 @@ class FilteredByIndexRDD(RDD):
             path, ids = v
             result_set = set(ids)
             with open(path, 'rb') as f:
-                f.seek(-8, 2)
-                footer_fields_size, footer_indices_size = struct.unpack('II', f.read(8))
-                f.seek(-8 - footer_fields_size - footer_indices_size, 2)
-                indices = cPickle.loads(zlib.decompress(f.read(footer_indices_size)))
-                _fields = marshal.loads(decompress(f.read(footer_fields_size)))
-                for k, v in six.iteritems(filters):
-                    result = set()
-                    if k not in _fields:
-                        raise RuntimeError('%s is not in fields!' % k)
-
-                    if k not in indices:
-                        raise RuntimeError('%s is not indexed' % k)
-
-                    index = indices[k]
-                    if isinstance(v, types.FunctionType):
-                        r = index.filter(v)
-                        if r is not None:
-                            result = set(r)
-                        else:
-                            result = result_set
+                _fields, indices, stats = read_footer(f)
+            for key, v in six.iteritems(filters):
+                k, op = parse_filter(key)
+                if k not in _fields:
+                    raise RuntimeError('%s is not in fields!' % k)
+
+                index = indices.get(k)
+                result = index.match(op, v, result_set) if index is not None else None
+                if result is None:
+                    if stats is not None:
+                        zone_maps = stats[k]
+                        result = set(_id for _id in result_set
+                                     if _id >= len(zone_maps) or
+                                     stripe_may_match(zone_maps[_id], op, v))
+                    elif index is not None and op is None:
+                        result = result_set
                     else:
-                        if not isinstance(v, list):
-                            v = [v]
+                        raise RuntimeError('%s is not indexed' % k)
 
-                        for vv in v:
-                            for _id in result_set:
-                                if index.get(vv, _id):
-                                    result.add(_id)
-            return path, result
+                result_set = result
+            return path, result_set
 
         sp_dict = {}
         for sp in self.rdd.splits:
             path = sp.rdd.path
-            _id = sp.split.begin / STRIPE_SIZE
+            _id = sp.split.begin // STRIPE_SIZE
             if path not in sp_dict:
                 sp_dict[path] = [_id]
             else:
@@ -258,25 +581,17 @@ class FilteredByIndexRDD(RDD):
         splits = []
         for sp in self.rdd.splits:
             path = sp.rdd.path
-            _id = sp.split.begin / STRIPE_SIZE
+            _id = sp.split.begin // STRIPE_SIZE
             if _id in path_ids_filter[path]:
                 splits.append(sp)
         return splits
 
     def compute(self, split):
+        filters = [parse_filter(k) + (v,) for k, v in six.iteritems(self.filters)]
         for t in self.rdd.iterator(split):
-            for k, v in six.iteritems(self.filters):
-                value = getattr(t, k)
-                if isinstance(v, types.FunctionType):
-                    if not v(value):
-                        break
-
-                else:
-                    if not isinstance(v, list):
-                        v = [v]
-
-                    if value not in v:
-                        break
+            for k, op, v in filters:
+                if not match_filter(getattr(t, k), op, v):
+                    break
             else:
                 yield t
 
@@ -289,21 +604,16 @@ class TabularFileRDD(TextFileRDD):
 
         self.fields = list(map(str, fields)) if fields is not None else None
 
-    def compute(self, split):
+    def read_stripe(self, split):
+        """ columns of the stripe in split as a NamedTuple of tuples,
+            None if the split is in the footer
+        """
         with closing(self.open_file()) as f:
-            f.seek(-8, 2)
-            footer_fields_size, footer_indices_size = struct.unpack('II', f.read(8))
-            footer_offset = self.size - 8 - footer_fields_size - footer_indices_size
-            footer_fields_offset = self.size - 8 - footer_fields_size
+            _fields, _, _, footer_offset = _read_footer(f, with_indices=False)
             if split.begin >= footer_offset:
-                return
+                return None
 
             start = split.begin
-            end = min(split.end, footer_offset)
-            stripe_id = start / STRIPE_SIZE
-            f.seek(footer_fields_offset)
-            _fields = marshal.loads(decompress(f.read(footer_fields_size)))
-
             if self.fields is None:
                 field_ids = list(range(len(_fields)))
                 field_names = _fields
@@ -329,8 +639,17 @@ class TabularFileRDD(TextFileRDD):
                 else:
                     f.seek(size, 1)
 
-            for r in zip(*content):
-                yield NamedTuple(field_names, r)
+            return NamedTuple(field_names, content)
+
+    def compute(self, split):
+        columns = self.read_stripe(split)
+        if columns is None:
+            return
+
+        cls = row_class(columns._fields)
+        new = tuple.__new__
+        for r in zip(*columns):
+            yield new(cls, r)
 
 
 class OutputTabularRDD(RDD):
@@ -379,7 +698,12 @@ class OutputTabularRDD(RDD):
         buffers = [list() for i in self.fields]
         remain_size = STRIPE_DATA_SIZE
         path = os.path.join(self.path, '%04d.dt' % split.index)
-        indices = dict((i, AdaptiveIndex()) for i in self.indices)
+        indices = dict((i, BitmapIndex()) for i in self.indices)
+        stats = dict((i, []) for i in self.fields)
+
+        def add_stats(buffers):
+            for field, b in zip(self.fields, buffers):
+                stats[field].append(column_stats(b))
 
         def write_stripe(f, compressed, header, padding=True):
             h = compress(marshal.dumps(header))
@@ -392,7 +716,7 @@ class OutputTabularRDD(RDD):
                 padding_size -= len(c)
 
             if padding:
-                f.write('\0' * padding_size)
+                f.write(b'\0' * padding_size)
 
         with atomic_file(path) as f:
             stripe_id = 0
@@ -408,6 +732,7 @@ class OutputTabularRDD(RDD):
                     _remain_size = STRIPE_DATA_SIZE - sum(_sizes)
                     if size > _remain_size:
                         write_stripe(f, compressed, _sizes)
+                        add_stats(buffers)
                         buffers = [list() for i in self.fields]
                         remain_size = STRIPE_DATA_SIZE
                         stripe_id += 1
@@ -425,8 +750,12 @@ class OutputTabularRDD(RDD):
                 compressed = [compress(marshal.dumps(tuple(b))) for b in buffers]
                 _sizes = tuple(map(len, compressed))
                 write_stripe(f, compressed, _sizes, False)
+                add_stats(buffers)
 
-            footer_indices = zlib.compress(cPickle.dumps(indices, -1))
+            footer_stats = zlib.compress(cPickle.dumps(stats, -1))
+            f.write(footer_stats)
+            f.write(struct.pack('I4s', len(footer_stats), STATS_MAGIC))
+            footer_indices = dump_indices(indices)
             footer_fields = compress(marshal.dumps(self.fields))
             f.write(footer_indices)
             f.write(footer_fields)
@@ -62,12 +62,13 @@ class TaskSet(object):
     """
 
     def __init__(self, sched, tasks, cpus=1, mem=100, gpus=0,
-                 task_host_manager=None):
+                 task_host_manager=None, priority=0):
         self.start_time = time.time()
         self.sched = sched
         self.tasks = tasks
         self.id = tasks[0].taskset_id
         self.ttids = set()
+        self.priority = priority  # tasksets with higher priority get offers first
 
         for t in self.tasks:
             t.status = None
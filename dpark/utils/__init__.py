@@ -7,11 +7,14 @@ import errno
 import uuid
 import time
 import platform
+import socket
+import struct
 import tempfile
 import os.path
 from contextlib import contextmanager
 from zlib import compress as _compress
 from dpark.utils.crc32c import crc32c
+from dpark.utils.log import get_logger
 
 try:
     from dpark.portable_hash import portable_hash as _hash
@@ -21,6 +24,8 @@ except ImportError:
     pyximport.install(inplace=True)
     from dpark.portable_hash import portable_hash as _hash
 
+logger = get_logger(__name__)
+
 try:
     import pwd
 
@@ -65,6 +70,22 @@ def spawn(target, *args, **kw):
     return t
 
 
+_hostnames = {}
+
+
+def get_hostname(addr):
+    """ host name of an ip address, resolved once in a process """
+    name = _hostnames.get(addr)
+    if name is None:
+        try:
+            name = socket.gethostbyaddr(addr)[0]
+        except (IOError, OSError) as e:
+            logger.warning('get hostname exec %s for loc %s', e, addr)
+            name = addr
+        _hostnames[addr] = name
+    return name
+
+
 # hash(None) is id(None), different from machines
 # http://effbot.org/zone/python-hash.htm
 def portable_hash(value):
@@ -213,5 +234,36 @@ def masked_crc32c(s):
     return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
 
 
+try:
+    from dpark.utils.crc32c import find_tfrecord, parse_tfrecords
+except ImportError:
+    # built by older versions
+    def find_tfrecord(buf, start=0):
+        """ offset of the first TFRecord header at or after start, -1 if not found """
+        for i in range(max(start, 0), len(buf) - 11):
+            if masked_crc32c(buf[i:i + 8]) == struct.unpack('<I', buf[i + 8:i + 12])[0]:
+                return i
+        return -1
+
+    def parse_tfrecords(buf, pos=0, limit=-1):
+        """ complete records beginning in [pos, limit) (None if data is corrupted),
+            and the offset after them
+        """
+        if limit < 0 or limit > len(buf):
+            limit = len(buf)
+        records = []
+        while pos < limit and pos + 12 <= len(buf):
+            length, length_mask = struct.unpack_from('<QI', buf, pos)
+            if masked_crc32c(buf[pos:pos + 8]) != length_mask:
+                raise ValueError('Not a valid TFRecord at %d' % pos)
+            if pos + length + 16 > len(buf):
+                break
+            data = buf[pos + 12:pos + 12 + length]
+            data_mask, = struct.unpack_from('<I', buf, pos + 12 + length)
+            records.append(data if masked_crc32c(data) == data_mask else None)
+            pos += length + 16
+        return records, pos
+
+
 def sec2nanosec(t):
     return t * 10**9
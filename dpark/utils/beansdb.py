@@ -7,8 +7,12 @@ import socket
 import time
 import struct
 import zlib
+from array import array
+from collections import OrderedDict
+from io import BytesIO
 from dpark.utils.log import get_logger
 from dpark.file_manager import open_file
+from dpark.file_manager.fs import ReadAhead
 from dpark.serialize import load_func, dump_func
 from contextlib import closing
 import six
@@ -144,7 +148,7 @@ def read_record(f, check_crc=False):
     return (rsize, key, ((flag, value), ver, tstamp)), None
 
 
-def write_record(f, key, flag, value, version, ts):
+def pack_record(key, flag, value, version, ts):
     err = check_size(len(key), len(value))
     if err:
         raise Exception(err)
@@ -153,21 +157,148 @@ def write_record(f, key, flag, value, version, ts):
     crc32 = binascii.crc32(header)
     crc32 = binascii.crc32(key, crc32)
     crc32 = binascii.crc32(value, crc32) & 0xffffffff
-    f.write(struct.pack("I", crc32))
-    f.write(header)
-    f.write(key)
-    f.write(value)
     rsize = 24 + len(key) + len(value)
-    if rsize & 0xff:
-        f.write(b'\x00' * (PADDING - (rsize & 0xff)))
-        rsize = ((rsize >> 8) + 1) << 8
-    return rsize
+    padding = b'\x00' * (-rsize & 0xff)
+    return b''.join([struct.pack("I", crc32), header, key, value, padding])
+
+
+def write_record(f, key, flag, value, version, ts):
+    record = pack_record(key, flag, value, version, ts)
+    f.write(record)
+    return len(record)
+
+
+try:
+    from dpark.utils.crc32c import parse_beansdb
+except ImportError:
+    # built by older versions
+    def parse_beansdb(buf, pos=0, limit=-1):
+        """ complete records beginning in [pos, limit), the offset after them,
+            and whether it stops at a header of bad sizes
+        """
+        n = len(buf)
+        if limit < 0 or limit > n:
+            limit = n
+        records = []
+        unpack_from = struct.Struct("IiiiII").unpack_from
+        while pos < limit and pos + 24 <= n:
+            _, tstamp, flag, ver, ksz, vsz = unpack_from(buf, pos)
+            if check_size(ksz, vsz):
+                return records, pos, True
+            rsize = (24 + ksz + vsz + PADDING - 1) & ~(PADDING - 1)
+            if rsize > n - pos:
+                break
+            p = pos + 24
+            records.append((buf[p:p + ksz], ((flag, buf[p + ksz:p + ksz + vsz]), ver, tstamp)))
+            pos += rsize
+        return records, pos, False
+
+
+def read_hint(hint_path):
+    with open(hint_path, 'rb') as f:
+        hint = f.read()
+
+    if hint_path.endswith('.qlz'):
+        try:
+            hint = quicklz.decompress(hint)
+        except ValueError as e:
+            msg = str(e)
+            if msg.startswith('compressed length not match'):
+                hint = hint[:int(msg.split('!=')[1])]
+                hint = quicklz.decompress(hint)
+    return hint
+
+
+class HintIndex(object):
+    """ parsed entries of a hint file, kept in arrays:
+        positions (with the key size in the lowest byte), versions,
+        and the keys joined in one bytes object.
+    """
+
+    def __init__(self, hint):
+        self.positions = array('I')
+        self.versions = array('i')
+        self.offsets = array('I')
+        keys = []
+        off = 0  # of the key in self.keys
+        p = 0
+        n = len(hint)
+        while p < n:
+            pos, ver, _ = struct.unpack_from("IiH", hint, p)
+            p += 10
+            ksz = pos & 0xff
+            self.positions.append(pos)
+            self.versions.append(ver)
+            self.offsets.append(off)
+            keys.append(hint[p: p + ksz])
+            off += ksz
+            p += ksz + 1  # \x00
+        self.keys = b''.join(keys)
+        self._lookup = None  # key -> [index]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def key(self, i):
+        off = self.offsets[i]
+        return self.keys[off: off + (self.positions[i] & 0xff)]
+
+    def iter_keys(self):
+        keys, offsets, positions = self.keys, self.offsets, self.positions
+        for i in range(len(positions)):
+            off = offsets[i]
+            yield keys[off: off + (positions[i] & 0xff)]
+
+    def filter(self, key_filter):
+        """ indices of entries whose key pass key_filter """
+        return [i for i, key in enumerate(self.iter_keys()) if key_filter(key)]
+
+    def find(self, keys):
+        """ indices of entries of keys, without scanning all of them """
+        if self._lookup is None:
+            lookup = {}
+            for i, key in enumerate(self.iter_keys()):
+                lookup.setdefault(key, []).append(i)
+            self._lookup = lookup
+        found = []
+        for key in keys:
+            found.extend(self._lookup.get(key, ()))
+        return found
+
+
+# hint indexes kept by a process, which only helps when a process runs many
+# tasks (local and process modes): a task of Mesos executors has a process of
+# its own, and reads one data file by its hint
+HINT_CACHE_SIZE = 8  # files
+_hint_cache = OrderedDict()
+
+
+def load_hint_index(hint_path):
+    """ the HintIndex of a hint file, cached by path, size and mtime """
+    st = os.stat(hint_path)
+    cache_key = (hint_path, st.st_size, st.st_mtime)
+    index = _hint_cache.pop(cache_key, None)
+    if index is None:
+        index = HintIndex(read_hint(hint_path))
+    _hint_cache[cache_key] = index
+    while len(_hint_cache) > HINT_CACHE_SIZE:
+        _hint_cache.popitem(last=False)
+    return index
 
 
 class BeansdbReader(object):
+    # records nearer than this are read with one read
+    COALESCE_GAP = 256 << 10
+    MAX_READ_SIZE = 16 << 20
+    READ_SIZE = 4 << 20  # of full scan
 
     def __init__(self, path, key_filter=None, fullscan=False, raw=False):
-        if key_filter is None:
+        self.keys = None
+        if key_filter is not None and not callable(key_filter):
+            self.keys = frozenset(k.encode('utf-8') if isinstance(k, six.text_type) else k
+                                  for k in key_filter)
+            key_filter = None
+        elif key_filter is None:
             fullscan = True
         self.path = path
         self.key_filter = key_filter
@@ -190,104 +321,160 @@ class BeansdbReader(object):
         except Exception:
             raise
 
-    def read(self, begin, end):
+    def get_key_filter(self):
+        if self.keys is not None:
+            return self.keys.__contains__
+        return self.key_filter or (lambda x: True)
+
+    def read(self, begin, end, threads=0):
+        """ threads: number of threads to restore values in full scan """
         if self.fullscan:
-            return self.full_scan(begin, end)
+            return self.full_scan(begin, end, threads)
         hint = self.path[:-5] + '.hint.qlz'
         if os.path.exists(hint):
             return self.scan_hint(hint)
         hint = self.path[:-5] + '.hint'
         if os.path.exists(hint):
             return self.scan_hint(hint)
-        return self.full_scan(begin, end)
+        return self.full_scan(begin, end, threads)
 
     def scan_hint(self, hint_path):
-        with open(hint_path, 'rb') as f:
-            hint = f.read()
-
-        if hint_path.endswith('.qlz'):
-            try:
-                hint = quicklz.decompress(hint)
-            except ValueError as e:
-                msg = str(e)
-                if msg.startswith('compressed length not match'):
-                    hint = hint[:int(msg.split('!=')[1])]
-                    hint = quicklz.decompress(hint)
+        index = load_hint_index(hint_path)
+        if self.keys is not None:
+            found = index.find(self.keys)
+        else:
+            found = index.filter(self.get_key_filter())
+        positions = sorted(set(index.positions[i] & 0xffffff00 for i in found))
 
-        key_filter = self.key_filter or (lambda x: True)
         with open(self.path, 'rb') as dataf:
-            p = 0
-            while p < len(hint):
-                pos, ver, _ = struct.unpack("IiH", hint[p:p + 10])
-                p += 10
-                ksz = pos & 0xff
-                key = hint[p: p + ksz]
-                if key_filter(key):
-                    dataf.seek(pos & 0xffffff00)
-                    r, err = read_record(dataf)
-                    if err is not None:
-                        logger.error("read failed from %s at %d",
-                                     self.path, pos & 0xffffff00)
-                    else:
-                        rsize, key, value = r
-                        value, err = self.restore(value)
-                        if not err:
-                            yield key, value
-                p += ksz + 1  # \x00
+            for pos, r, err in self.read_records(dataf, positions):
+                if err is not None:
+                    logger.error("read failed from %s at %d", self.path, pos)
+                else:
+                    rsize, key, value = r
+                    value, err = self.restore(value)
+                    if not err:
+                        yield key, value
+
+    def read_records(self, f, positions):
+        """ records at sorted positions, nearby ones are read together """
+        i = 0
+        n = len(positions)
+        while i < n:
+            start = positions[i]
+            j = i + 1
+            while (j < n and positions[j] - positions[j - 1] <= self.COALESCE_GAP
+                   and positions[j] - start < self.MAX_READ_SIZE):
+                j += 1
+            f.seek(start)
+            data = f.read(positions[j - 1] + PADDING - start)
+            buf = BytesIO(data)
+            for pos in positions[i:j]:
+                buf.seek(pos - start)
+                r, err = read_record(buf)
+                if err is not None and err.startswith('EOF') and pos - start + 24 <= len(data):
+                    # the record ends after buf, f is at the end of buf
+                    ksz, vsz = struct.unpack_from('II', data, pos - start + 16)
+                    if not check_size(ksz, vsz):
+                        data += f.read(pos - start + 24 + ksz + vsz + PADDING - len(data))
+                        buf = BytesIO(data)
+                        buf.seek(pos - start)
+                        r, err = read_record(buf)
+                yield pos, r, err
+            i = j
 
     def restore(self, value):
         err = None
         if not self.raw:
             try:
-                value = restore_value(*value)
+                (flag, val), ver, tstamp = value
+                value = restore_value(flag, val), ver, tstamp
             except Exception as e:
                 err = "restore expection: %s value %s" % (e, value)
                 logger.error(err)
         return value, err
 
+    def restore_records(self, records):
+        result = []
+        for key, value in records:
+            value, err = self.restore(value)
+            if not err:
+                result.append((key, value))
+        return result
+
     def open_file(self):
         return open_file(self.path)
 
-    def full_scan(self, begin, end):
-        with closing(self.open_file()) as f:
-            # try to find first record
-            while True:
+    def seek_record(self, f, begin, end):
+        """ offset of the first record with right crc in [begin, end), or end """
+        while begin < end:
+            f.seek(begin)
+            r, err = read_record(f, check_crc=True)
+            if err is None:
+                return begin
+            begin += PADDING
+        return end
+
+    def read_chunks(self, f, begin, end):
+        """ lists of records beginning in [begin, end), parsed from chunks of READ_SIZE """
+        key_filter = self.get_key_filter()
+        f.seek(begin)
+        buf = b''
+        base = begin  # offset of buf in file
+        while True:
+            records, pos, bad = parse_beansdb(buf, begin - base, end - base)
+            records = [r for r in records if key_filter(r[0])]
+            if records:
+                yield records
+
+            begin = base + pos
+            if begin >= end:
+                return
+            if bad:
+                logger.error('read error at %s pos: %d err: %s', self.path, begin,
+                             check_size(*struct.unpack_from("II", buf, pos + 16)))
+                begin = self.seek_record(f, begin + PADDING, end)
                 f.seek(begin)
-                r, err = read_record(f, check_crc=True)
-                if err is None:
-                    break
-                begin += PADDING
-                if begin >= end:
-                    break
+                buf = b''
+                base = begin
+                continue
+
+            size = self.READ_SIZE
+            if len(buf) - pos >= 24:
+                ksz, vsz = struct.unpack_from("II", buf, pos + 16)
+                size = max(size, 24 + ksz + vsz + PADDING - (len(buf) - pos))
+            data = f.read(size)
+            if not data:
+                if pos < len(buf):
+                    logger.error('read error at %s pos: %d err: %s', self.path, begin, 'EOF data')
+                return
+            buf = buf[pos:] + data
+            base = begin
+
+    def full_scan(self, begin, end, threads=0):
+        with closing(self.open_file()) as f:
+            # try to find first record, records are aligned to PADDING
+            begin = self.seek_record(f, (begin + PADDING - 1) // PADDING * PADDING, end)
             if begin >= end:
                 return
 
-            f.seek(begin)
-            key_filter = self.key_filter or (lambda x: True)
-            while begin < end:
-                r, err = read_record(f)
-                if err:
-                    logger.error('read error at %s pos: %d err: %s',
-                                 self.path, begin, err)
-                    if err == "EOF":
-                        return
-                    begin += PADDING
-                    while begin < end:
-                        f.seek(begin)
-                        r, err = read_record(f, check_crc=True)
-                        if err is not None:
-                            break
-                        begin += PADDING
-                    continue
-                size, key, value = r
-                if key_filter(key):
-                    value, err = self.restore(value)
-                    if not err:
-                        yield key, value
-                begin += size
+            chunks = self.read_chunks(f, begin, end)
+            if not self.raw:
+                chunks = ReadAhead(self.restore_records, ((rs,) for rs in chunks), threads)
+            try:
+                for records in chunks:
+                    for r in records:
+                        yield r
+            finally:
+                if not self.raw:
+                    chunks.close()
 
 
 class BeansdbWriter(object):
+    BUFFER_SIZE = 32 << 20  # of all files written by a task
+    # hint files are compressed in memory as one quicklz block (the format of
+    # beansdb), larger ones are kept uncompressed
+    MAX_COMPRESS_HINT_SIZE = 64 << 20
 
     def __init__(self, path, depth, overwrite, compress=False,
                  raw=False, value_with_meta=False):
@@ -319,7 +506,7 @@ class BeansdbWriter(object):
 
         return prepare_value(val, self.compress)
 
-    def write_record(self, f, key, value, now):
+    def pack_record(self, key, value, now):
         if self.value_with_meta:
             value, version, ts = value
         else:
@@ -329,12 +516,19 @@ class BeansdbWriter(object):
             flag, value = value
         else:
             flag, value = self.prepare(value)
-        return write_record(f, key, flag, value, version, ts)
+        return pack_record(key, flag, value, version, ts)
 
     def write_bucket(self, it, index):
         """ 0 <= index < 256
             yield from it
             write to  "*/%03d.data" % index
+
+            records and hint entries are kept in buffers of each file, and
+            the largest buffer is appended to its temp file when all of them
+            exceed BUFFER_SIZE, so no file is kept open.
+
+            with compress, a hint file up to MAX_COMPRESS_HINT_SIZE is read
+            and compressed in memory as a whole.
         """
         N = 16 ** self.depth
         if self.depth > 0:
@@ -344,12 +538,28 @@ class BeansdbWriter(object):
             ds = [self.path]
         pname = '%03d.data' % index
         tname = '.%03d.data.%s.tmp' % (index, socket.gethostname())
+        hname = '.%03d.hint.%s.tmp' % (index, socket.gethostname())
         p = [os.path.join(d, pname) for d in ds]
         tp = [os.path.join(d, tname) for d in ds]
+        hp = [os.path.join(d, hname) for d in ds]
         pos = [0] * N
-        f = [open(t, 'wb', 1 << 20) for t in tp]
+        data = [bytearray() for d in ds]
+        hint = [bytearray() for d in ds]
+        written = [False] * N  # temp files are created
         now = int(time.time())
-        hint = [[] for d in ds]
+        buffered = 0
+
+        def flush(i):
+            mode = 'ab' if written[i] else 'wb'
+            with open(tp[i], mode) as f:
+                f.write(data[i])
+            with open(hp[i], mode) as f:
+                f.write(hint[i])
+            written[i] = True
+            size = len(data[i]) + len(hint[i])
+            data[i] = bytearray()
+            hint[i] = bytearray()
+            return size
 
         bits = 32 - self.depth * 4
         for key, value in it:
@@ -365,22 +575,36 @@ class BeansdbWriter(object):
 
             i = fnv1a(key) >> bits
 
-            hint[i].append(struct.pack("IIH", pos[i] + len(key), 1, 0) + key + b'\x00')
-            pos[i] += self.write_record(f[i], key, value, now)
-        for i in f:
-            i.close()
+            hint[i] += struct.pack("IIH", pos[i] + len(key), 1, 0) + key + b'\x00'
+            record = self.pack_record(key, value, now)
+            data[i] += record
+            pos[i] += len(record)
+            buffered += len(record) + len(key) + 11
+            if buffered > self.BUFFER_SIZE:
+                largest = max(range(N), key=lambda j: len(data[j]))
+                buffered -= flush(largest)
 
+        result = []
         for i in range(N):
-            if hint[i] and not os.path.exists(p[i]):
-                os.rename(tp[i], p[i])
-                hintdata = b''.join(hint[i])
-                hint_path = os.path.join(os.path.dirname(p[i]), '%03d.hint' % index)
-                if self.compress:
-                    hintdata = quicklz.compress(hintdata)
-                    hint_path += '.qlz'
-                with open(hint_path, 'wb') as f:
-                    f.write(hintdata)
-            else:
+            if data[i]:
+                flush(i)
+            if not written[i]:
+                continue
+
+            if os.path.exists(p[i]):
                 os.remove(tp[i])
+                os.remove(hp[i])
+                continue
+
+            os.rename(tp[i], p[i])
+            hint_path = os.path.join(ds[i], '%03d.hint' % index)
+            if self.compress and os.path.getsize(hp[i]) <= self.MAX_COMPRESS_HINT_SIZE:
+                with open(hp[i], 'rb') as f:
+                    hintdata = quicklz.compress(f.read())
+                with open(hp[i], 'wb') as f:
+                    f.write(hintdata)
+                hint_path += '.qlz'
+            os.rename(hp[i], hint_path)
+            result.append(p[i])
 
-        return sum([([p[i]] if hint[i] else []) for i in range(N)], [])
+        return result
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 import marshal
 import math
+import struct
+from array import array
+from bisect import bisect_left
 from dpark.portable_hash import portable_hash
 from six.moves import range
 from functools import reduce
@@ -13,6 +16,11 @@ BYTE_MASK = BYTE_SIZE - 1
 
 _table = [(), (0,), (1,), (0, 1), (2,), (0, 2), (1, 2), (0, 1, 2), (3,),
           (0, 3), (1, 3), (0, 1, 3), (2, 3), (0, 2, 3), (1, 2, 3), (0, 1, 2, 3)]
+_bits = [len(_table[i & 0xF]) + len(_table[i >> 4]) for i in range(256)]
+
+# containers of RoaringBitmap with more values are bitmaps
+ROARING_ARRAY_SIZE = 4096
+ROARING_BITMAP_BYTES = 1 << 13
 
 
 class BitIndex(object):
@@ -167,3 +175,161 @@ class Bloomfilter(object):
 
     def __contains__(self, obj):
         return next(self._match([obj]))
+
+
+def _bitmap_values(bitmap, base=0):
+    for i, byte in enumerate(bitmap):
+        if byte:
+            for x in _table[byte & 0xF]:
+                yield base + i * BYTE_SIZE + x
+            for x in _table[byte >> 4]:
+                yield base + i * BYTE_SIZE + 4 + x
+
+
+def _to_bitmap(values):
+    bitmap = bytearray(ROARING_BITMAP_BYTES)
+    for v in values:
+        bitmap[v >> BYTE_SHIFT] |= 1 << (v & BYTE_MASK)
+    return bitmap
+
+
+class RoaringBitmap(object):
+    """ compressed set of ints in [0, 2^32), in containers of 2^16 ints: a
+        sorted array of the low 16 bits if there are at most
+        ROARING_ARRAY_SIZE of them, otherwise a bitmap of 8KB.
+    """
+    __slots__ = ('keys', 'containers')
+
+    def __init__(self, positions=()):
+        self.keys = []  # high 16 bits, sorted
+        self.containers = []  # array('H') or bytearray
+        for pos in positions:
+            self.add(pos)
+
+    def _find(self, high):
+        keys = self.keys
+        if keys and keys[-1] == high:
+            return len(keys) - 1
+        i = bisect_left(keys, high)
+        return i if i < len(keys) and keys[i] == high else -1
+
+    def add(self, pos):
+        if not 0 <= pos < 1 << 32:
+            raise ValueError('pos must be in [0, 2^32)!')
+
+        high, low = pos >> 16, pos & 0xFFFF
+        i = self._find(high)
+        if i < 0:
+            i = bisect_left(self.keys, high)
+            self.keys.insert(i, high)
+            self.containers.insert(i, array('H', [low]))
+            return
+
+        c = self.containers[i]
+        if isinstance(c, bytearray):
+            c[low >> BYTE_SHIFT] |= 1 << (low & BYTE_MASK)
+            return
+
+        if low > c[-1]:
+            c.append(low)
+        else:
+            j = bisect_left(c, low)
+            if c[j] == low:
+                return
+            c.insert(j, low)
+        if len(c) > ROARING_ARRAY_SIZE:
+            self.containers[i] = _to_bitmap(c)
+
+    def __contains__(self, pos):
+        if not 0 <= pos < 1 << 32:
+            return False
+        i = self._find(pos >> 16)
+        if i < 0:
+            return False
+        c = self.containers[i]
+        low = pos & 0xFFFF
+        if isinstance(c, bytearray):
+            return (c[low >> BYTE_SHIFT] & (1 << (low & BYTE_MASK))) != 0
+        j = bisect_left(c, low)
+        return j < len(c) and c[j] == low
+
+    def __iter__(self):
+        for high, c in zip(self.keys, self.containers):
+            base = high << 16
+            if isinstance(c, bytearray):
+                for v in _bitmap_values(c, base):
+                    yield v
+            else:
+                for v in c:
+                    yield base + v
+
+    def __len__(self):
+        return sum(sum(_bits[b] for b in c) if isinstance(c, bytearray) else len(c)
+                   for c in self.containers)
+
+    def __eq__(self, other):
+        return isinstance(other, RoaringBitmap) and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __or__(self, other):
+        r = RoaringBitmap()
+        a = dict(zip(self.keys, self.containers))
+        b = dict(zip(other.keys, other.containers))
+        for high in sorted(set(a) | set(b)):
+            x, y = a.get(high), b.get(high)
+            if x is None or y is None:
+                c = x if y is None else y
+                c = bytearray(c) if isinstance(c, bytearray) else array('H', c)
+            elif isinstance(x, bytearray) or isinstance(y, bytearray):
+                if not isinstance(x, bytearray):
+                    x, y = y, x
+                c = bytearray(x)
+                if isinstance(y, bytearray):
+                    for i, byte in enumerate(y):
+                        c[i] |= byte
+                else:
+                    for v in y:
+                        c[v >> BYTE_SHIFT] |= 1 << (v & BYTE_MASK)
+            else:
+                values = sorted(set(x) | set(y))
+                if len(values) > ROARING_ARRAY_SIZE:
+                    c = _to_bitmap(values)
+                else:
+                    c = array('H', values)
+            r.keys.append(high)
+            r.containers.append(c)
+        return r
+
+    def dumps(self):
+        """ count of containers, then (high, size, values) of each, size is
+            0 for a bitmap
+        """
+        out = [struct.pack('<I', len(self.keys))]
+        for high, c in zip(self.keys, self.containers):
+            if isinstance(c, bytearray):
+                out.append(struct.pack('<HH', high, 0))
+                out.append(bytes(c))
+            else:
+                out.append(struct.pack('<HH', high, len(c)))
+                out.append(struct.pack('<%dH' % len(c), *c))
+        return b''.join(out)
+
+    @classmethod
+    def loads(cls, data):
+        r = cls()
+        n, = struct.unpack_from('<I', data)
+        pos = 4
+        for _ in range(n):
+            high, size = struct.unpack_from('<HH', data, pos)
+            pos += 4
+            if size:
+                c = array('H', struct.unpack_from('<%dH' % size, data, pos))
+                pos += size * 2
+            else:
+                c = bytearray(data[pos:pos + ROARING_BITMAP_BYTES])
+                pos += ROARING_BITMAP_BYTES
+            r.keys.append(high)
+            r.containers.append(c)
+        return r
@@ -1,5 +1,6 @@
 #include <Python.h>
 #include <stdint.h>
+#include <string.h>
 
 uint32_t crc32c(const void *buf, size_t len, uint32_t crc);
 uint32_t crc32c_sw(uint32_t crci, const void *buf, size_t len);
@@ -32,8 +33,196 @@ crc32c_crc32c(PyObject *self, PyObject *args)
     return PyLong_FromLong(result);
 }
 
+static uint32_t
+masked_crc32c(const unsigned char *buf, size_t len, int hw)
+{
+    uint32_t crc = hw ? crc32c(buf, len, 0U) : crc32c_sw(0U, buf, len);
+    return ((crc >> 15) | (crc << 17)) + 0xa282ead8U;
+}
+
+static uint32_t
+load_le32(const unsigned char *p)
+{
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8) |
+        ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+PyDoc_STRVAR(doc_find_tfrecord,
+"(bytes, start = 0) -> offset. Find the first TFRecord header at or after start,\n"
+"whose 8 bytes of length are followed by their masked CRC-32c, -1 if not found");
+
+static PyObject *
+crc32c_find_tfrecord(PyObject *self, PyObject *args)
+{
+    Py_buffer pbin;
+    const unsigned char *p;
+    Py_ssize_t start = 0, i, n, result = -1;
+    int hw;
+
+    if ( !PyArg_ParseTuple(args, "s*|n:find_tfrecord", &pbin, &start) )
+        return NULL;
+
+    p = pbin.buf;
+    n = pbin.len;
+    if (start < 0)
+        start = 0;
+    hw = __builtin_cpu_supports("sse4.2");
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = start; i + 12 <= n; i++) {
+        if (masked_crc32c(p + i, 8, hw) == load_le32(p + i + 8)) {
+            result = i;
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&pbin);
+    return PyLong_FromSsize_t(result);
+}
+
+PyDoc_STRVAR(doc_parse_tfrecords,
+"(bytes, pos = 0, limit = -1) -> (records, pos). Parse complete TFRecords\n"
+"beginning in [pos, limit), a record is None if the CRC of its data is wrong.\n"
+"Raise ValueError if a header is not valid");
+
+static PyObject *
+crc32c_parse_tfrecords(PyObject *self, PyObject *args)
+{
+    Py_buffer pbin;
+    const unsigned char *p;
+    Py_ssize_t pos = 0, limit = -1, n;
+    unsigned long long length;
+    PyObject *records, *item;
+    int hw;
+
+    if ( !PyArg_ParseTuple(args, "s*|nn:parse_tfrecords", &pbin, &pos, &limit) )
+        return NULL;
+
+    p = pbin.buf;
+    n = pbin.len;
+    if (limit < 0 || limit > n)
+        limit = n;
+    hw = __builtin_cpu_supports("sse4.2");
+
+    records = PyList_New(0);
+    if (records == NULL)
+        goto error;
+
+    while (pos < limit && pos + 12 <= n) {
+        if (masked_crc32c(p + pos, 8, hw) != load_le32(p + pos + 8)) {
+            PyErr_Format(PyExc_ValueError, "Not a valid TFRecord at %zd", pos);
+            goto error;
+        }
+        length = (unsigned long long)load_le32(p + pos) |
+            ((unsigned long long)load_le32(p + pos + 4) << 32);
+        if (n - pos < 16 || length > (unsigned long long)(n - pos - 16))
+            break;
+
+        if (masked_crc32c(p + pos + 12, (size_t)length, hw) == load_le32(p + pos + 12 + length)) {
+            item = PyBytes_FromStringAndSize((const char *)p + pos + 12, (Py_ssize_t)length);
+            if (item == NULL)
+                goto error;
+        } else {
+            Py_INCREF(Py_None);
+            item = Py_None;
+        }
+        if (PyList_Append(records, item) < 0) {
+            Py_DECREF(item);
+            goto error;
+        }
+        Py_DECREF(item);
+        pos += (Py_ssize_t)length + 16;
+    }
+
+    PyBuffer_Release(&pbin);
+    return Py_BuildValue("(Nn)", records, pos);
+
+error:
+    Py_XDECREF(records);
+    PyBuffer_Release(&pbin);
+    return NULL;
+}
+
+#define BEANSDB_PADDING 256
+#define BEANSDB_MAX_KEY_LENGTH 250
+#define BEANSDB_MAX_VALUE_LENGTH (500 << 20)
+
+PyDoc_STRVAR(doc_parse_beansdb,
+"(bytes, pos = 0, limit = -1) -> (records, pos, bad). Parse complete beansdb\n"
+"records beginning in [pos, limit) into (key, ((flag, value), version, tstamp)),\n"
+"without checking CRC. bad is True if it stops at a header of bad sizes");
+
+static PyObject *
+crc32c_parse_beansdb(PyObject *self, PyObject *args)
+{
+    Py_buffer pbin;
+    const unsigned char *p;
+    Py_ssize_t pos = 0, limit = -1, n, rsize;
+    int32_t tstamp, flag, ver;
+    uint32_t ksz, vsz;
+    PyObject *records, *key, *value, *item;
+    int bad = 0;
+
+    if ( !PyArg_ParseTuple(args, "s*|nn:parse_beansdb", &pbin, &pos, &limit) )
+        return NULL;
+
+    p = pbin.buf;
+    n = pbin.len;
+    if (limit < 0 || limit > n)
+        limit = n;
+
+    records = PyList_New(0);
+    if (records == NULL)
+        goto error;
+
+    while (pos < limit && pos + 24 <= n) {
+        memcpy(&tstamp, p + pos + 4, 4);
+        memcpy(&flag, p + pos + 8, 4);
+        memcpy(&ver, p + pos + 12, 4);
+        memcpy(&ksz, p + pos + 16, 4);
+        memcpy(&vsz, p + pos + 20, 4);
+        if (ksz == 0 || ksz > BEANSDB_MAX_KEY_LENGTH || vsz > BEANSDB_MAX_VALUE_LENGTH) {
+            bad = 1;
+            break;
+        }
+        rsize = (24 + ksz + vsz + BEANSDB_PADDING - 1) & ~(Py_ssize_t)(BEANSDB_PADDING - 1);
+        if (rsize > n - pos)
+            break;
+
+        key = PyBytes_FromStringAndSize((const char *)p + pos + 24, ksz);
+        if (key == NULL)
+            goto error;
+        value = PyBytes_FromStringAndSize((const char *)p + pos + 24 + ksz, vsz);
+        if (value == NULL) {
+            Py_DECREF(key);
+            goto error;
+        }
+        item = Py_BuildValue("(N((iN)ii))", key, (int)flag, value, (int)ver, (int)tstamp);
+        if (item == NULL)
+            goto error;
+        if (PyList_Append(records, item) < 0) {
+            Py_DECREF(item);
+            goto error;
+        }
+        Py_DECREF(item);
+        pos += rsize;
+    }
+
+    PyBuffer_Release(&pbin);
+    return Py_BuildValue("(NnN)", records, pos, PyBool_FromLong(bad));
+
+error:
+    Py_XDECREF(records);
+    PyBuffer_Release(&pbin);
+    return NULL;
+}
+
 static PyMethodDef crc32c_module_methods[] = {
     {"crc32c",      crc32c_crc32c,      METH_VARARGS, doc_crc32c},
+    {"find_tfrecord", crc32c_find_tfrecord, METH_VARARGS, doc_find_tfrecord},
+    {"parse_tfrecords", crc32c_parse_tfrecords, METH_VARARGS, doc_parse_tfrecords},
+    {"parse_beansdb", crc32c_parse_beansdb, METH_VARARGS, doc_parse_beansdb},
     {NULL, NULL}                             /* sentinel */
 };
 
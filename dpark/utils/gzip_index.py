@@ -0,0 +1,360 @@
+""" Access points of gzip files, to decompress from the middle (like zran.c).
+
+    An access point is the beginning of a gzip member, or the end of a sync
+    flush marker (00 00 ff ff) where a deflate block begins at a byte boundary.
+    A point is kept only if decompressing from it gives the same data as
+    decompressing the whole file, and the last 32KB of data before it (window)
+    is kept only if needed, so files written by pigz -i or dpark have small
+    indexes.
+
+    point: (compressed offset, uncompressed offset, begins a line, window)
+    window: None at the header of a member, b'' if not needed, or the
+    window compressed by zlib.
+
+    Files written by write_members are made of independent members, whose
+    beginnings are the index.
+"""
+from __future__ import absolute_import
+import os
+import sys
+import stat
+import errno
+import zlib
+import struct
+import marshal
+import hashlib
+
+from dpark.utils import atomic_file, mkdir_p
+from dpark.utils.log import get_logger
+from dpark.file_manager.fs import ReadAhead
+
+logger = get_logger(__name__)
+
+INDEX_VERSION = 1
+READ_SIZE = 1 << 20
+MAX_OUTPUT = 8 << 20  # of one call of decompress
+WINDOW_SIZE = 32 << 10
+VERIFY_SIZE = 16 << 10
+SYNC_MARK = b'\x00\x00\xff\xff'
+GZIP_MAGIC = b'\x1f\x8b'
+FHCRC, FEXTRA, FNAME, FCOMMENT = 2, 4, 8, 16
+
+# zdict is not supported by zlib of python 2
+HAS_ZDICT = sys.version_info >= (3, 3)
+
+
+def gzip_header_size(buf):
+    """ size of the gzip member header at the beginning of buf,
+        -1 if buf is too short, 0 if it is not a gzip header
+    """
+    if len(buf) < 10:
+        if buf and not GZIP_MAGIC.startswith(buf[:2]):
+            return 0
+        return -1
+    if buf[:2] != GZIP_MAGIC:
+        return 0
+
+    flag, = struct.unpack('B', buf[3:4])
+    pos = 10
+    if flag & FEXTRA:
+        if len(buf) < pos + 2:
+            return -1
+        xlen, = struct.unpack('<H', buf[pos:pos + 2])
+        pos += 2 + xlen
+    for f in (FNAME, FCOMMENT):
+        if flag & f:
+            p = buf.find(b'\x00', pos)
+            if p < 0:
+                return -1
+            pos = p + 1
+    if flag & FHCRC:
+        pos += 2
+    return pos if pos <= len(buf) else -1
+
+
+def gzip_member(data, level=9):
+    """ data compressed as a gzip member """
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = c.compress(data) + c.flush()
+    xfl = b'\x02' if level == 9 else b'\x04' if level == 1 else b'\x00'
+    header = GZIP_MAGIC + b'\x08\x00\x00\x00\x00\x00' + xfl + b'\xff'
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return b''.join([header, body, trailer])
+
+
+def _compress_block(data, level):
+    return data, gzip_member(data, level)
+
+
+def write_members(f, blocks, threads=0, level=9):
+    """ write blocks of data as gzip members compressed by threads,
+        return the index of the members
+    """
+    points = []
+    coff = uoff = 0
+    starts_line = True
+    members = ReadAhead(_compress_block, ((b, level) for b in blocks if b), threads)
+    try:
+        for data, member in members:
+            points.append((coff, uoff, starts_line, None))
+            f.write(member)
+            coff += len(member)
+            uoff += len(data)
+            starts_line = data.endswith(b'\n')
+    finally:
+        members.close()
+    return points
+
+
+def _decompressor(window):
+    if window:
+        return zlib.decompressobj(-zlib.MAX_WBITS, zdict=zlib.decompress(window))
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def iter_decompress(f, point, read_size=READ_SIZE):
+    """ decompressed data from point to the end of file, across members """
+    coff, _, _, window = point
+    f.seek(coff)
+    buf = b''
+    dz = None if window is None else _decompressor(window)
+    while True:
+        if dz is None:
+            hs = gzip_header_size(buf)
+            while hs < 0:
+                d = f.read(read_size)
+                if not d:
+                    return
+                buf += d
+                hs = gzip_header_size(buf)
+            if hs == 0:
+                return  # padding after the last member
+            buf = buf[hs:]
+            dz = _decompressor(b'')
+
+        if not buf:
+            buf = f.read(read_size)
+            if not buf:
+                return
+
+        out = dz.decompress(buf, MAX_OUTPUT)
+        buf = dz.unconsumed_tail
+        if out:
+            yield out
+
+        if dz.unused_data:
+            # end of member, skip crc32 and size
+            buf = dz.unused_data
+            while len(buf) < 8:
+                d = f.read(read_size)
+                if not d:
+                    return
+                buf += d
+            buf = buf[8:]
+            dz = None
+
+
+def _verify(cdata, window, expected):
+    """ whether decompressing cdata with window gives expected """
+    try:
+        dz = _decompressor(window)
+        out = dz.decompress(cdata, len(expected))
+    except zlib.error:
+        return False
+    return len(out) == len(expected) and out == expected
+
+
+class _IndexBuilder(object):
+
+    def __init__(self):
+        self.points = []
+        self.uoff = 0
+        self.tail = b''  # the last WINDOW_SIZE bytes of data
+        self.last_point = 0
+        self.candidate = None  # (point, compressed data after, data after)
+
+    def add_point(self, coff, window):
+        starts_line = self.uoff == 0 or self.tail.endswith(b'\n')
+        self.points.append((coff, self.uoff, starts_line, window))
+        self.last_point = coff
+
+    def feed_output(self, out):
+        self.uoff += len(out)
+        if len(out) >= WINDOW_SIZE:
+            self.tail = out[-WINDOW_SIZE:]
+        else:
+            self.tail = (self.tail + out)[-WINDOW_SIZE:]
+
+    def set_candidate(self, coff):
+        starts_line = self.uoff == 0 or self.tail.endswith(b'\n')
+        self.candidate = ((coff, self.uoff, starts_line), [], [], self.tail)
+
+    def feed_candidate(self, cdata, out):
+        point, cs, outs, window = self.candidate
+        cs.append(cdata)
+        outs.append(out)
+        if sum(len(o) for o in outs) >= VERIFY_SIZE:
+            self.check_candidate()
+
+    def check_candidate(self):
+        if self.candidate is None:
+            return
+        (coff, uoff, starts_line), cs, outs, window = self.candidate
+        self.candidate = None
+        expected = b''.join(outs)[:VERIFY_SIZE]
+        if not expected:
+            return
+        cdata = b''.join(cs)
+        if _verify(cdata, b'', expected):
+            w = b''
+        elif HAS_ZDICT and _verify(cdata, zlib.compress(window), expected):
+            w = zlib.compress(window)
+        else:
+            return
+        self.points.append((coff, uoff, starts_line, w))
+        self.last_point = coff
+
+
+def build_index(f, span):
+    """ access points of a gzip file, at least `span` compressed bytes apart """
+    b = _IndexBuilder()
+    f.seek(0)
+    buf = f.read(READ_SIZE)
+    base = 0  # offset of buf in file
+    pos = 0
+    dz = None
+    while True:
+        if dz is None:
+            hs = gzip_header_size(buf[pos:])
+            while hs < 0:
+                d = f.read(READ_SIZE)
+                if not d:
+                    break
+                buf = buf[pos:] + d
+                base += pos
+                pos = 0
+                hs = gzip_header_size(buf)
+            if hs <= 0:
+                break
+            b.check_candidate()
+            if not b.points or base + pos - b.last_point >= span:
+                b.add_point(base + pos, None)
+            pos += hs
+            dz = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        if pos >= len(buf):
+            base += len(buf)
+            buf = f.read(READ_SIZE)
+            pos = 0
+            if not buf:
+                break
+
+        piece = buf[pos:]
+        want = False
+        if b.candidate is not None:
+            piece = piece[:VERIFY_SIZE]
+        else:
+            # stop at the span, then at the first sync mark after it
+            need = b.last_point + span - (base + pos)
+            if need > 0:
+                piece = piece[:need]
+            else:
+                want = True
+                m = piece.find(SYNC_MARK)
+                if m >= 0:
+                    piece = piece[:m + 4]
+
+        out = dz.decompress(piece, MAX_OUTPUT)
+        used = len(piece) - len(dz.unconsumed_tail) - len(dz.unused_data)
+        consumed_all = used == len(piece)
+        piece = piece[:used]
+        if b.candidate is not None:
+            b.feed_candidate(piece, out)
+        b.feed_output(out)
+        pos += used
+
+        if dz.unused_data:
+            # end of member, skip crc32 and size
+            while len(buf) - pos < 8:
+                d = f.read(READ_SIZE)
+                if not d:
+                    break
+                buf = buf[pos:] + d
+                base += pos
+                pos = 0
+            pos += 8
+            dz = None
+        elif want and consumed_all and piece.endswith(SYNC_MARK) and b.candidate is None:
+            b.set_candidate(base + pos)
+
+    b.check_candidate()
+    return b.points
+
+
+def private_dir(root):
+    """ root created private to the user, None if it is not private """
+    try:
+        mkdir_p(os.path.dirname(root))
+        os.mkdir(root, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.warning('fail to create gzip index dir %s: %s', root, e)
+            return None
+    st = os.lstat(root)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        logger.warning('gzip index dir %s is not private to the user, not used', root)
+        return None
+    return root
+
+
+def _index_path(path, size, mtime, index_dir):
+    key = '%s:%d:%d' % (path, size, int(mtime))
+    return os.path.join(index_dir, hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def sidecar_path(path):
+    d, name = os.path.split(path)
+    return os.path.join(d, '.%s.gzidx' % name)
+
+
+def _load(path, size, mtime, span):
+    try:
+        with open(path, 'rb') as f:
+            version, size_, mtime_, span_, points = marshal.loads(f.read())
+    except Exception:
+        return None
+    if version != INDEX_VERSION or size_ != size or int(mtime_) != int(mtime) or span_ > span:
+        return None
+    return points
+
+
+def save_index(path, size, mtime, span, points):
+    with atomic_file(path) as f:
+        f.write(marshal.dumps((INDEX_VERSION, size, int(mtime), span, points)))
+
+
+def get_index(f, path, size, mtime, span, index_dir, build=True):
+    """ load the index from the sidecar file or index_dir, build it if missing
+        and build, otherwise None. index_dir is used only if it is private
+        to the user.
+    """
+    index_dir = private_dir(index_dir)
+    paths = [sidecar_path(path)]
+    if index_dir is not None:
+        paths.append(_index_path(path, size, mtime, index_dir))
+    for p in paths:
+        points = _load(p, size, mtime, span)
+        if points is not None:
+            return points
+
+    if not build:
+        return None
+
+    logger.info('build gzip index of %s (%d bytes)', path, size)
+    points = build_index(f, span)
+    if index_dir is not None:
+        try:
+            save_index(_index_path(path, size, mtime, index_dir), size, mtime, span, points)
+        except (IOError, OSError) as e:
+            logger.warning('fail to save gzip index of %s: %s', path, e)
+    return points
@@ -6,7 +6,7 @@ from six.moves import range
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from dpark.utils.bitindex import BitIndex, Bloomfilter
+from dpark.utils.bitindex import BitIndex, Bloomfilter, RoaringBitmap
 
 
 class TestBitIndex(unittest.TestCase):
@@ -85,3 +85,34 @@ class TestBitIndex(unittest.TestCase):
         self.assertTrue(keys[0] in b)
         self.assertTrue(all(b.match(keys)))
         self.assertTrue(len([_f for _f in b.match(range(80000, 100000)) if _f]) < 100000 * 0.01)
+
+    def test_roaring_bitmap(self):
+        a = RoaringBitmap()
+        self.assertEqual(len(a), 0)
+        self.assertEqual(list(a), [])
+        self.assertRaises(ValueError, a.add, -1)
+
+        # sparse, dense and far containers
+        pos_a = set([3, 1, 70000, 1 << 31] + list(range(200000, 210000, 2)))
+        for p in pos_a:
+            a.add(p)
+        a.add(3)
+        self.assertEqual(list(a), sorted(pos_a))
+        self.assertEqual(len(a), len(pos_a))
+        self.assertEqual([type(c).__name__ for c in a.containers],
+                         ['array', 'array', 'bytearray', 'array'])
+        self.assertTrue(70000 in a)
+        self.assertTrue(200002 in a)
+        self.assertFalse(200001 in a)
+        self.assertFalse(5 in a)
+        self.assertFalse(-1 in a)
+
+        data = a.dumps()
+        self.assertEqual(RoaringBitmap.loads(data), a)
+        self.assertTrue(len(data) < 8192 + 100)
+
+        pos_b = set(random.randint(0, 300000) for i in range(5000))
+        b = RoaringBitmap(pos_b)
+        self.assertEqual(list(a | b), sorted(pos_a | pos_b))
+        self.assertEqual(list(b | a), sorted(pos_a | pos_b))
+        self.assertEqual(list(b | RoaringBitmap()), sorted(pos_b))
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+import os
+import shutil
+import datetime
+import tempfile
+import itertools
+import unittest
+
+from dpark.cache import (
+    MemoryCache, DiskCache, CacheTracker, HTTPConnectionPool, estimate_size,
+    MEMORY_SER, MEMORY_SER_COMPRESSED
+)
+from dpark.context import DparkContext
+from dpark.env import env
+from dpark.shuffle import pack_header
+from dpark.executor import LocalizedHTTP
+from dpark.utils import spawn
+from six.moves import range, socketserver
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_lru(self):
+        size = estimate_size(list(range(1000)))
+        cache = MemoryCache(int(size * 2.5))
+        evicted = env.task_stats.num_cache_evict
+        self.assertEqual(list(cache.put((1, 0), iter(range(1000)), is_iterator=True)),
+                         list(range(1000)))
+        cache.put((1, 1), list(range(1000)))
+        self.assertIsNotNone(cache.get((1, 0)))
+
+        cache.put((1, 2), list(range(1000)))
+        self.assertEqual(env.task_stats.num_cache_evict, evicted + 1)
+        self.assertIsNone(cache.get((1, 1)))
+        self.assertEqual(cache.get((1, 0)), tuple(range(1000)))
+        self.assertEqual(cache.get((1, 2)), tuple(range(1000)))
+        self.assertTrue(cache.used <= cache.capacity)
+
+    def test_too_large(self):
+        cache = MemoryCache(1000)
+        r = list(cache.put((1, 0), iter(range(10000)), is_iterator=True))
+        self.assertEqual(r, list(range(10000)))
+        self.assertIsNone(cache.get((1, 0)))
+        self.assertEqual(cache.used, 0)
+
+    def test_serialized(self):
+        cache = MemoryCache(1 << 20)
+        data = [(i, str(i)) for i in range(10000)]
+        for i, level in enumerate([MEMORY_SER, MEMORY_SER_COMPRESSED]):
+            r = list(cache.put_iter((1, i), iter(data), level))
+            self.assertEqual(r, data)
+            self.assertEqual(list(cache.get((1, i))), data)
+            self.assertEqual(list(cache.get((1, i))), data)
+
+        self.assertTrue(cache.sizes[(1, 1)] < cache.sizes[(1, 0)] < estimate_size(data))
+
+        # unmarshalable
+        data = [datetime.date(2000, 1, i % 28 + 1) for i in range(100)]
+        list(cache.put_iter((2, 0), iter(data), MEMORY_SER))
+        self.assertEqual(list(cache.get((2, 0))), data)
+
+    def test_rdd_cache(self):
+        ctx = DparkContext('local')
+        rdd = ctx.makeRDD(list(range(1000)), 4).map(lambda x: (x, x * 2))
+        rdd.cache(MEMORY_SER_COMPRESSED)
+        self.assertEqual(rdd.count(), 1000)
+        self.assertEqual(rdd.collect(), [(x, x * 2) for x in range(1000)])
+        self.assertRaises(ValueError, rdd.cache, 'DISK')
+
+        # a process per task (Mesos executor) keeps nothing in memory
+        env.register('PROCESS_PER_TASK', True)
+        try:
+            tracker = CacheTracker()
+            self.assertIsNone(tracker.mem_cache)
+            split = rdd.splits[1]
+            self.assertEqual(list(tracker.getOrCompute(rdd, split)), list(rdd.compute(split)))
+        finally:
+            env.environ.pop('PROCESS_PER_TASK', None)
+        ctx.stop()
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = DiskCache(None, self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_save_load(self):
+        data = [(i, str(i)) for i in range(100000)]
+        self.assertEqual(list(self.cache.put((1, 0), iter(data))), data)
+        self.assertEqual(list(self.cache.get((1, 0))), data)
+        # batches and the end mark
+        with open(self.cache.get_path((1, 0)), 'rb') as f:
+            self.assertEqual(f.read()[-5:], pack_header(0, True, False))
+
+        self.assertEqual(list(itertools.islice(self.cache.get((1, 0)), 10)), data[:10])
+
+        data = [datetime.date(2000, 1, i % 28 + 1) for i in range(100)]
+        self.assertEqual(list(self.cache.put((2, 0), data)), data)
+        self.assertEqual(list(self.cache.get((2, 0))), data)
+
+        self.assertEqual(list(self.cache.put((3, 0), [])), [])
+        self.assertEqual(list(self.cache.get((3, 0))), [])
+
+    def test_keep_alive(self):
+        data = list(range(1000))
+        list(self.cache.put((1, 0), data))
+
+        # the file server of executors
+        LocalizedHTTP.basedir = os.path.dirname(self.root)
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), LocalizedHTTP)
+        server.daemon_threads = True
+        spawn(server.serve_forever)
+        try:
+            pool = HTTPConnectionPool()
+            url = 'http://127.0.0.1:%d/%s/1_0' % (server.server_address[1],
+                                                  os.path.basename(self.root))
+            for i in range(3):
+                status, f = pool.urlopen(url)
+                self.assertEqual(status, 200)
+                self.assertEqual(list(self.cache.load(f)), data)
+                self.assertEqual(sum(len(c) for c in pool.conns.values()), 1)
+
+            status, f = pool.urlopen(url + '_404')
+            self.assertEqual(status, 404)
+            self.assertIsNone(f)
+            pool.clear()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
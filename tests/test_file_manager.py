@@ -0,0 +1,161 @@
+from __future__ import absolute_import
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import dpark.conf
+from dpark.file_manager.consts import CHUNKSIZE, TYPE_FILE
+from dpark.file_manager.fs import ReadAhead, MooseFS
+from six.moves import range
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def test_order(self):
+        for max_window in (0, 1, 8):
+            r = ReadAhead(lambda i: str(i), ((i,) for i in range(100)), max_window)
+            self.assertEqual(list(r), [str(i) for i in range(100)])
+            r.close()
+
+    def test_error(self):
+        def fetch(i):
+            if i == 5:
+                raise IOError('bad segment')
+            return i
+
+        r = ReadAhead(fetch, ((i,) for i in range(10)), 4)
+        self.assertEqual([next(r) for _ in range(5)], list(range(5)))
+        self.assertRaises(IOError, next, r)
+        r.close()
+
+    def test_adaptive_window(self):
+        def fetch(i):
+            time.sleep(0.02)
+            return i
+
+        r = ReadAhead(fetch, ((i,) for i in range(50)), 4)
+        self.assertEqual(r.window, 1)
+        t = time.time()
+        self.assertEqual(list(r), list(range(50)))
+        # slow fetch, fast reader: fetch in parallel
+        self.assertEqual(r.window, 4)
+        self.assertTrue(time.time() - t < 50 * 0.02 * 0.6)
+        r.close()
+
+
+class MockInfo(object):
+
+    def __init__(self, inode, length):
+        self.inode = inode
+        self.ftype = TYPE_FILE
+        self.length = length
+
+
+class MockChunk(object):
+
+    def __init__(self, inode, index):
+        self.id = inode * 100 + index
+        self.addrs = [('10.0.0.%d' % (inode % 3), 9422)]
+
+
+class MockProxy(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.calls = []
+
+    def getdirplus(self, inode):
+        self.calls.append(('getdirplus', inode))
+        return dict((name, MockInfo(i + 1, length))
+                    for i, (name, length) in enumerate(self.files))
+
+    def readchunk(self, inode, index):
+        self.calls.append(('readchunk', inode, index))
+        return MockChunk(inode, index)
+
+
+class MockMooseFS(MooseFS):
+
+    def __init__(self, proxy):
+        MooseFS.__init__(self)
+        self.proxy = proxy
+
+    def _get_indeed_root(self, root):
+        return root, self.proxy, 1
+
+    def _find_proxy(self, path):
+        return self.proxy
+
+
+class TestMooseFSMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.origin = dpark.conf.MOOSEFS_DIR_CACHE, dpark.conf.METADATA_CACHE_DIR
+        dpark.conf.MOOSEFS_DIR_CACHE = True
+        dpark.conf.METADATA_CACHE_DIR = self.dir
+
+    def tearDown(self):
+        dpark.conf.MOOSEFS_DIR_CACHE, dpark.conf.METADATA_CACHE_DIR = self.origin
+        shutil.rmtree(self.dir)
+
+    def test_prefetch(self):
+        files = [('a', 10), ('b', CHUNKSIZE * 2 + 1), ('c', 0)]
+        proxy = MockProxy(files)
+        fs = MockMooseFS(proxy)
+        paths = ['/mfs/d/%s' % name for name, _ in files]
+        fs.prefetch(paths)
+        self.assertEqual(sum(1 for c in proxy.calls if c[0] == 'getdirplus'), 1)
+        self.assertEqual(sum(1 for c in proxy.calls if c[0] == 'readchunk'), 4)
+
+        info, chunks = fs.get_meta('/mfs/d/b')
+        self.assertEqual(info.length, CHUNKSIZE * 2 + 1)
+        self.assertEqual(sorted(chunks), [0, 1, 2])
+        self.assertEqual(fs.get_meta('/mfs/d/c')[1], {})
+
+        # cached in memory, then on disk
+        del proxy.calls[:]
+        fs.prefetch(paths)
+        self.assertEqual(proxy.calls, [])
+        fs = MockMooseFS(proxy)
+        fs.prefetch(paths)
+        self.assertEqual(proxy.calls, [])
+        self.assertEqual(fs.get_meta('/mfs/d/a')[1][0].addrs, [('10.0.0.1', 9422)])
+
+        origin = dpark.conf.METADATA_CACHE_TTL
+        dpark.conf.METADATA_CACHE_TTL = -1
+        try:
+            fs = MockMooseFS(proxy)
+            fs.prefetch(paths[:1])
+            self.assertEqual(len(proxy.calls), 2)
+            self.assertIsNone(fs.get_meta('/mfs/d/a'))
+        finally:
+            dpark.conf.METADATA_CACHE_TTL = origin
+
+    def test_stat_files(self):
+        files = [('f%d' % i, i * 100) for i in range(50)]
+        proxy = MockProxy(files)
+        r = MockMooseFS(proxy).stat_files('/mfs/d', [n for n, _ in files])
+        self.assertEqual(r, [(n, size, ['10.0.0.%d' % ((i + 1) % 3)] if size else [])
+                             for i, (n, size) in enumerate(files)])
+        self.assertEqual(sum(1 for c in proxy.calls if c[0] == 'readchunk'), 49)
+
+    def test_private_cache_dir(self):
+        files = [('a', 10)]
+        proxy = MockProxy(files)
+        dpark.conf.METADATA_CACHE_DIR = os.path.join(self.dir, 'meta')
+        MockMooseFS(proxy).prefetch(['/mfs/d/a'])
+        self.assertEqual(os.stat(dpark.conf.METADATA_CACHE_DIR).st_mode & 0o777, 0o700)
+        self.assertEqual(len(os.listdir(dpark.conf.METADATA_CACHE_DIR)), 1)
+
+        # not used if others can write it
+        os.chmod(dpark.conf.METADATA_CACHE_DIR, 0o777)
+        del proxy.calls[:]
+        MockMooseFS(proxy).prefetch(['/mfs/d/a'])
+        self.assertEqual(len(proxy.calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
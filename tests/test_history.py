@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import dpark.conf
+from dpark.env import TaskStats
+from dpark.history import StageHistory, ProfileStore
+
+
+class MockScope(object):
+
+    def __init__(self, api_callsite):
+        self.api_callsite = api_callsite
+
+
+class MockRDD(object):
+
+    def __init__(self, api_callsite):
+        self.scope = MockScope(api_callsite)
+
+
+class MockStage(object):
+
+    def __init__(self, id, parents, n, api_callsite):
+        self.id = id
+        self.parents = parents
+        self.numPartitions = n
+        self.num_task_finished = 0
+        self.rdd = MockRDD(api_callsite)
+        self.rdd.cpus = 0
+        self.priority = 0
+        self.task_stats = [[] for _ in range(n)]
+
+    def get_tree_stages(self):
+        stages = [self]
+        for p in self.parents:
+            for s in p.get_tree_stages():
+                if s not in stages:
+                    stages.append(s)
+        return stages
+
+
+def make_stats(costs):
+    stages = [{'info': {'api_callsite': k, 'num_partition': n},
+               'stats': {'secs_all': {'sum': secs}}}
+              for k, (secs, n) in costs.items()]
+    return {'run': {'stages': stages}}
+
+
+class TestStageHistory(unittest.TestCase):
+
+    def test_rank_stages(self):
+        h = StageHistory()
+        h.loaded = True
+        h.add_job(make_stats({'a': (100, 10), 'b': (10, 10), 'c': (50, 10), 'f': (5, 10)}))
+
+        a = MockStage(1, [], 10, 'a')
+        b = MockStage(2, [], 10, 'b')
+        c = MockStage(3, [b], 10, 'c')
+        f = MockStage(4, [a, c], 10, 'f')
+        h.rank_stages(f)
+        self.assertEqual(f.priority, 5)
+        self.assertEqual(a.priority, 105)
+        self.assertEqual(c.priority, 55)
+        self.assertEqual(b.priority, 65)
+
+    def test_estimate(self):
+        h = StageHistory()
+        h.loaded = True
+        h.add_job(make_stats({'a': (100, 10)}))
+        a = MockStage(1, [], 10, 'a')
+        a.num_task_finished = 5
+        self.assertEqual(h.estimate(a), 50)
+
+        # unknown stage is estimated with mean secs of tasks
+        x = MockStage(2, [], 4, 'x')
+        self.assertEqual(h.estimate(x), 40)
+
+
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.origin_dir = dpark.conf.PROFILE_STORE_DIR
+        dpark.conf.PROFILE_STORE_DIR = self.dir
+
+    def tearDown(self):
+        dpark.conf.PROFILE_STORE_DIR = self.origin_dir
+        shutil.rmtree(self.dir)
+
+    def test_record_and_suggest(self):
+        stage = MockStage(1, [], 10, 'a')
+        for i in range(10):
+            s = TaskStats()
+            s.bytes_max_rss = (100 + i * 10) << 20
+            s.secs_all = 10
+            s.secs_cpu = 3
+            s.bytes_dump = 100 << 20
+            stage.task_stats[i].append(s)
+
+        store = ProfileStore()
+        store.record(stage, 1 << 30)
+        store.save()
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+
+        store = ProfileStore()
+        cpus, mem = store.suggest_resources(stage, 1 << 30, 0.25, 100)
+        self.assertEqual(cpus, 0.5)
+        self.assertEqual(mem, 228)  # max(190 * 1.2, 190)
+        # never lowered
+        self.assertEqual(store.suggest_resources(stage, 1 << 30, 1, 4000), (1, 4000))
+
+        # 1000MB output, 64MB per split
+        self.assertEqual(store.suggest_splits(stage.rdd, 100), 16)
+        self.assertEqual(store.suggest_splits(stage.rdd, 8), 8)
+        self.assertEqual(store.suggest_splits(MockRDD('b'), 8), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
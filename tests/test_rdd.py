@@ -5,10 +5,13 @@ import time
 from six.moves import map
 from six.moves import range
 from six.moves import zip
+from six.moves import cPickle
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import bz2
 import gzip
+import zlib
+import struct
 import unittest
 import random
 import operator
@@ -16,13 +19,15 @@ import shutil
 import logging
 from math import ceil
 import binascii
+import csv
 import uuid
 import tempfile
 import contextlib
 import dpark.conf
 from dpark.context import *
 from dpark.rdd import *
-from dpark.utils.beansdb import is_valid_key, restore_value
+from dpark.utils import beansdb
+from dpark.utils.beansdb import is_valid_key, restore_value, BeansdbReader, PADDING
 from dpark.accumulator import *
 from tempfile import mkdtemp
 from dpark.serialize import loads, dumps
@@ -174,6 +179,18 @@ class TestRDDNoShuffle(TestRDD):
         finally:
             shutil.rmtree(checkpoint_path)
 
+    def test_checkpoint_collection(self):
+        checkpoint_path = mkdtemp()
+        try:
+            # compute() of ParallelCollection returns a list
+            d = list(range(3000))
+            rdd = self.sc.makeRDD(d, 1).checkpoint(checkpoint_path)
+            self.assertEqual(rdd.collect(), d)
+            self.assertEqual(CheckpointRDD.generated_files(rdd.checkpoint_path), ['0'])
+            self.assertEqual(rdd.collect(), d)
+        finally:
+            shutil.rmtree(checkpoint_path)
+
     def test_checkpoint_partial(self):
         checkpoint_path = mkdtemp()
         try:
@@ -188,6 +205,118 @@ class TestRDDNoShuffle(TestRDD):
         finally:
             shutil.rmtree(checkpoint_path)
 
+    def test_checkpoint_stream(self):
+        checkpoint_path = mkdtemp()
+        try:
+            d = list(range(10000))
+            rdd = self.sc.makeRDD(d, 2).map(lambda x: (x, str(x))).checkpoint(checkpoint_path)
+            # partial partition is not saved
+            it = rdd.iterator(rdd.splits[0])
+            self.assertEqual(next(it), (0, '0'))
+            it.close()
+            self.assertEqual(CheckpointRDD.generated_files(rdd.checkpoint_path), [])
+
+            r = rdd.collect()
+            self.assertEqual(r, [(x, str(x)) for x in d])
+            self.assertEqual(CheckpointRDD.generated_files(rdd.checkpoint_path), ['0', '1'])
+            self.assertEqual(rdd.collect(), r)
+
+            # written by older versions
+            with open(os.path.join(rdd.checkpoint_path, '1'), 'wb') as f:
+                f.write(dumps(r[5000:]))
+            self.assertEqual(rdd.collect(), r)
+
+            # items changed by later rdds are saved as computed
+            rdd = self.sc.makeRDD(d, 2).map(lambda x: [x]).checkpoint(checkpoint_path)
+            self.assertEqual(rdd.map(lambda l: l.append(0) or l).count(), len(d))
+            self.assertEqual(rdd.collect(), [[x] for x in d])
+        finally:
+            shutil.rmtree(checkpoint_path)
+
+    def test_fingerprint(self):
+        def build(n, path):
+            words = self.sc.textFile(path).flatMap(lambda l: l.split())
+            return words.map(lambda w: (w, n)).reduceByKey(lambda x, y: x + y)
+
+        with temppath('fingerprint') as root:
+            os.makedirs(root)
+            path = os.path.join(root, 'input.txt')
+            with open(path, 'w') as f:
+                f.write('a b c\nd e\n')
+            fp = build(1, path).fingerprint()
+            self.assertEqual(build(1, path).fingerprint(), fp)
+            self.assertNotEqual(build(2, path).fingerprint(), fp)
+            self.assertNotEqual(build(1, path).map(lambda x: x).fingerprint(), fp)
+
+            with open(path, 'a') as f:
+                f.write('f\n')
+            self.assertNotEqual(build(1, path).fingerprint(), fp)
+
+            # files packed by combinedTextFile, rewritten at the same size
+            with open(os.path.join(root, 'other.txt'), 'w') as f:
+                f.write('x y\n')
+            fp = self.sc.combinedTextFile(root).fingerprint()
+            self.assertEqual(self.sc.combinedTextFile(root).fingerprint(), fp)
+            st = os.stat(path)
+            with open(path, 'w') as f:
+                f.write('a b c\nd g\nf\n')
+            os.utime(path, (st.st_atime, st.st_mtime + 10))
+            self.assertNotEqual(self.sc.combinedTextFile(root).fingerprint(), fp)
+
+        rdd = self.sc.makeRDD(list(range(10)), 2)
+        self.assertEqual(self.sc.makeRDD(list(range(10)), 2).fingerprint(), rdd.fingerprint())
+        self.assertNotEqual(self.sc.makeRDD(list(range(11)), 2).fingerprint(), rdd.fingerprint())
+        self.assertNotEqual(self.sc.makeRDD(list(range(10)), 3).fingerprint(), rdd.fingerprint())
+
+        # methods of classes are edited between runs
+        class Scale(object):
+            def __call__(self, x):
+                return x * 2
+        fp = rdd.map(Scale()).fingerprint()
+        self.assertEqual(rdd.map(Scale()).fingerprint(), fp)
+
+        class Scale(object):
+            def __call__(self, x):
+                return x * 3
+        self.assertNotEqual(rdd.map(Scale()).fingerprint(), fp)
+
+        import threading
+        lock = threading.Lock()
+        self.assertRaises(ValueError, rdd.map(lambda x: lock and x).fingerprint)
+
+    def test_persist(self):
+        path = mkdtemp()
+        try:
+            d = list(range(1000))
+            rdd = self.sc.makeRDD(d, 5).map(lambda x: x + 1).persist(path)
+            assert rdd._dependencies
+            r = rdd.collect()
+            self.assertEqual(r, [x + 1 for x in d])
+            assert not rdd._dependencies
+
+            rdd = self.sc.makeRDD(d, 5).map(lambda x: x + 1).persist(path)
+            assert not rdd._dependencies
+            self.assertEqual(rdd.collect(), r)
+
+            # evict least recently used
+            os.utime(rdd.checkpoint_path, (0, 0))
+            rdd2 = self.sc.makeRDD(d, 5).map(lambda x: x + 2)
+            origin_size = dpark.conf.PERSIST_CACHE_SIZE
+            dpark.conf.PERSIST_CACHE_SIZE = 1
+            try:
+                rdd2.persist(path)
+            finally:
+                dpark.conf.PERSIST_CACHE_SIZE = origin_size
+            self.assertEqual(os.listdir(path), [rdd2.fingerprint()])
+
+            # not persisted if the fingerprint is unknown
+            import threading
+            lock = threading.Lock()
+            rdd3 = self.sc.makeRDD(d, 5).map(lambda x: lock and x).persist(path)
+            self.assertFalse(rdd3.checkpoint_path)
+        finally:
+            shutil.rmtree(path)
+
     def test_long_lineage(self):
         checkpoint_path = mkdtemp()
         try:
@@ -472,6 +601,130 @@ class TestRDDShuffle(TestRDD):
                                                                   ).saveAsCSVFile(path),
                              [os.path.join(path, '0000.csv')])
 
+    def test_text_file_blocks(self):
+        srcpath = 'tests/test_rdd.py'
+        with open(srcpath) as f_:
+            lines = f_.read().split('\n')[:-1]
+
+        origin = TextFileRDD.READ_BLOCK_SIZE
+        try:
+            for block_size in (1, 100, 1 << 20):
+                TextFileRDD.READ_BLOCK_SIZE = block_size
+                for split_size in (333, 1 << 20):
+                    rdd = self.sc.textFile(srcpath, splitSize=split_size)
+                    r = sum([list(rdd.compute(sp)) for sp in rdd.splits], [])
+                    self.assertEqual(r, lines)
+        finally:
+            TextFileRDD.READ_BLOCK_SIZE = origin
+
+        # not read far after the end of split
+        class CountedFile(object):
+            def __init__(self, f):
+                self.f = f
+                self.size = 0
+
+            def read(self, n):
+                self.size += n
+                return self.f.read(n)
+
+        rdd = self.sc.textFile(srcpath)
+        with open(srcpath, 'rb') as f_:
+            f = CountedFile(f_)
+            r = list(rdd.read(f, 0, 1000))
+        self.assertEqual(r, lines[:len(r)])
+        self.assertTrue(sum(len(l) + 1 for l in r) >= 1000)
+        self.assertTrue(f.size <= 1000 + TextFileRDD.LINE_READ_SIZE)
+
+    def test_csv_file(self):
+        rows = [[str(i), 'a,b' if i % 3 else 'say "hi"\nline %d' % i, '' if i % 5 else '%d.5' % i]
+                for i in range(300)]
+        with temppath('csv') as root:
+            os.makedirs(root)
+            path = os.path.join(root, 'a.csv')
+            with open(path, 'w') as f:
+                csv.writer(f).writerows(rows)
+
+            origin = TextFileRDD.READ_BLOCK_SIZE
+            try:
+                for block_size in (1, 100, 1 << 20):
+                    TextFileRDD.READ_BLOCK_SIZE = block_size
+                    for split_size in (7, 333, 1 << 20):
+                        rdd = self.sc.csvFile(path, splitSize=split_size)
+                        self.assertEqual(rdd.collect(), rows)
+            finally:
+                TextFileRDD.READ_BLOCK_SIZE = origin
+
+            rdd = self.sc.csvFile(path, splitSize=333, types=[int, None, float])
+            self.assertEqual(rdd.collect(), [(int(a), b, float(c) if c else None)
+                                             for a, b, c in rows])
+
+            with open(path, 'w') as f:
+                f.write('1,2\n\n3\n')
+            self.assertEqual(self.sc.csvFile(path).collect(), [['1', '2'], [], ['3']])
+
+            # extra columns are kept, fewer columns do not match the types
+            rows = list(convert_csv_rows(iter([['1', 'a', 'x', 'y'], ['', 'b']]), [int, None]))
+            self.assertEqual(rows, [(1, 'a', 'x', 'y'), (None, 'b')])
+            self.assertRaises(ValueError, list, convert_csv_rows(iter([['1']]), [int, None]))
+
+            # typed rows to tables
+            with open(path, 'w') as f:
+                csv.writer(f).writerows([[i, 'k%d' % (i % 3), '%d.5' % i] for i in range(100)])
+            rdd = self.sc.csvFile(path, types=[int, None, float])
+            self.assertEqual(rdd.asTable('a, k, v').execute('select sum(v) where a < 10'),
+                             [(sum(i + .5 for i in range(10)),)])
+            tab = os.path.join(root, 'tab')
+            rdd.saveAsTabular(tab, 'a, k, v')
+            self.assertEqual(self.sc.tabular(tab).filterByIndex(a__ge=98).map(tuple).collect(),
+                             [(98, 'k2', 98.5), (99, 'k0', 99.5)])
+
+            # line breaks in quoted fields of compressed files
+            rows = [['1', 'a\nb'], ['2', 'c']]
+            gz = os.path.join(root, 'b.csv.gz')
+            with gzip.open(gz, 'wb') as f:
+                f.write(b'1,"a\nb"\n2,c\n')
+            self.assertEqual(self.sc.csvFile(gz).collect(), rows)
+
+    def test_combined_text_file(self):
+        with temppath('combined') as path:
+            os.makedirs(os.path.join(path, 'sub'))
+            for i in range(20):
+                with open(os.path.join(path, 'sub' if i % 2 else '', '%02d.txt' % i), 'w') as f:
+                    f.write(''.join('%d-%d\n' % (i, j) for j in range(i * 10)))
+            with gzip.open(os.path.join(path, 'z.gz'), 'wb') as f:
+                f.write(b'gz1\ngz2')
+            with open(os.path.join(path, 'large.txt'), 'w') as f:
+                f.write('x' * 100 + '\n' + 'y' * 3000 + '\n')
+
+            rdd = self.sc.combinedTextFile(path, splitSize=1000)
+            self.assertTrue(len(rdd.splits) < 22)
+            self.assertEqual(sorted(rdd.collect()), sorted(self.sc.textFile(path).collect()))
+
+            rdd = CombinedFileRDD(self.sc, [('a', 600, ['h1']), ('b', 600, ['h2']),
+                                            ('c', 600, ['h1', 'h2']), ('d', 100, [])], 1000)
+            self.assertEqual([sp.files for sp in rdd.splits],
+                             [[('a', 600), ('c', 600)], [('b', 600)], [('d', 100)]])
+            self.assertEqual([rdd.preferredLocations(sp) for sp in rdd.splits][2], [])
+
+        # decompressed in blocks, lines across blocks
+        origin = TextFileRDD.READ_BLOCK_SIZE
+        TextFileRDD.READ_BLOCK_SIZE = 100
+        lines = ['%d' % i * (i % 20) for i in range(1000)]
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        try:
+            with temppath('combined') as path:
+                os.makedirs(path)
+                with open(os.path.join(path, 'a.bz2'), 'wb') as f:
+                    f.write(bz2.compress(data[:5000]) + bz2.compress(data[5000:]))
+                with gzip.open(os.path.join(path, 'b.gz'), 'wb') as f:
+                    f.write(data)
+                with open(os.path.join(path, 'c.txt'), 'wb') as f:
+                    f.write(data[:-1])
+                rdd = self.sc.combinedTextFile(path, splitSize=1 << 20)
+                self.assertEqual(sorted(rdd.collect()), sorted(lines * 3))
+        finally:
+            TextFileRDD.READ_BLOCK_SIZE = origin
+
     def test_tfrecord(self):
         N = 1000
         d = self.sc.makeRDD(list(("the %d string" % i) for i in range(N)), 1)
@@ -493,6 +746,28 @@ class TestRDDShuffle(TestRDD):
             self.assertEqual(rd.count(), N)
             self.assertEqual(rd.map(lambda x: int(x)).reduce(lambda x, y: x + y), sum(range(N)))
 
+    def test_tfrecord_splits(self):
+        d = ['%d:%s' % (i, 'x' * (i * 7 % 300)) for i in range(3000)]
+        origin = OutputTfrecordstFileRDD.INDEX_SPAN, TfrecordsRDD.BUFFER_SIZE
+        OutputTfrecordstFileRDD.INDEX_SPAN = 4 << 10
+        TfrecordsRDD.BUFFER_SIZE = 1000
+        try:
+            with temppath('tfsplit') as path:
+                self.sc.makeRDD(d, 1).saveAsTFRecordsFile(path)
+                p = os.path.join(path, '0000.tfrecords')
+                self.assertTrue(os.path.exists(tfrecord_index_path(p)))
+                for split_size in (777, 10 << 10, 1 << 20):
+                    rd = self.sc.tfRecordsFile(path, splitSize=split_size)
+                    self.assertEqual(rd.collect(), d)
+
+                # find records by scanning
+                os.remove(tfrecord_index_path(p))
+                rd = self.sc.tfRecordsFile(path, splitSize=777)
+                self.assertIsNone(TfrecordsRDD(self.sc, p).load_index())
+                self.assertEqual(rd.collect(), d)
+        finally:
+            OutputTfrecordstFileRDD.INDEX_SPAN, TfrecordsRDD.BUFFER_SIZE = origin
+
     def test_compressed_file(self):
         # compress
         d = self.sc.makeRDD(list(range(100000)), 1)
@@ -508,6 +783,55 @@ class TestRDDShuffle(TestRDD):
             rd = self.sc.textFile(path, splitSize=10 << 10)
             self.assertEqual(rd.count(), 100000)
 
+    def test_gzip_members_output(self):
+        d = self.sc.makeRDD(list(range(100000)), 1).map(str).with_cpus(3)
+        origin = OutputTextFileRDD.BLOCK_SIZE
+        OutputTextFileRDD.BLOCK_SIZE = 16 << 10
+        with temppath('tout') as path:
+            try:
+                [p] = d.saveAsTextFile(path, compress=True)
+            finally:
+                OutputTextFileRDD.BLOCK_SIZE = origin
+            index = os.path.join(path, '.0000.gz.gzidx')
+            self.assertTrue(os.path.exists(index))
+            with gzip.open(p) as f:
+                self.assertEqual(f.read(), ''.join('%d\n' % i for i in range(100000)).encode())
+
+            rd = self.sc.textFile(p, splitSize=10 << 10)
+            self.assertTrue(len(rd) > 10)
+            self.assertEqual(rd.map(int).collect(), list(range(100000)))
+            # splits begin at members
+            self.assertTrue(all(pt[3] is None and pt[2] for sp in rd.splits for pt in sp.points))
+
+        rows = [(i, 'a,"%d"' % i, 'x\ny') for i in range(10000)]
+        with temppath('csvout') as path:
+            [p] = self.sc.makeRDD(rows, 1).saveAsCSVFile(path, compress=True)
+            self.assertTrue(p.endswith('.csv.gz'))
+            rd = self.sc.csvFile(path, types=[int, None, None])
+            self.assertEqual(rd.collect(), rows)
+
+    def test_text_file_by_key_sorted(self):
+        d = self.sc.makeRDD(list(range(50000)), 2).map(lambda i: (i % 37, 'line %d' % i))
+        origin = MultiOutputTextFileRDD.BLOCK_SIZE, MultiOutputTextFileRDD.SORT_BUFFER_SIZE
+        MultiOutputTextFileRDD.BLOCK_SIZE = 4 << 10
+        MultiOutputTextFileRDD.SORT_BUFFER_SIZE = 64 << 10  # several runs
+        try:
+            for compress in (False, True):
+                with temppath('tout') as path, temppath('tout2') as path2:
+                    files = d.saveAsTextFileByKey(path, compress=compress, sort=True)
+                    self.assertEqual(len(files), 37 * 2)
+                    d.saveAsTextFileByKey(path2, compress=compress)
+                    for k in range(37):
+                        sub = '%d/0001%s' % (k, '.gz' if compress else '')
+                        self.assertEqual(self.sc.textFile(os.path.join(path, sub)).collect(),
+                                         self.sc.textFile(os.path.join(path2, sub)).collect())
+                    self.assertEqual(self.sc.textFile(os.path.join(path, '5')).collect(),
+                                     ['line %d' % i for i in range(5, 50000, 37)])
+                    if compress:
+                        self.assertTrue(os.path.exists(os.path.join(path, '5', '.0000.gz.gzidx')))
+        finally:
+            MultiOutputTextFileRDD.BLOCK_SIZE, MultiOutputTextFileRDD.SORT_BUFFER_SIZE = origin
+
     def test_large_txt_file(self):
         with gen_big_text_file(64 << 10, 5 << 20, ext='txt') as f:
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
@@ -526,6 +850,63 @@ class TestRDDShuffle(TestRDD):
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
             self.assertEqual(rd.count(), f.cnt)
 
+    def test_gzip_index(self):
+        lines = [str(i) * (i % 50) for i in range(100000)]
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        index_dir = mkdtemp()
+        origin_dir = dpark.conf.GZIP_INDEX_DIR
+        dpark.conf.GZIP_INDEX_DIR = index_dir
+        try:
+            with temppath('gzip_index') as path:
+                os.makedirs(path)
+                # sync flush with shared window (pigz)
+                c = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+                with open(os.path.join(path, 'sync.gz'), 'wb') as f:
+                    f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03')
+                    for i in range(0, len(data), 100000):
+                        f.write(c.compress(data[i:i + 100000]))
+                        f.write(c.flush(zlib.Z_SYNC_FLUSH))
+                    f.write(c.flush())
+                    f.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+                # multiple members
+                with open(os.path.join(path, 'members.gz'), 'wb') as f:
+                    for i in range(0, len(data), 77777):
+                        with gzip.GzipFile(fileobj=f, mode='wb') as g:
+                            g.write(data[i:i + 77777])
+
+                # split at sync markers without index, not built by default
+                rdd = self.sc.textFile(os.path.join(path, 'sync.gz'), splitSize=64 << 10)
+                self.assertTrue(len(rdd) > 3)
+                self.assertEqual(rdd.collect(), lines)
+                self.assertEqual(os.listdir(index_dir), [])
+
+                dpark.conf.GZIP_INDEX_BUILD = True
+                for name in ('sync.gz', 'members.gz'):
+                    rdd = self.sc.textFile(os.path.join(path, name), splitSize=64 << 10)
+                    self.assertTrue(len(rdd) > 3)
+                    self.assertEqual(rdd.collect(), lines)
+                dpark.conf.GZIP_INDEX_BUILD = False
+
+                self.assertEqual(len(os.listdir(index_dir)), 2)
+                rdd = self.sc.textFile(os.path.join(path, 'sync.gz'), splitSize=128 << 10)
+                self.assertEqual(len(os.listdir(index_dir)), 2)
+                self.assertEqual(rdd.collect(), lines)
+
+                # indexes in a dir writable by others are not used
+                from dpark.utils import gzip_index
+                self.assertEqual(gzip_index.private_dir(index_dir), index_dir)
+                os.chmod(index_dir, 0o777)
+                self.assertEqual(gzip_index.private_dir(index_dir), None)
+                rdd = self.sc.textFile(os.path.join(path, 'sync.gz'), splitSize=64 << 10)
+                self.assertFalse(any(isinstance(sp, GZipSplit) for sp in rdd.splits))
+                self.assertEqual(rdd.collect(), lines)
+                os.chmod(index_dir, 0o700)
+        finally:
+            dpark.conf.GZIP_INDEX_DIR = origin_dir
+            dpark.conf.GZIP_INDEX_BUILD = False
+            shutil.rmtree(index_dir)
+
     def test_large_bz2_file(self):
         with gen_big_text_file(64 << 10, 5 << 20, ext='bz2') as f:
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
@@ -535,6 +916,10 @@ class TestRDDShuffle(TestRDD):
             rd = self.sc.textFile(f.name, splitSize=512 * 1024)
             self.assertEqual(rd.count(), f.cnt)
 
+            # decompress blocks by threads
+            rd2 = self.sc.textFile(f.name, splitSize=512 * 1024).with_cpus(3)
+            self.assertEqual(rd2.collect(), rd.collect())
+
     def test_binary_file(self):
         d = self.sc.makeRDD(list(range(100000)), 1)
         with temppath("bout") as path:
@@ -543,6 +928,37 @@ class TestRDDShuffle(TestRDD):
             rd = self.sc.binaryFile(path, fmt="I", splitSize=10 << 10)
             self.assertEqual(rd.count(), 100000)
 
+        d = self.sc.makeRDD([(i, i * 0.5, b'%03d' % (i % 1000)) for i in range(10000)], 2)
+        with temppath("bout") as path:
+            d.saveAsBinaryFile(path, fmt="<Id3s")
+            origin = BinaryFileRDD.READ_BLOCK_SIZE
+            BinaryFileRDD.READ_BLOCK_SIZE = 1000
+            try:
+                rd = self.sc.binaryFile(path, fmt="<Id3s", splitSize=10 << 10)
+                self.assertEqual(rd.collect(), d.collect())
+                rd = self.sc.binaryFile(path, length=15, splitSize=10 << 10)
+                self.assertEqual(rd.map(lambda x: struct.unpack('<Id3s', x)).collect(), d.collect())
+            finally:
+                BinaryFileRDD.READ_BLOCK_SIZE = origin
+
+    def test_binary_blocks(self):
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('numpy is not installed')
+
+        d = self.sc.makeRDD([(i, i * 0.5) for i in range(10000)], 2)
+        with temppath("bout") as path:
+            d.saveAsBinaryFile(path, fmt="<Id")
+            rd = self.sc.binaryFile(path, fmt="<Id", splitSize=10 << 10)
+            self.assertEqual(rd.mapBlocks(lambda a: int(a['f0'].sum())).reduce(lambda x, y: x + y),
+                             sum(range(10000)))
+
+            with temppath("bout2") as path2:
+                rd.mapBlocks(lambda a: a[a['f0'] % 2 == 0]).saveAsBinaryFile(path2, fmt="<Id")
+                self.assertEqual(self.sc.binaryFile(path2, fmt="<Id").collect(),
+                                 [x for x in d.collect() if x[0] % 2 == 0])
+
     def test_table_file(self):
         N = 100000
         d = self.sc.makeRDD(list(zip(list(range(N)), list(range(N)))), 1)
@@ -608,6 +1024,110 @@ class TestRDDShuffle(TestRDD):
             rdd = rdd.mapValue(lambda v: (restore_value(*v[0]), v[1], v[2]))
             check_rdd(rdd, files, num_splits_reduce, num_splits_reduce)
 
+    def test_beansdb_keys(self):
+        N = 1000
+        d = [(str(i).encode('utf-8'), 'v' * (i % 7 * 100)) for i in range(N)]
+        with temppath('beansdb-keys') as path:
+            self.sc.makeRDD(d, 2).saveAsBeansdb(path, compress=False)
+            keys = [b'3', b'500', b'999', b'-1', u'42']
+            rdd = self.sc.beansdb(path, depth=0, filter=keys)
+            expected = [(k, v) for k, v in d if k in (b'3', b'500', b'999', b'42')]
+            self.assertEqual(sorted(rdd.map(lambda k_v: (k_v[0], k_v[1][0])).collect()),
+                             sorted(expected))
+            rdd = self.sc.beansdb(path, depth=0, filter=lambda k: int(k) % 3 == 0)
+            self.assertEqual(sorted(rdd.map(lambda k_v: (k_v[0], k_v[1][0])).collect()),
+                             [(k, v) for k, v in sorted(d) if int(k) % 3 == 0])
+
+            data_path = os.path.join(path, '000.data')
+            reader = BeansdbReader(data_path, [b'%d' % i for i in range(0, N, 2)], raw=True)
+            reader.COALESCE_GAP = PADDING  # small reads, and records larger than them
+            r = list(reader.read(0, os.path.getsize(data_path)))
+            # in the order of positions
+            self.assertEqual([(k, restore_value(*v[0])) for k, v in r],
+                             [(k, v) for k, v in d[:N // 2] if int(k) % 2 == 0])
+
+            # one read of a group, also for its last record larger than PADDING
+            hint = data_path[:-5] + '.hint'
+            index = beansdb.load_hint_index(hint if os.path.exists(hint) else hint + '.qlz')
+            # up to the record of b'496', whose value has 600 bytes
+            positions = sorted(p & 0xffffff00 for p in index.positions)[:497]
+            seeks = []
+
+            class File(object):
+                def __init__(self, f):
+                    self.f = f
+                    self.read = f.read
+
+                def seek(self, pos):
+                    seeks.append(pos)
+                    self.f.seek(pos)
+
+            reader.COALESCE_GAP = reader.MAX_READ_SIZE = 1 << 30
+            with open(data_path, 'rb') as f:
+                r = list(reader.read_records(File(f), positions))
+            self.assertEqual(seeks, [0])
+            self.assertEqual([err for _, _, err in r], [None] * len(positions))
+            self.assertEqual(r[-1][1][1], b'496')
+
+    def test_beansdb_full_scan(self):
+        N = 1000
+        d = [(str(i).encode('utf-8'), 'v' * (i % 7 * 100)) for i in range(N)]
+        with temppath('beansdb-scan') as path:
+            self.sc.makeRDD(d, 1).saveAsBeansdb(path, compress=False)
+            data_path = os.path.join(path, '000.data')
+            size = os.path.getsize(data_path)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            reader = BeansdbReader(data_path, lambda k: True, fullscan=True)
+            reader.READ_SIZE = 1000  # records across chunks
+            for threads in (0, 2):
+                r = list(reader.read(0, size, threads))
+                self.assertEqual([(k, v[0]) for k, v in r], d)
+
+            # splits
+            r = list(reader.read(0, size // 3)) + list(reader.read(size // 3, size))
+            self.assertEqual([(k, v[0]) for k, v in r], d)
+
+            # skip a corrupted record
+            records = beansdb.parse_beansdb(data)[0]
+            pos = sum((24 + len(k) + len(v[0][1]) + PADDING - 1) // PADDING * PADDING
+                      for k, v in records[:500])
+            with open(data_path, 'r+b') as f:
+                f.seek(pos + 16)
+                f.write(b'\xff' * 4)
+            r = list(reader.read(0, size))
+            self.assertEqual([(k, v[0]) for k, v in r], d[:500] + d[501:])
+
+    def test_beansdb_writer_buffer(self):
+        N = 2000
+        d = [(str(i).encode('utf-8'), 'v' * (i % 7 * 100)) for i in range(N)]
+        with temppath('beansdb-writer') as path:
+            for compress in (False, True):
+                writer = beansdb.BeansdbWriter(path, 1, True, compress)
+                writer.BUFFER_SIZE = 10000  # flush many times
+                files = writer.write_bucket(iter(d), 3)
+                self.assertEqual(len(files), 16)
+                names = [n for i in range(16) for n in os.listdir(os.path.join(path, '%x' % i))]
+                self.assertEqual(len(names), 32)
+                self.assertFalse([n for n in names if n.endswith('.tmp')])
+
+                rdd = self.sc.beansdb(path, depth=1, filter=[b'7', b'1999', b'2000'])
+                self.assertEqual(sorted(rdd.map(lambda k_v: (k_v[0], k_v[1][0])).collect()),
+                                 [d[1999], d[7]])
+                rdd = self.sc.beansdb(path, depth=1, fullscan=True)
+                self.assertEqual(sorted(rdd.map(lambda k_v: (k_v[0], k_v[1][0])).collect()),
+                                 sorted(d))
+
+        # large hint files are not compressed
+        with temppath('beansdb-writer') as path:
+            writer = beansdb.BeansdbWriter(path, 0, True, True)
+            writer.MAX_COMPRESS_HINT_SIZE = 1000
+            writer.write_bucket(iter(d), 3)
+            self.assertEqual(sorted(os.listdir(path)), ['003.data', '003.hint'])
+            rdd = self.sc.beansdb(path, depth=0, filter=[b'7', b'1999'])
+            self.assertEqual(sorted(rdd.map(lambda k_v: (k_v[0], k_v[1][0])).collect()),
+                             [d[1999], d[7]])
+
     def test_beansdb_invalid_key(self):
         func = is_valid_key
         input_expect = [
@@ -643,6 +1163,233 @@ class TestRDDShuffle(TestRDD):
 
             self.assertEqual(sorted(x.f_int for x in r), sorted(x[0] for x in d if hash(x[2]) % 2))
 
+            rdd = self.sc.tabular(path, fields='f_int f_str')
+            self.assertEqual(rdd.mapStripes(lambda c: sum(c.f_int)).reduce(lambda x, y: x + y),
+                             sum(range(10000)))
+            self.assertEqual(rdd.mapStripes(lambda c: c._fields).first(), ['f_int', 'f_str'])
+            row = rdd.first()
+            self.assertEqual((row.f_int, row.f_str), tuple(row))
+            self.assertEqual(loads(dumps(row)).f_str, row.f_str)
+            self.assertEqual(rdd.map(lambda x: (x.f_int % 3, x)).groupByKey().count(), 3)
+
+    def test_tabular_zone_map(self):
+        import dpark.tabular as tabular
+        origin = tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE
+        tabular.STRIPE_SIZE = 1 << 16
+        tabular.STRIPE_HEADER_SIZE = 1 << 12
+        tabular.STRIPE_DATA_SIZE = tabular.STRIPE_SIZE - tabular.STRIPE_HEADER_SIZE
+        d = [(i, 'k%d' % (i % 3), i if i % 10 else None, str(uuid.uuid4()))
+             for i in range(20000)]
+        try:
+            with temppath('tabular-zone-map') as path:
+                self.sc.makeRDD(d, 2).saveAsTabular(path, 'ts, kind, v, pad', indices=['kind'])
+                rdd = self.sc.tabular(path)
+                n = len(rdd.splits)
+                self.assertTrue(n > 4)
+
+                r = rdd.filterByIndex(ts__ge=15000, ts__lt=15100)
+                self.assertTrue(len(r.splits) < n / 2)
+                self.assertEqual(sorted(x.ts for x in r.collect()), list(range(15000, 15100)))
+
+                r = rdd.filterByIndex(v__gt=19990, kind='k1')
+                self.assertEqual(len(r.splits), 1)
+                self.assertEqual([x.ts for x in r.collect()], [19993, 19996, 19999])
+
+                # not indexed, by min and max
+                r = rdd.filterByIndex(ts=[3, 19999])
+                self.assertEqual(len(r.splits), 2)
+                self.assertEqual(sorted(x.ts for x in r.collect()), [3, 19999])
+
+                r = rdd.filterByIndex(kind=lambda k: k == 'k4')
+                self.assertEqual(r.collect(), [])
+        finally:
+            tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE = origin
+
+    def test_tabular_zone_map_nulls(self):
+        d = [(i, None if i % 10 == 0 else 'v%d' % (i % 3)) for i in range(100)]
+        with temppath('tabular-zone-map-nulls') as path:
+            self.sc.makeRDD(d, 2).saveAsTabular(path, 'a, b')
+            rdd = self.sc.tabular(path)
+            nulls = [x[0] for x in d if x[1] is None]
+            self.assertEqual(sorted(x.a for x in rdd.filterByIndex(b=None).collect()), nulls)
+            self.assertEqual(sorted(x.a for x in rdd.filterByIndex(b=[None, 'v1']).collect()),
+                             [x[0] for x in d if x[1] in (None, 'v1')])
+            self.assertEqual(rdd.filterByIndex(b=lambda x: x is None).count(), len(nulls))
+            self.assertEqual(rdd.filterByIndex(b='v4').count(), 0)
+
+    def test_tabular_stats_cross_stripes(self):
+        import dpark.tabular as tabular
+        origin = tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE
+        tabular.STRIPE_SIZE = 1 << 16
+        tabular.STRIPE_HEADER_SIZE = 1 << 10
+        tabular.STRIPE_DATA_SIZE = tabular.STRIPE_SIZE - tabular.STRIPE_HEADER_SIZE
+        rnd = random.Random(1)
+        values = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(40))
+                  for _ in range(60)]
+        d = [tuple([i, '%016x' % rnd.getrandbits(64)] +
+                   [values[(i * 7 + j * 13) % 60] for j in range(8)])
+             for i in range(2000)]
+        try:
+            with temppath('tabular-stats') as path:
+                self.sc.makeRDD(d, 1).saveAsTabular(path, ['f%d' % j for j in range(10)])
+                p = os.path.join(path, '0000.dt')
+                with open(p, 'rb') as f:
+                    f.seek(-8, 2)
+                    fields_size, indices_size = struct.unpack('II', f.read(8))
+                    indices_offset = os.path.getsize(p) - 8 - fields_size - indices_size
+                    f.seek(indices_offset - 8)
+                    stats_size, _ = struct.unpack('I4s', f.read(8))
+                stats_offset = indices_offset - 8 - stats_size
+                # the stats begin in the last stripe and end after it
+                self.assertNotEqual(stats_offset // tabular.STRIPE_SIZE,
+                                    indices_offset // tabular.STRIPE_SIZE)
+                self.assertEqual(self.sc.tabular(path).map(tuple).collect(), d)
+        finally:
+            tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE = origin
+
+    def test_tabular_bitmap_index(self):
+        import dpark.tabular as tabular
+        origin = tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE
+        max_values = tabular.MAX_INDEX_VALUES
+        tabular.STRIPE_SIZE = 1 << 16
+        tabular.STRIPE_HEADER_SIZE = 1 << 12
+        tabular.STRIPE_DATA_SIZE = tabular.STRIPE_SIZE - tabular.STRIPE_HEADER_SIZE
+        # user is not ordered by stripes, kind is in every stripe
+        d = [(i, 'u%05d' % (i * 7919 % 20000), 'k%d' % (i % 3) if i % 10 else None,
+              str(uuid.uuid4())) for i in range(20000)]
+        try:
+            with temppath('tabular-bitmap-index') as path:
+                self.sc.makeRDD(d, 1).saveAsTabular(path, 'ts, user, kind, pad',
+                                                    indices=['user', 'kind'])
+                with open(os.path.join(path, '0000.dt'), 'rb') as f:
+                    _, indices, _ = tabular.read_footer(f)
+                self.assertTrue(isinstance(indices['user'], tabular.BitmapIndex))
+                self.assertEqual(len(indices['user'].values), 20000)
+
+                rdd = self.sc.tabular(path)
+                n = len(rdd.splits)
+                self.assertTrue(n > 4)
+
+                def check(r, expected):
+                    self.assertEqual(sorted(x.ts for x in r.collect()), sorted(expected))
+
+                r = rdd.filterByIndex(user=['u00042', 'u19999', 'x'])
+                self.assertTrue(len(r.splits) <= 2)
+                check(r, [x[0] for x in d if x[1] in ('u00042', 'u19999')])
+
+                r = rdd.filterByIndex(user__startswith='u0123')
+                self.assertTrue(len(r.splits) <= 10)
+                check(r, [x[0] for x in d if x[1].startswith('u0123')])
+
+                r = rdd.filterByIndex(user__gt='u19996')
+                self.assertTrue(len(r.splits) <= 3)
+                check(r, [x[0] for x in d if x[1] > 'u19996'])
+                r = rdd.filterByIndex(user__ge='u19990', user__lt='u19993')
+                check(r, [x[0] for x in d if 'u19990' <= x[1] < 'u19993'])
+                self.assertTrue(len(r.splits) <= 10)
+
+                r = rdd.filterByIndex(kind=None)
+                self.assertEqual(len(r.splits), n - 1)  # all stripes, not the footer
+                check(r, list(range(0, 20000, 10)))
+
+                r = rdd.filterByIndex(kind=lambda k: k == 'k4', user=lambda u: u < 'u00100')
+                self.assertEqual(r.collect(), [])
+
+                # functions not handling None on fields without nulls
+                r = rdd.filterByIndex(user=lambda u: u.startswith('u0123'))
+                self.assertTrue(len(r.splits) <= 10)
+                check(r, [x[0] for x in d if x[1].startswith('u0123')])
+
+                # wrong types of values
+                r = rdd.filterByIndex(user__gt=3, kind__startswith=b'k')
+                self.assertEqual(r.collect(), [])
+
+            # indices of older versions
+            old = tabular.AdaptiveIndex()
+            old.add('a', 1)
+            old.add('b', 3)
+            data = zlib.compress(cPickle.dumps({'f': old}, -1))
+            self.assertEqual(tabular.load_indices(data)['f'].match(None, ['b'], {1, 2, 3}), {3})
+
+            tabular.MAX_INDEX_VALUES = 100
+            index = tabular.BitmapIndex()
+            for i in range(101):
+                index.add(i, 0)
+            self.assertEqual(tabular.load_indices(tabular.dump_indices({'f': index})), {})
+        finally:
+            tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE = origin
+            tabular.MAX_INDEX_VALUES = max_values
+
+    def test_tabular_table_pushdown(self):
+        import dpark.tabular as tabular
+        origin = tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE
+        tabular.STRIPE_SIZE = 1 << 16
+        tabular.STRIPE_HEADER_SIZE = 1 << 12
+        tabular.STRIPE_DATA_SIZE = tabular.STRIPE_SIZE - tabular.STRIPE_HEADER_SIZE
+        d = [(i, i % 7, 'u%d' % (i // 1000), str(uuid.uuid4())) for i in range(20000)]
+        try:
+            with temppath('tabular-pushdown') as path:
+                self.sc.makeRDD(d, 1).saveAsTabular(path, 'ts, kind, user, pad', indices=['user'])
+                t = self.sc.tabular(path).asTable(None, 't')
+                self.assertEqual(t.fields, ['ts', 'kind', 'user', 'pad'])
+                plain = self.sc.makeRDD(d, 1).asTable(t.fields, 't')
+                n = len(t.prev.splits)
+
+                sql = "select ts, kind from t where user == 'u3' and kind in (1, 2) and ts > 3500"
+                r = t.execute(sql, asTable=True)
+                self.assertEqual(sorted(r.collect()), sorted(plain.execute(sql)))
+                self.assertEqual(len(r.collect()),
+                                 sum(1 for x in d if x[2] == 'u3' and x[1] in (1, 2) and x[0] > 3500))
+                # select of where of filterByIndex of the needed columns
+                filtered = r.prev.prev.prev
+                self.assertTrue(isinstance(filtered, tabular.FilteredByIndexRDD))
+                self.assertEqual(filtered.rdd.fields, ['ts', 'kind', 'user'])
+                self.assertTrue(len(filtered.splits) < n / 4)
+
+                # renamed fields, not pushed conditions
+                t2 = self.sc.tabular(path).asTable(['a', 'b', 'c', 'd'], 't2')
+                for where in ["b == 1 or c == 'u1'", "(c == 'u1' or b > 5) and a < 100",
+                              "c in ['u2', 'u5'] and not (a == 2500)", "b == c"]:
+                    sql = 'select a, count(*) from t2 where %s group by a' % where
+                    self.assertEqual(sorted(t2.execute(sql)),
+                                     sorted(plain.asTable(t2.fields, 't2').execute(sql)))
+                self.assertEqual(t2._where_filters("c in ['u2', 'u5'] and not (a == 2500)"),
+                                 {('c', ''): ['u2', 'u5']})
+                self.assertEqual(t2.execute('select count(*) from t2'), [(20000,)])
+
+            # files written before stats, without indices of the fields
+            d = [(i, 'v%d' % (i % 3)) for i in range(100)]
+            with temppath('tabular-pushdown-nostats') as path:
+                self.sc.makeRDD(d, 1).saveAsTabular(path, 'a, b')
+                p = os.path.join(path, '0000.dt')
+                with open(p, 'rb') as f:
+                    data = f.read()
+                fields_size, indices_size = struct.unpack('II', data[-8:])
+                footer = len(data) - 8 - fields_size - indices_size
+                stats_size, _ = struct.unpack('I4s', data[footer - 8:footer])
+                with open(p, 'wb') as f:
+                    f.write(data[:footer - 8 - stats_size] + data[footer:])
+                with open(p, 'rb') as f:
+                    self.assertEqual(tabular.read_footer(f)[2], None)
+
+                t = self.sc.tabular(path).asTable(None, 't')
+                self.assertFalse(t.prev.can_filter([('a', None)]))
+                self.assertEqual(t.execute('select a, b from t where a = 3'), [(3, 'v0')])
+
+            # nulls are not pushed down
+            d = [(i, None if i % 10 == 0 else 'v%d' % (i % 3)) for i in range(100)]
+            with temppath('tabular-pushdown-nulls') as path:
+                self.sc.makeRDD(d, 2).saveAsTabular(path, 'a, b')
+                t = self.sc.tabular(path).asTable(None, 't')
+                plain = self.sc.makeRDD(d, 2).asTable(['a', 'b'], 't')
+                for where in ['b == None', "b in (None, 'v1')"]:
+                    sql = 'select a from t where %s' % where
+                    self.assertEqual(sorted(t.execute(sql)), sorted(plain.execute(sql)))
+                self.assertEqual(len(t.execute('select a from t where b == None')), 10)
+                self.assertEqual(t._where_filters("b == None and b in (None, 'v1')"), {})
+        finally:
+            tabular.STRIPE_SIZE, tabular.STRIPE_HEADER_SIZE, tabular.STRIPE_DATA_SIZE = origin
+
 
 class TestRDDShuffleKeepOrder(TestRDDShuffle):
 